@@ -16,18 +16,34 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
 
+import copy
+import atexit
 import enki
 import json
+import multiprocessing
 import pbclient
 try:  # pragma: no cover
     import settings
 except ImportError:  # pragma: no cover
     import settings_testing as settings
 
-import requests
+import threading
 import time
+from collections import OrderedDict, namedtuple
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
 import pandas as pd
 import numpy as np
+from cache import LRUCache, normalize_name
+from client import session
+from connections import get_redis, get_queue
+from contributors import ContributorStore
+from log import get_logger, flush_logs, Stages
+from metrics import metrics
+from results import ResultWriter
+from species import SpeciesIndex
+from tally import Tally, TallyStore
+from workers import get_worker_pool
 
 # STATUS =  ['Extinct', 'Extinct in the wild', 'Critically Endangered', 'Endangered',
 #             'Vulnerable', 'Near Threatened', 'Least Concern']
@@ -39,14 +55,77 @@ RARE_FINDS = ['Endangered', 'Critically Endangered']
 REST = ['Extinct', 'Extinct in the wild', 'Vulnerable', 'Near Threatened',
         'Least Concern', 'Data deficient', 'Not evaluated']
 
+REQUIRED = ['project_short_name', 'task_id']
+
+logger = get_logger('analysis')
+
 enki.pbclient.set('api_key', settings.api_key)
 enki.pbclient.set('endpoint', settings.endpoint)
+if settings.http_share_with_pbclient:
+    enki.pbclient.requests = session
+
+# RQ work horses exit after every job, so background jobs always share the
+# red list cache through Redis.
+red_list_cache = LRUCache(settings.red_list_cache_size,
+                          settings.red_list_cache_ttl,
+                          redis=(get_redis() if settings.red_list_cache_redis or
+                                 settings.enable_background_jobs else None),
+                          prefix='instantwild:red_list:')
+
+species_indexes = {}
+
+enki_cache = LRUCache(settings.project_cache_size, settings.project_cache_ttl)
+
+tally_store = TallyStore(get_redis(), ttl=settings.tally_ttl)
+
+# Contributors are read, updated and written back by give_badges, so tasks
+# analyzed concurrently must not update the same contributor at once.
+contributor_locks = [threading.Lock() for i in range(64)]
+
+contributor_store = ContributorStore(get_redis())
+
+result_writer = ResultWriter(
+    lambda result: enki.pbclient.update_result(result),
+    settings.result_buffer_size, settings.result_buffer_interval,
+    settings.result_write_retries, settings.result_write_pool_size)
+atexit.register(result_writer.flush)
+
+
+def get_enki(project_short_name):
+    """Return an Enki instance for the project.
+
+    The project lookup is cached per worker process, and every caller gets
+    its own copy of the cached instance. RQ work horses only reuse the
+    projects cached by jobs.Worker before forking them.
+    """
+    if not enki_cache.enabled:
+        return enki.Enki(endpoint=settings.endpoint,
+                         api_key=settings.api_key,
+                         project_short_name=project_short_name,
+                         all=1)
+    e = enki_cache.get(project_short_name)
+    if e is None:
+        e = enki.Enki(endpoint=settings.endpoint,
+                      api_key=settings.api_key,
+                      project_short_name=project_short_name,
+                      all=1)
+        enki_cache.set(project_short_name, e)
+    return copy.copy(e)
+
+
+def invalidate_project(project_short_name=None):
+    """Forget the cached project, or all of them."""
+    if project_short_name is None:
+        enki_cache.clear()
+    else:
+        enki_cache.invalidate(project_short_name)
 
 
 def get_task(project_id, task_id):
     """Return task."""
     task = enki.pbclient.find_tasks(project_id, id=task_id, all=1)
-    print task
+    logger.debug('Task found', extra=dict(data=dict(task_id=task_id,
+                                                    found=len(task))))
     if len(task) > 0:
         return task[0]
     else:
@@ -64,96 +143,413 @@ def create_result(t, value, result):
         Create_time=t.info.get('Create_time')
     )
     result.info = tmp
+    return store_result(result)
+
+
+def store_result(result):
+    """Store a result in PyBossa.
+
+    With settings.result_buffer the result is queued in result_writer, and
+    stored with other results later.
+    """
+    if settings.result_buffer:
+        result_writer.add(result)
+        return result
     return enki.pbclient.update_result(result)
 
 
-def give_badges(e, t, answers, result):
-    topSpeciesScientific = [x['speciesScientificName'] for x in answers]
-    for tr in e.task_runs[t.id]:
-        if tr.user_id:
-            if (len(tr.info['answer']) == 1 and
-               tr.info['answer'][0]['animalCount'] == -1):
-                user_answer = []
+def concurrent_map(func, items, size):
+    """Map func over items using up to size threads."""
+    if size <= 1 or len(items) <= 1:
+        return map(func, items)
+    pool = ThreadPool(min(size, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+
+
+def get_user_answer(answer, topSpeciesScientific):
+    """Return the answers of a task run that match the consensus."""
+    if len(answer) == 1 and answer[0]['animalCount'] == -1:
+        return []
+    return list(filter(lambda x: x['speciesScientificName']
+                       in topSpeciesScientific, answer))
+
+
+def user_url(user_id):
+    """Return the API URL of a contributor."""
+    return settings.endpoint + '/api/user/%s?api_key=%s' % (user_id, settings.api_key)
+
+
+def get_contributor(user_id):
+    """Return the contributor from the PyBossa API."""
+    res = session.get(user_url(user_id))
+    return res.json()
+
+
+def update_contributor(user_id, contributor):
+    """Store the contributor in the PyBossa API."""
+    contributor.pop('n_answers', None)
+    contributor.pop('rank', None)
+    contributor.pop('score', None)
+    contributor.pop('registered_ago', None)
+    return session.put(user_url(user_id), headers={'content-type':
+                                                   'application/json'},
+                       data=json.dumps(contributor))
+
+
+def get_badge(user_answer, answers, result):
+    """Return the badge earned with the answers of a contributor, or None."""
+    badge = None
+    for ua in user_answer:
+        iucn_red_list_status = filter(lambda a:
+                                      a['speciesScientificName'] ==
+                                      ua['speciesScientificName'],
+                                      answers)[0]['iucn_red_list_status']
+        badge= dict(iucn_red_list_status=iucn_red_list_status,
+                    number=1,
+                    result_id=result.id)
+    return badge
+
+
+def compact_badges(info):
+    """Convert the badges list of a contributor to the compact format.
+
+    The compact format keeps the number of badges per red list status in
+    badge_counts, and the ids of the last settings.badge_results_size
+    awarded results in badge_results.
+    """
+    counts = info.setdefault('badge_counts', {})
+    results = info.setdefault('badge_results', [])
+    seen = set(results)
+    for b in info.pop('badges', None) or []:
+        if b['result_id'] not in seen:
+            status = b['iucn_red_list_status'] or 'Unknown'
+            counts[status] = counts.get(status, 0) + 1
+            results.append(b['result_id'])
+            seen.add(b['result_id'])
+    del results[:-settings.badge_results_size]
+    return info
+
+
+def apply_compact_badge(contributor, badge):
+    """Update the compact badges and karma of the contributor in memory."""
+    info = compact_badges(contributor['info'])
+    if badge is not None:
+        counts = info['badge_counts']
+        if badge['result_id'] in info['badge_results']:
+            logger.debug('Badge already in place',
+                         extra=dict(data=dict(result_id=badge['result_id'])))
+        else:
+            status = badge['iucn_red_list_status'] or 'Unknown'
+            counts[status] = counts.get(status, 0) + 1
+            info['badge_results'].append(badge['result_id'])
+            del info['badge_results'][:-settings.badge_results_size]
+        iucn_number = sum(counts.get(status, 0) for status in RARE_FINDS)
+        species_number = sum(counts.get(status, 0) for status in REST)
+        info['iucn_number'] = iucn_number
+        info['species_number'] = species_number + iucn_number
+        info['karma'] = (info.get('karma') or 0) + 1
+    else:
+        if info.get('iucn_number') is None:
+            info['iucn_number'] = 0
+        if info.get('species_number') is None:
+            info['species_number'] = 0
+        info['karma'] = max((info.get('karma') or 0) - 1, 0)
+    return contributor
+
+
+def apply_badge(contributor, badge):
+    """Update badges and karma of the contributor in memory.
+
+    badge is None when the contributor chose a wrong answer.
+    """
+    if settings.compact_badges:
+        return apply_compact_badge(contributor, badge)
+    if badge is not None:
+        if contributor.get('info').get('badges'):
+            current_badges = contributor.get('info').get('badges')
+            if (len(filter(lambda b: b['result_id'] ==
+                          badge['result_id'], current_badges)) == 0):
+                contributor['info']['badges'].append(badge)
             else:
-                user_answer = list(filter(lambda x: x['speciesScientificName']
-                                          in topSpeciesScientific,
-                                          tr.info['answer']))
-            url = settings.endpoint + '/api/user/%s?api_key=%s' % (tr.user_id, settings.api_key)
-            res = requests.get(url)
-            contributor = res.json()
-
-            if len(user_answer) > 0:
-                print "User %s chose the good answer" % tr.user_id
-                #print contributor.get('info').get('extra')
-                new_badges = []
-                for ua in user_answer:
-                    iucn_red_list_status = filter(lambda a:
-                                                  a['speciesScientificName'] ==
-                                                  ua['speciesScientificName'],
-                                                  answers)[0]['iucn_red_list_status']
-                    badge= dict(iucn_red_list_status=iucn_red_list_status,
-                                number=1,
-                                result_id=result.id)
-                    new_badges.append(badge)
-                if contributor.get('info').get('badges'):
-                    current_badges = contributor.get('info').get('badges')
-                    if (len(filter(lambda b: b['result_id'] ==
-                                  result.id, current_badges)) == 0):
-                        contributor['info']['badges'].append(badge)
-                    else:
-                        print("Badge already in place")
-                else:
-                    contributor['info']['badges'] = [badge]
-                badges = contributor['info']['badges']
-                iucn_number = len(filter(lambda b: b['iucn_red_list_status'] in
-                                     RARE_FINDS, badges))
-                species_number = len(filter(lambda b: b['iucn_red_list_status'] in
-                                        REST, badges))
-                #contributor['info']['iucn_number'] = len(contributor['info']['extra']['badges'])
-                contributor['info']['iucn_number'] = iucn_number
-                contributor['info']['species_number'] = species_number + iucn_number
-                if contributor['info'].get('karma'):
-                    contributor['info']['karma'] += 1
-                else:
-                    contributor['info']['karma'] = 1
+                logger.debug('Badge already in place',
+                         extra=dict(data=dict(result_id=badge['result_id'])))
+        else:
+            contributor['info']['badges'] = [badge]
+        badges = contributor['info']['badges']
+        iucn_number = len(filter(lambda b: b['iucn_red_list_status'] in
+                             RARE_FINDS, badges))
+        species_number = len(filter(lambda b: b['iucn_red_list_status'] in
+                                REST, badges))
+        contributor['info']['iucn_number'] = iucn_number
+        contributor['info']['species_number'] = species_number + iucn_number
+        if contributor['info'].get('karma'):
+            contributor['info']['karma'] += 1
+        else:
+            contributor['info']['karma'] = 1
+    else:
+        if contributor['info'].get('iucn_number') is None:
+            contributor['info']['iucn_number'] = 0
+        if contributor['info'].get('species_number') is None:
+            contributor['info']['species_number'] = 0
+        if contributor['info'].get('karma'):
+            contributor['info']['karma'] -= 1
+            if contributor['info']['karma'] < 0:
+                contributor['info']['karma'] = 0
+        else:
+            contributor['info']['karma'] = 0
+        if contributor['info'].get('badges') is None:
+            contributor['info']['badges'] = []
+    return contributor
+
+
+def award_badges(contributor, user_answer, answers, result):
+    """Update badges and karma of the contributor in memory."""
+    return apply_badge(contributor, get_badge(user_answer, answers, result))
+
+
+def flush_contributor(user_id):
+    """Store the pending badges of a contributor in PyBossa.
+
+    Returns the number of applied badges.
+    """
+    if not contributor_store.lock(user_id):
+        return 0
+    try:
+        badges = contributor_store.pending(user_id)
+        if len(badges) == 0:
+            return 0
+        contributor = get_contributor(user_id)
+        for badge in badges:
+            apply_badge(contributor, badge)
+        res = update_contributor(user_id, contributor)
+        if res.status_code != 200:
+            logger.warning('Contributor not updated',
+                           extra=dict(data=dict(user_id=user_id,
+                                                status_code=res.status_code)))
+            return 0
+        contributor_store.discard(user_id, len(badges))
+        return len(badges)
+    finally:
+        contributor_store.unlock(user_id)
+
+
+def flush_contributors():
+    """Store the pending badges of all the contributors in PyBossa.
+
+    Returns the number of applied badges.
+    """
+    return sum(concurrent_map(flush_contributor, contributor_store.dirty(),
+                              settings.badges_pool_size))
+
+
+def run_badge_stage():
+    """Store the pending badges of all the contributors in PyBossa.
+
+    Returns the number of applied badges.
+    """
+    # Cleared first, so badges pushed while it runs get a stage of their own
+    contributor_store.unschedule()
+    n = flush_contributors()
+    logger.info('Badges awarded', extra=dict(data=dict(badges=n)))
+    if settings.enable_background_jobs:
+        flush_logs()
+    return n
+
+
+def schedule_badge_stage(delay=None):
+    """Run the badge stage in the background, unless one is pending.
+
+    The stage is a job of settings.queue_name that waits delay seconds
+    (settings.badge_delay by default), so it updates every contributor once
+    for the badges of all the results stored meanwhile. Without background
+    jobs it waits in a thread of the app, and then runs in the worker pool
+    or right away.
+    """
+    if delay is None:
+        delay = settings.badge_delay
+    if not contributor_store.schedule(delay + settings.coalesce_ttl):
+        return
+    if settings.enable_background_jobs:
+        queue = get_queue()
+        if delay > 0:
+            queue.enqueue_in(timedelta(seconds=delay), run_badge_stage)
+        else:
+            queue.enqueue(run_badge_stage)
+    elif delay > 0:
+        timer = threading.Timer(delay, run_badge_stage)
+        timer.daemon = True
+        timer.start()
+    elif settings.enable_worker_pool:
+        if not get_worker_pool().submit(run_badge_stage):
+            # The badges stay pending for the next stage
+            contributor_store.unschedule()
+    else:
+        run_badge_stage()
+
+
+def give_badges(e, t, answers, result, contributions=None):
+    """Give badges and karma to the contributors of the task.
+
+    contributions is a list of (user_id, answer) for the task runs of
+    registered users; by default they are taken from e.task_runs.
+    Contributors are fetched once each, updated in memory and written back,
+    using up to settings.badges_pool_size concurrent requests. With
+    settings.defer_badges the badges are kept in Redis for the badge stage.
+    With settings.contributor_write_behind they are kept in Redis too, and
+    contributors are flushed every contributor_flush_size badges, or by a
+    badge stage contributor_flush_interval seconds later.
+    """
+    topSpeciesScientific = [x['speciesScientificName'] for x in answers]
+    if contributions is None:
+        contributions = [(tr.user_id, tr.info['answer'])
+                         for tr in e.task_runs[t.id] if tr.user_id]
+    user_ids = []
+    user_answers = []
+    for user_id, answer in contributions:
+        user_answers.append((user_id, get_user_answer(answer,
+                                                      topSpeciesScientific)))
+        if user_id not in user_ids:
+            user_ids.append(user_id)
+    if settings.defer_badges:
+        for user_id, user_answer in user_answers:
+            contributor_store.push(user_id, get_badge(user_answer, answers,
+                                                      result))
+        schedule_badge_stage()
+        return
+    if settings.contributor_write_behind:
+        full = []
+        for user_id, user_answer in user_answers:
+            n = contributor_store.push(user_id, get_badge(user_answer, answers,
+                                                          result))
+            if n >= settings.contributor_flush_size and user_id not in full:
+                full.append(user_id)
+        concurrent_map(flush_contributor, full, settings.badges_pool_size)
+        schedule_badge_stage(settings.contributor_flush_interval)
+        return
+    # Always taken in the same order, so concurrent tasks cannot deadlock
+    locks = sorted(set(contributor_locks[hash(user_id) % len(contributor_locks)]
+                       for user_id in user_ids), key=id)
+    for lock in locks:
+        lock.acquire()
+    try:
+        contributors = dict(zip(user_ids,
+                                concurrent_map(get_contributor, user_ids,
+                                               settings.badges_pool_size)))
+        for user_id, user_answer in user_answers:
+            logger.debug('Contributor answer',
+                         extra=dict(data=dict(user_id=user_id,
+                                              good=len(user_answer) > 0)))
+            award_badges(contributors[user_id], user_answer, answers, result)
+        concurrent_map(lambda user_id: update_contributor(user_id,
+                                                          contributors[user_id]),
+                       user_ids, settings.badges_pool_size)
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+
+def get_species_index(project_id):
+    """Return the species index of the project, loading it if needed."""
+    index = species_indexes.get(project_id)
+    if index is None:
+        index = SpeciesIndex(project_id, settings.endpoint,
+                             page_size=settings.species_index_page_size,
+                             refresh_interval=settings.species_index_refresh_interval)
+        index.load()
+        species_indexes[project_id] = index
+    return index
+
+
+def warm_project(project_id, project_short_name):
+    """Load what the jobs of a project cache in the current process.
+
+    RQ forks a work horse for every job, so whatever a job caches is lost
+    when it ends. jobs.Worker calls this before forking, so the work horses
+    inherit the cached project and its species index. Errors are logged and
+    ignored, as the job loads what it needs by itself.
+    """
+    try:
+        if enki_cache.enabled and project_short_name:
+            get_enki(project_short_name)
+        if settings.species_index:
+            index = species_indexes.get(project_id)
+            if index is None:
+                get_species_index(project_id)
             else:
-                print "User %s chose the wrong answer" % tr.user_id
-                if contributor['info'].get('iucn_number') is None:
-                    contributor['info']['iucn_number'] = 0
-                if contributor['info'].get('species_number') is None:
-                    contributor['info']['species_number'] = 0
-                if contributor['info'].get('karma'):
-                    contributor['info']['karma'] -= 1
-                    if contributor['info']['karma'] < 0:
-                        contributor['info']['karma'] = 0
-                else:
-                    contributor['info']['karma'] = 0
-                if contributor['info'].get('badges') is None:
-                    contributor['info']['badges'] = []
-            # Update contributor
-            contributor.pop('n_answers', None)
-            contributor.pop('rank', None)
-            contributor.pop('score', None)
-            contributor.pop('registered_ago', None)
-            res = requests.put(url, headers={'content-type':
-                                             'application/json'},
-                               data=json.dumps(contributor))
-            time.sleep(0)
+                index.refresh()
+    except Exception:
+        logger.exception('Project not warmed')
+    finally:
+        # Work horses must not inherit the keep-alive connections of the
+        # worker, which every one of them would reuse.
+        session.close()
 
 
 def get_red_list_status(topSpeciesScientific, project_id):
+    key = '%s:%s' % (project_id, normalize_name(topSpeciesScientific))
+    cached = red_list_cache.get(key)
+    if cached is not None:
+        return tuple(cached)
+    if settings.species_index:
+        index = get_species_index(project_id)
+        found = index.lookup(topSpeciesScientific)
+        if found is None and index.refresh() > 0:
+            found = index.lookup(topSpeciesScientific)
+        if found is not None:
+            red_list_cache.set(key, found)
+            return found
     hp_url = settings.endpoint + '/api/helpingmaterial?all=1&project_id=' + str(project_id) + '&info=scientific_name::' + topSpeciesScientific.replace(" ", '%26') + '&fulltextsearch=1'
-    res = requests.get(hp_url)
+    res = session.get(hp_url)
     iucn_red_list_status = None
+    species = None
     if res.status_code == 200:
         data = res.json()
-        print data
+        logger.debug('Helping material found',
+                     extra=dict(data=dict(scientific_name=topSpeciesScientific,
+                                          found=len(data))))
         if len(data) > 0:
             iucn_red_list_status = data[0]['info']['iucn_red_list_status']
             species = data[0]['info']['species']
+            red_list_cache.set(key, (iucn_red_list_status, species))
     return iucn_red_list_status, species
 
 
+def get_red_list_statuses(names, project_id):
+    """Return {name: (iucn_red_list_status, species)} for the species.
+
+    Every species is looked up once, using up to settings.red_list_pool_size
+    concurrent lookups. Raises multiprocessing.TimeoutError if they take
+    longer than settings.red_list_timeout seconds, so the job fails instead
+    of storing a result without the red list statuses. Failed jobs are not
+    run again by themselves.
+    """
+    unique = []
+    for name in names:
+        if name not in unique:
+            unique.append(name)
+    pool = ThreadPool(max(min(settings.red_list_pool_size, len(unique)), 1))
+    try:
+        pending = [(name, pool.apply_async(get_red_list_status,
+                                           (name, project_id)))
+                   for name in unique]
+        deadline = time.time() + settings.red_list_timeout
+        statuses = {}
+        for name, res in pending:
+            try:
+                statuses[name] = res.get(max(deadline - time.time(), 0))
+            except multiprocessing.TimeoutError:
+                logger.warning('Red list lookup timed out',
+                               extra=dict(data=dict(scientific_name=name)))
+                raise multiprocessing.TimeoutError(
+                    'Red list lookup of %s timed out' % name)
+        return statuses
+    finally:
+        pool.close()
+
+
 def get_count_nan(df):
     vc = None
     if 'speciesID' in df.columns and 'speciesScientificName' in df.columns:
@@ -168,95 +564,370 @@ def get_count_nan(df):
     return vc
 
 
+def get_no_animal(vc):
+    """Return True if no animal is the most common answer in vc.
+
+    vc are the value counts of get_count_nan. On a tie with a species the
+    species wins, like in Tally.top.
+    """
+    return (type(vc) == pd.Series and
+            (str(vc.index[0]) == 'nan' or vc.index[0] == -1) and
+            (len(vc) == 1 or vc.values[1] < vc.values[0]))
+
+
 def get_consensus(df, th=10):
-    consensus = df.groupby('speciesScientificName').filter(lambda x: len(x) >= th)
+    """Return the species chosen by at least th answers.
+
+    The animalCount statistics of every species are computed with vectorized
+    aggregations over a single grouping, as floats like describe() returns
+    them.
+    """
+    grouped = df.groupby('speciesScientificName')['animalCount']
+    size = grouped.size()
+    keep = (size >= th).values
     answer = []
-    for sp, val in consensus.groupby('speciesScientificName').size().iteritems():
-        animalCountDescribe = consensus.loc[consensus['speciesScientificName'] == sp,
-                                            'animalCount'].describe()
+    mins = grouped.min().astype(float)
+    maxes = grouped.max().astype(float)
+    for sp, mean, std, low, high in zip(size.index[keep],
+                                        grouped.mean().values[keep],
+                                        grouped.std().values[keep],
+                                        mins.values[keep], maxes.values[keep]):
         answer.append(dict(speciesScientificName=sp,
-                           animalCount=animalCountDescribe['mean'],
-                           animalCountStd=animalCountDescribe['std'],
-                           animalCountMin=animalCountDescribe['min'],
-                           animalCountMax=animalCountDescribe['max']))
+                           animalCount=mean,
+                           animalCountStd=std,
+                           animalCountMin=low,
+                           animalCountMax=high))
     return answer
 
-def basic(**kwargs):
-    """A basic analyzer."""
-    e = enki.Enki(endpoint=settings.endpoint,
-                  api_key=settings.api_key,
-                  project_short_name=kwargs['project_short_name'],
-                  all=1)
-    if kwargs['task_id']  != 95049:
-        e.get_tasks(task_id=kwargs['task_id'])
-        e.get_task_runs()
-        labels = ['task_run_id', 'speciesID', 'speciesScientificName',
-                  'speciesCommonName', 'animalCount']
-        for t in e.tasks:
+def iter_task_runs(project_id, task_id, last_id=0, limit=100):
+    """Yield the task runs of a task created after last_id.
+
+    Task runs are fetched a page at a time, when the previous page has been
+    consumed. Raises ValueError if PyBossa returns an error instead of a
+    page, so that nothing is decided from a partial list of task runs.
+    """
+    while True:
+        if last_id:
+            page = enki.pbclient.find_taskruns(project_id, task_id=task_id,
+                                               last_id=last_id, limit=limit,
+                                               all=1)
+        else:
+            page = enki.pbclient.find_taskruns(project_id, task_id=task_id,
+                                               limit=limit, offset=0, all=1)
+        if type(page) != list:
+            raise ValueError(page)
+        if len(page) == 0:
+            return
+        for tr in page:
+            yield tr
+        last_id = page[-1].id
+
+
+def get_new_task_runs(project_id, task_id, last_id=0, limit=100):
+    """Return the task runs of a task created after last_id."""
+    return list(iter_task_runs(project_id, task_id, last_id, limit))
+
+
+def update_tally(t):
+    """Return the stored tally of the task updated with its new task runs."""
+    tally = tally_store.load(t.project_id, t.id)
+    task_runs = tally.task_runs
+    for tr in iter_task_runs(t.project_id, t.id, tally.last_task_run_id):
+        tally.add_task_run(tr)
+    if tally.task_runs > task_runs:
+        tally_store.save(t.project_id, t.id, tally)
+    return tally
+
+
+def stream_tally(t):
+    """Return the tally of all the task runs of the task."""
+    tally = Tally()
+    for tr in iter_task_runs(t.project_id, t.id):
+        tally.add_task_run(tr)
+    return tally
+
+
+TaskContext = namedtuple('TaskContext', ['task', 'task_runs', 'tally',
+                                         'result'])
+
+
+def load_task_context(e, t, event, fetch_task_runs=None):
+    """Return the TaskContext of task t for a webhook event.
+
+    The result of the event is fetched while the task runs are loaded, by
+    calling fetch_task_runs (by default e.task_runs is already loaded) or,
+    with settings.incremental_tally, by updating the tally of the task. With
+    settings.stream_task_runs they are counted in a tally page by page, and
+    task_runs is None. result is None if the result does not exist.
+    """
+    def load_task_runs():
+        if settings.incremental_tally:
+            return update_tally(t)
+        if settings.stream_task_runs:
+            return stream_tally(t)
+        if fetch_task_runs is not None:
+            fetch_task_runs()
+
+    def find_result():
+        result = enki.pbclient.find_results(project_id=event['project_id'],
+                                            id=event['result_id'], all=1)
+        if len(result) > 0:
+            return result[0]
+
+    tally, result = concurrent_map(lambda load: load(),
+                                   [load_task_runs, find_result], 2)
+    task_runs = None if tally is not None else e.task_runs[t.id]
+    return TaskContext(t, task_runs, tally, result)
+
+
+def reopen_task(task):
+    """Ask for one more answer for the task."""
+    task.n_answers += 1
+    task.state = 'ongoing'
+    return enki.pbclient.update_task(task)
+
+
+def decided(stages, outcome):
+    """Record the decision taken for a task."""
+    stages.data['outcome'] = outcome
+    metrics.inc('instantwild_analysis_total', outcome=outcome)
+
+
+def analyze_context(ctx, stages=None):
+    """Analyze the task runs of a task and store the decision.
+
+    The time spent in every stage is added to stages. Returns None when
+    there is nothing to store for the task.
+    """
+    if stages is None:
+        stages = Stages()
+    t = ctx.task
+    project_id = t.project_id
+    tally = ctx.tally
+    contributions = None
+    with stages('decide'):
+        if tally is not None:
+            n_task_runs = tally.task_runs
+            contributions = tally.contributions
+            no_animal, top = tally.top()
+        elif settings.fast_analysis:
+            tally = Tally()
+            for tr in ctx.task_runs:
+                tally.add_task_run(tr)
+            n_task_runs = len(ctx.task_runs)
+            contributions = tally.contributions
+            no_animal, top = tally.top()
+        else:
             data = []
-            project_id = t.project_id
-            for tr in e.task_runs[t.id]:
+            for tr in ctx.task_runs:
                 for datum in tr.info['answer']:
                    data.append(datum)
             df = pd.DataFrame(data)
-            # If 5 first answers is nan (nothing here) mark task
-            # as completed
             vc = get_count_nan(df)
-            print vc.index[0]
-            print vc.values[0]
-            if len(e.task_runs[t.id]) == 5:
-                msg = "The five taskruns reported no animal"
-                if type(vc) == pd.Series and ((str(vc.index[0]) == 'nan' or
-                                              vc.index[0] == -1) and vc.values[0] == 5):
-                    result = enki.pbclient.find_results(project_id=kwargs['project_id'],
-                                                        id=kwargs['result_id'],all=1)
-                    if len(result) > 0:
-                        return create_result(t, settings.no_animal, result[0])
-                else:
-                    task = get_task(t.project_id, t.id)
-                    task.n_answers += 1
-                    task.state = 'ongoing'
-                    return enki.pbclient.update_task(task)
-            else:
-                if (str(vc.index[0]) == 'nan' or vc.index[0] == -1) and vc.values[0] >= 10:
-                    msg = "10 taskruns reported no animal"
-                    result = enki.pbclient.find_results(project_id=kwargs['project_id'],
-                                                        id=kwargs['result_id'],all=1)
-                    if len(result) > 0:
-                        return create_result(t, settings.no_animal, result[0])
+            no_animal = get_no_animal(vc)
+            top = vc.values[0]
+            n_task_runs = len(ctx.task_runs)
+            contributions = [(tr.user_id, tr.info['answer'])
+                             for tr in ctx.task_runs if tr.user_id]
+    stages.data.update(task_runs=n_task_runs, top=int(top))
+    # If 5 first answers is nan (nothing here) mark task
+    # as completed
+    if n_task_runs == 5:
+        msg = "The five taskruns reported no animal"
+        if no_animal and top == 5:
+            decided(stages, 'no_animal_5')
+            if ctx.result is not None:
+                with stages('write'):
+                    return create_result(t, settings.no_animal, ctx.result)
+        else:
+            decided(stages, 'reopen_5')
+            with stages('write'):
+                return reopen_task(t)
+    else:
+        if no_animal and top >= 10:
+            msg = "10 taskruns reported no animal"
+            decided(stages, 'no_animal_10')
+            if ctx.result is not None:
+                with stages('write'):
+                    return create_result(t, settings.no_animal, ctx.result)
+        else:
+            with stages('decide'):
+                if tally is not None:
+                    answers = tally.consensus(th=10)
                 else:
                     answers = get_consensus(df, th=10)
-                    if len(answers) == 0:
-                        if len(e.task_runs[t.id]) < 25:
-                            msg = "No consensus. Asking for one more answer."
-                            task = get_task(t.project_id, t.id)
-                            task.n_answers += 1
-                            task.state = 'ongoing'
-                            return enki.pbclient.update_task(task)
-                        else:
-                            result = enki.pbclient.find_results(project_id=kwargs['project_id'],
-                                                                id=kwargs['result_id'],all=1)
-                            if len(result) > 0:
-                                return create_result(t, settings.no_consensus,
-                                                     result[0])
-                    else:
-                        for a in answers:
-                            iucn_red_list_status, species = get_red_list_status(a['speciesScientificName'], project_id)
-                            a['speciesCommonName'] = species
-                            a['iucn_red_list_status'] = iucn_red_list_status
-                            a['imageURL'] = t.info.get('image', None)
-                            a['deploymentID'] = t.info.get('deploymentID', None)
-                            a['deploymentLocationID'] = t.info.get('deploymentLocationID', None)
-                            a['Create_time'] = t.info.get('Create_time')
-                        result = enki.pbclient.find_results(project_id=kwargs['project_id'],
-                                                            id=kwargs['result_id'],all=1)
-                        if len(result) > 0:
-                            result = result[0]
-                            if len(answers) == 1:
-                                result.info = answers[0]
-                            if len(answers) >= 2:
-                                result.info = dict(answers=answers)
-                            give_badges(e, t, answers, result)
-                            result = enki.pbclient.update_result(result)
-                            return 'OK'
-    return "OK"
+            if len(answers) == 0:
+                if n_task_runs < 25:
+                    msg = "No consensus. Asking for one more answer."
+                    decided(stages, 'reopen_no_consensus')
+                    with stages('write'):
+                        return reopen_task(t)
+                else:
+                    decided(stages, 'no_consensus')
+                    if ctx.result is not None:
+                        with stages('write'):
+                            return create_result(t, settings.no_consensus,
+                                                 ctx.result)
+            else:
+                decided(stages, 'consensus')
+                with stages('lookup'):
+                    statuses = get_red_list_statuses(
+                        [a['speciesScientificName'] for a in answers],
+                        project_id)
+                for a in answers:
+                    iucn_red_list_status, species = statuses[a['speciesScientificName']]
+                    a['speciesCommonName'] = species
+                    a['iucn_red_list_status'] = iucn_red_list_status
+                    a['imageURL'] = t.info.get('image', None)
+                    a['deploymentID'] = t.info.get('deploymentID', None)
+                    a['deploymentLocationID'] = t.info.get('deploymentLocationID', None)
+                    a['Create_time'] = t.info.get('Create_time')
+                if ctx.result is not None:
+                    result = ctx.result
+                    if len(answers) == 1:
+                        result.info = answers[0]
+                    if len(answers) >= 2:
+                        result.info = dict(answers=answers)
+                    if settings.defer_badges:
+                        # Stored right away, even with result_buffer, as
+                        # the badges are pushed for a stored result
+                        with stages('write'):
+                            res = enki.pbclient.update_result(result)
+                        # The job fails rather than awarding badges for a
+                        # result that was not stored (RQ does not retry it)
+                        if isinstance(res, dict):
+                            raise ValueError('Result %s not stored: %s'
+                                             % (result.id, res))
+                    with stages('badges'):
+                        give_badges(None, t, answers, result, contributions)
+                    if not settings.defer_badges:
+                        with stages('write'):
+                            result = store_result(result)
+                    return 'OK'
+
+
+def run_analysis(e, t, event, fetch_task_runs=None):
+    """Load and analyze task t, logging the duration of every stage."""
+    stages = Stages()
+    stages.data.update(project_id=t.project_id, task_id=t.id)
+    try:
+        with stages('fetch'):
+            ctx = load_task_context(e, t, event, fetch_task_runs)
+        return analyze_context(ctx, stages)
+    finally:
+        logger.info('Task analyzed', extra=dict(data=stages.to_dict()))
+
+
+def analyze_task(e, t, **kwargs):
+    """Analyze the task runs of task t and store the decision.
+
+    Returns None when there is nothing to store for the task.
+    """
+    return run_analysis(e, t, kwargs)
+
+
+def basic(**kwargs):
+    """A basic analyzer."""
+    try:
+        e = get_enki(kwargs['project_short_name'])
+        if kwargs['task_id']  != 95049:
+            e.get_tasks(task_id=kwargs['task_id'])
+            fetch_task_runs = e.get_task_runs
+            if settings.incremental_tally or settings.stream_task_runs:
+                fetch_task_runs = None
+            for t in e.tasks:
+                res = run_analysis(e, t, kwargs, fetch_task_runs)
+                fetch_task_runs = None
+                if res is not None:
+                    return res
+        return "OK"
+    finally:
+        # Only the worker pool of the app outlives the event, the RQ work
+        # horses exit after it
+        if settings.result_buffer and (settings.enable_background_jobs or
+                                       not settings.enable_worker_pool):
+            result_writer.flush()
+        if settings.enable_background_jobs:
+            flush_logs()
+
+
+def check_event(event):
+    """Return the failed status of an event missing required keys, or None."""
+    missing = [key for key in REQUIRED if key not in event]
+    if len(missing) > 0:
+        return dict(task_id=event.get('task_id'), status='failed',
+                    error='Missing %s' % ', '.join(missing))
+
+
+def basic_batch(events, only_completed=False):
+    """Analyze a batch of webhook events.
+
+    Events are grouped by project so a single Enki instance and a single
+    task runs fetch serve all the tasks of the project in the batch. The
+    tasks themselves are still fetched one request at a time, as the API
+    only finds tasks by a single id, and every event of a project fails if
+    one of them cannot be fetched. The tasks are then analyzed using up to
+    settings.analysis_pool_size threads. With only_completed, tasks that
+    are not completed are skipped. Returns a status per event, in the same
+    order.
+    """
+    statuses = [None] * len(events)
+    projects = OrderedDict()
+    for i, event in enumerate(events):
+        statuses[i] = check_event(event)
+        if statuses[i] is None:
+            projects.setdefault(event['project_short_name'], []).append(i)
+    for short_name, indexes in projects.items():
+        try:
+            e = get_enki(short_name)
+            task_ids = []
+            for i in indexes:
+                task_id = events[i]['task_id']
+                if task_id != 95049 and task_id not in task_ids:
+                    task_ids.append(task_id)
+            e.tasks = []
+            for task_id in task_ids:
+                found = enki.pbclient.find_tasks(project_id=e.project.id,
+                                                 id=task_id, limit=1,
+                                                 offset=0, all=1)
+                if type(found) != list:
+                    raise ValueError(found)
+                e.tasks += found
+            if only_completed:
+                e.tasks = [t for t in e.tasks if t.state == 'completed']
+            if (len(e.tasks) > 0 and not settings.incremental_tally and
+                    not settings.stream_task_runs):
+                e.get_task_runs()
+        except Exception as ex:
+            for i in indexes:
+                statuses[i] = dict(task_id=events[i].get('task_id'),
+                                   status='failed', error=str(ex))
+            continue
+        tasks = dict((t.id, t) for t in e.tasks)
+        todo = []
+        for i in indexes:
+            t = tasks.pop(events[i]['task_id'], None)
+            if t is None:
+                # Unknown tasks and repeated events of an analyzed task
+                statuses[i] = dict(task_id=events[i]['task_id'],
+                                   status='skipped')
+            else:
+                todo.append((i, t))
+
+        def analyze(item):
+            i, t = item
+            try:
+                analyze_task(e, t, **events[i])
+                return dict(task_id=events[i]['task_id'], status='ok')
+            except Exception as ex:
+                return dict(task_id=events[i]['task_id'], status='failed',
+                            error=str(ex))
+
+        for (i, t), status in zip(todo, concurrent_map(
+                analyze, todo, settings.analysis_pool_size)):
+            statuses[i] = status
+    if settings.result_buffer:
+        result_writer.flush()
+    if settings.enable_background_jobs:
+        flush_logs()
+    return statuses
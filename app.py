@@ -17,10 +17,15 @@
 # along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
 
 from flask import Flask, render_template, request, make_response, abort
-from flask import jsonify
-from analysis import basic
-from redis import Redis
-from rq import Queue
+from flask import jsonify, Response
+import json
+from analysis import basic, basic_batch, check_event
+from jobs import enqueue_analysis, enqueue_batch, get_priority_queue
+from jobs import PRIORITIES, queue_name
+from metrics import metrics
+from workers import get_worker_pool
+from connections import get_queue
+from redis.exceptions import RedisError
 try:
     import settings
 except ImportError:
@@ -36,8 +41,10 @@ def index():
         return render_template('index.html')
     else:
         if settings.enable_background_jobs:
-            q = Queue(settings.queue_name, connection=Redis())
-            q.enqueue(basic, **request.json)
+            enqueue_analysis(get_priority_queue(request.json), request.json)
+        elif settings.enable_worker_pool:
+            if not get_worker_pool().submit(basic, **request.json):
+                return make_response("Busy", 503)
         else:
             res = basic(**request.json)
             if (type(res) == dict and res['status'] == "failed"):
@@ -45,6 +52,79 @@ def index():
                                      int(res['status_code']))
         return "OK"
 
+
+def get_events():
+    """Return the events of a JSON array or NDJSON request."""
+    data = request.get_data()
+    try:
+        events = json.loads(data)
+    except ValueError:
+        try:
+            events = [json.loads(line) for line in data.splitlines()
+                      if line.strip()]
+        except ValueError:
+            abort(400)
+    if type(events) == dict:
+        events = [events]
+    if (type(events) != list or
+            any(type(event) != dict for event in events)):
+        abort(400)
+    return events
+
+
+@app.route("/batch", methods=['POST'])
+def batch():
+    events = get_events()
+    if settings.enable_background_jobs:
+        statuses = enqueue_batch(get_queue(), events)
+    elif settings.enable_worker_pool:
+        statuses = [check_event(event) or
+                    dict(task_id=event['task_id'], status='queued')
+                    for event in events]
+        valid = [event for event, status in zip(events, statuses)
+                 if status['status'] == 'queued']
+        if not get_worker_pool().submit(basic_batch, valid):
+            return make_response("Busy", 503)
+    else:
+        statuses = basic_batch(events)
+    return jsonify(statuses)
+
+
+def worker_pool_stats():
+    if not settings.enable_worker_pool:
+        return []
+    stats = get_worker_pool().stats()
+    return [(dict(state=state), stats[state])
+            for state in ['queued', 'running']]
+
+
+metrics.gauge('instantwild_worker_pool_jobs',
+              'Jobs of the in-process worker pool of this process.',
+              worker_pool_stats)
+
+
+def queue_stats():
+    if not settings.enable_background_jobs:
+        return []
+    names = [queue_name(priority) for priority in PRIORITIES]
+    if not settings.priority_queues:
+        names = [settings.queue_name]
+    try:
+        return [(dict(queue=name), len(get_queue(name))) for name in names]
+    except RedisError:
+        return []
+
+
+metrics.gauge('instantwild_queue_jobs',
+              'Background jobs waiting in every queue.',
+              queue_stats)
+
+
+@app.route("/metrics")
+def get_metrics():
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 if __name__ == "__main__": # pragma: no cover
     app.debug = True
     app.run()
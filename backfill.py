@@ -0,0 +1,251 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Re-analyze all the completed tasks of a project.
+
+Every result of the project is replayed as a task_completed webhook. Results
+are read page by page, and every page is analyzed by analysis.basic_batch in
+a pool of processes, skipping the tasks that are not completed. The results
+of a page are stored together when it ends. Badges are not given again
+unless asked, as contributors got them when the tasks were first analyzed.
+After each round of pages the last analyzed result is saved in a checkpoint
+file, so an interrupted backfill resumes from there:
+
+    python backfill.py instantwild --processes 4 --dry-run
+
+This exports:
+    - get_events: returns the webhook events of a page of results
+    - backfill: re-analyzes the completed tasks of a project
+
+"""
+import argparse
+import copy
+import json
+import os
+from collections import Counter
+from multiprocessing import Pool
+import enki
+import analysis
+try:  # pragma: no cover
+    import settings
+except ImportError:  # pragma: no cover
+    import settings_testing as settings
+
+
+def get_events(project, last_id=0, limit=100):
+    """Return the webhook events of the results created after last_id."""
+    if last_id:
+        results = enki.pbclient.find_results(project.id, last_id=last_id,
+                                             limit=limit, all=1)
+    else:
+        results = enki.pbclient.find_results(project.id, limit=limit,
+                                             offset=0, all=1)
+    if type(results) != list:
+        raise ValueError(results)
+    return [dict(project_short_name=project.short_name,
+                 project_id=project.id, task_id=r.task_id, result_id=r.id,
+                 event='task_completed') for r in results]
+
+
+def read_checkpoint(path):
+    """Return the saved progress of a backfill, or None."""
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_checkpoint(path, checkpoint):
+    """Save the progress of a backfill."""
+    if path is None:
+        return
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(checkpoint, f)
+    os.rename(tmp, path)
+
+
+class DryRun(object):
+
+    """Records the writes of the analysis instead of sending them."""
+
+    def __init__(self):
+        """Init method."""
+        self.writes = Counter()
+        self.saved = None
+
+    def update_result(self, result):
+        """Count a result update."""
+        self.writes['results'] += 1
+        return result
+
+    def update_task(self, task):
+        """Count a task update."""
+        self.writes['tasks'] += 1
+        return task
+
+    def update_contributor(self, user_id, contributor):
+        """Count a contributor update."""
+        self.writes['contributors'] += 1
+
+    def save_tally(self, project_id, task_id, tally):
+        """Count a tally update."""
+        self.writes['tallies'] += 1
+
+    def install(self):
+        """Replace the writes of the analysis in this process."""
+        self.saved = (enki.pbclient.update_result, enki.pbclient.update_task,
+                      analysis.update_contributor, analysis.tally_store,
+                      settings.contributor_write_behind, settings.defer_badges)
+        enki.pbclient.update_result = self.update_result
+        enki.pbclient.update_task = self.update_task
+        analysis.update_contributor = self.update_contributor
+        # Tallies are still read, but never saved to Redis
+        analysis.tally_store = copy.copy(analysis.tally_store)
+        analysis.tally_store.save = self.save_tally
+        settings.contributor_write_behind = False
+        settings.defer_badges = False
+
+    def uninstall(self):
+        """Restore the writes of the analysis."""
+        (enki.pbclient.update_result, enki.pbclient.update_task,
+         analysis.update_contributor, analysis.tally_store,
+         settings.contributor_write_behind, settings.defer_badges) = self.saved
+
+
+def skip_badges(*args, **kwargs):
+    """Give no badges."""
+
+
+dry_run = None
+
+saved = None
+
+
+def init_worker(is_dry_run, with_badges=False):
+    """Set up a backfill process."""
+    global dry_run, saved
+    saved = (analysis.give_badges, settings.result_buffer)
+    settings.result_buffer = True
+    if not with_badges:
+        # Giving them again would change the karma of the contributors
+        analysis.give_badges = skip_badges
+    if is_dry_run:
+        dry_run = DryRun()
+        dry_run.install()
+    else:
+        dry_run = None
+
+
+def restore_worker():
+    """Undo init_worker in this process."""
+    analysis.give_badges, settings.result_buffer = saved
+    if dry_run is not None:
+        dry_run.uninstall()
+
+
+def analyze_page(events):
+    """Analyze a page of events and return the number of every status.
+
+    Results that could not be stored are counted as unstored.
+    """
+    if dry_run is not None:
+        dry_run.writes.clear()
+    failed = analysis.result_writer.stats()['failed']
+    counts = Counter(status['status'] for status in
+                     analysis.basic_batch(events, only_completed=True))
+    unstored = analysis.result_writer.stats()['failed'] - failed
+    if unstored > 0:
+        counts['unstored'] += unstored
+    if dry_run is not None:
+        counts.update(dry_run.writes)
+    return dict(counts)
+
+
+def backfill(project_short_name, processes=4, page_size=100, checkpoint=None,
+             is_dry_run=False, restart=False, with_badges=False):
+    """Re-analyze the completed tasks of a project.
+
+    Returns the number of events per status (and with is_dry_run the number
+    of results, tasks and contributors that would have been updated).
+    """
+    project = analysis.get_enki(project_short_name).project
+    state = None if restart else read_checkpoint(checkpoint)
+    if state is None or state['project_id'] != project.id:
+        state = dict(project_id=project.id, last_id=0, counts={})
+    counts = Counter(state['counts'])
+    if processes > 1:
+        pool = Pool(processes, init_worker, (is_dry_run, with_badges))
+        run = pool.map
+    else:
+        init_worker(is_dry_run, with_badges)
+        run = map
+    try:
+        done = False
+        while not done:
+            # A round has a page per process
+            pages = []
+            for i in range(max(processes, 1)):
+                events = get_events(project, state['last_id'], page_size)
+                if len(events) > 0:
+                    pages.append(events)
+                    state['last_id'] = events[-1]['result_id']
+                if len(events) < page_size:
+                    done = True
+                    break
+            for page_counts in run(analyze_page, pages):
+                counts.update(page_counts)
+            state['counts'] = dict(counts)
+            write_checkpoint(checkpoint, state)
+            print "Analyzed results up to %s: %s" % (state['last_id'],
+                                                     dict(counts))
+    finally:
+        if processes > 1:
+            pool.close()
+            pool.join()
+        else:
+            restore_worker()
+    return dict(counts)
+
+
+def main():  # pragma: no cover
+    """Run the backfill."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('project_short_name')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--checkpoint',
+                        help='progress file (default backfill-PROJECT.json)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='analyze the tasks without storing anything')
+    parser.add_argument('--restart', action='store_true',
+                        help='ignore the checkpoint')
+    parser.add_argument('--badges', action='store_true',
+                        help='give the badges and karma again')
+    args = parser.parse_args()
+    checkpoint = args.checkpoint or 'backfill-%s.json' % args.project_short_name
+    if args.dry_run and not args.checkpoint:
+        checkpoint = None
+    print backfill(args.project_short_name, processes=args.processes,
+                   page_size=args.page_size, checkpoint=checkpoint,
+                   is_dry_run=args.dry_run, restart=args.restart,
+                   with_badges=args.badges)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,101 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmark of the consensus computation.
+
+Compares analysis.get_consensus with the previous implementation, which
+filtered the groups with a Python callback and ran a full describe() per
+species. Run it from the root of the project:
+
+    python -m bench.consensus
+
+"""
+import random
+import timeit
+import numpy as np
+import pandas as pd
+from analysis import get_consensus
+
+
+def describe_consensus(df, th=10):
+    """Previous get_consensus implementation, kept as reference."""
+    consensus = df.groupby('speciesScientificName').filter(lambda x: len(x) >= th)
+    answer = []
+    for sp, val in consensus.groupby('speciesScientificName').size().iteritems():
+        animalCountDescribe = consensus.loc[consensus['speciesScientificName'] == sp,
+                                            'animalCount'].describe()
+        answer.append(dict(speciesScientificName=sp,
+                           animalCount=animalCountDescribe['mean'],
+                           animalCountStd=animalCountDescribe['std'],
+                           animalCountMin=animalCountDescribe['min'],
+                           animalCountMax=animalCountDescribe['max']))
+    return answer
+
+
+def answers(n, n_species, seed=0):
+    """Return a DataFrame with n random answers."""
+    rnd = random.Random(seed)
+    data = []
+    for i in range(n):
+        if rnd.random() < 0.2:
+            data.append(dict(animalCount=-1))
+        else:
+            sp = rnd.randint(0, n_species - 1)
+            data.append(dict(animalCount=float(rnd.randint(1, 20)),
+                             speciesScientificName='species %s' % sp,
+                             speciesCommonName='common %s' % sp,
+                             speciesID=sp))
+    return pd.DataFrame(data)
+
+
+def same(answer, expected):
+    """Return True if both consensus are equal up to rounding errors."""
+    if len(answer) != len(expected):
+        return False
+    keys = ['animalCount', 'animalCountStd', 'animalCountMin',
+            'animalCountMax']
+    for a, b in zip(answer, expected):
+        if a['speciesScientificName'] != b['speciesScientificName']:
+            return False
+        if not np.allclose([a[k] for k in keys], [b[k] for k in keys],
+                           equal_nan=True):
+            return False
+    return True
+
+
+def run(name, df, number):
+    """Time both implementations on df and print the speedup."""
+    assert same(get_consensus(df), describe_consensus(df))
+    before = min(timeit.repeat(lambda: describe_consensus(df), number=number,
+                               repeat=3)) / number
+    after = min(timeit.repeat(lambda: get_consensus(df), number=number,
+                              repeat=3)) / number
+    print '%-30s describe: %9.3f ms  grouped: %9.3f ms  speedup: %5.1fx' % (
+        name, before * 1000, after * 1000, before / after)
+
+
+def main():
+    """Run the benchmarks."""
+    run('25 runs, 1 species', answers(25, 1), 200)
+    run('25 runs, 3 species', answers(25, 3), 200)
+    run('10000 answers, 50 species', answers(10000, 50), 10)
+    run('100000 answers, 500 species', answers(100000, 500), 2)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,226 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Local stand-in for the PyBossa API used by the benchmarks.
+
+It serves in memory projects, tasks, task runs, results, users and helping
+material with a configurable latency, and records when the analysis of every
+task finished (its result or the task itself was updated). Run it from the
+root of the project, writing the webhook events of its tasks to a file:
+
+    python -m bench.fake_pybossa --tasks 200 --latency 0.02 \\
+        --events events.jsonl
+
+and point the endpoint of settings.py to it (http://localhost:5001).
+
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from flask import Flask, request, jsonify, abort
+
+SPECIES = [('Loxodonta africana', 'African elephant', 'Vulnerable'),
+           ('Panthera leo', 'Lion', 'Vulnerable'),
+           ('Diceros bicornis', 'Black rhinoceros', 'Critically Endangered'),
+           ('Lycaon pictus', 'African wild dog', 'Endangered'),
+           ('Giraffa camelopardalis', 'Giraffe', 'Vulnerable'),
+           ('Syncerus caffer', 'African buffalo', 'Least Concern')]
+
+RESERVED = ['limit', 'offset', 'last_id', 'all', 'api_key',
+            'fulltextsearch', 'info', 'orderby', 'desc']
+
+
+class FakePyBossa(object):
+
+    """In memory PyBossa data."""
+
+    def __init__(self, n_tasks=100, n_users=50, seed=0,
+                 short_name='instantwild'):
+        """Init method."""
+        self.lock = threading.Lock()
+        self.rnd = random.Random(seed)
+        self.project = dict(id=1, short_name=short_name, name='Instant Wild',
+                            info={})
+        # Tasks without consensus need 25 different contributors
+        self.users = dict((i, dict(id=i, name='user%s' % i, info={}))
+                          for i in range(1, max(n_users, 25) + 1))
+        self.helpingmaterial = [
+            dict(id=i + 1, project_id=1,
+                 info=dict(scientific_name=name, species=common,
+                           iucn_red_list_status=status))
+            for i, (name, common, status) in enumerate(SPECIES)]
+        self.tasks = []
+        self.taskruns = []
+        self.results = []
+        self.completed = {}
+        for i in range(1, n_tasks + 1):
+            self.add_task(i)
+
+    def add_task(self, task_id):
+        """Create a task with the task runs of a random scenario."""
+        scenario = self.rnd.choice(['no_animal', 'consensus', 'disagreement'])
+        if scenario == 'no_animal':
+            answers = [[dict(animalCount=-1)] for i in range(5)]
+        elif scenario == 'consensus':
+            answers = [self.answer(SPECIES[task_id % len(SPECIES)])
+                       for i in range(10)]
+            answers += [[dict(animalCount=-1)] for i in range(2)]
+        else:
+            answers = [self.answer(self.rnd.choice(SPECIES))
+                       for i in range(25)]
+        self.tasks.append(dict(id=task_id, project_id=1, state='completed',
+                               n_answers=len(answers), info=dict(
+                                   image='http://image/%s.jpg' % task_id,
+                                   deploymentID='d%s' % task_id,
+                                   deploymentLocationID='l%s' % task_id,
+                                   Create_time='2017-01-01')))
+        self.results.append(dict(id=task_id, project_id=1, task_id=task_id,
+                                 info=None))
+        user_ids = self.rnd.sample(sorted(self.users), len(answers))
+        for answer, user_id in zip(answers, user_ids):
+            self.taskruns.append(dict(id=len(self.taskruns) + 1,
+                                      project_id=1, task_id=task_id,
+                                      user_id=user_id, info=dict(answer=answer)))
+
+    def answer(self, species):
+        """Return the answer of a task run for species."""
+        name, common, status = species
+        return [dict(speciesScientificName=name, speciesCommonName=common,
+                     speciesID=SPECIES.index(species),
+                     animalCount=float(self.rnd.randint(1, 4)))]
+
+    def events(self):
+        """Return the webhook events of all the tasks."""
+        return [dict(fired_at='2017-01-01 00:00:00',
+                     project_short_name=self.project['short_name'],
+                     project_id=1, task_id=t['id'], result_id=t['id'],
+                     event='task_completed') for t in self.tasks]
+
+    def complete(self, task_id):
+        """Record the time the analysis of a task finished."""
+        self.completed[int(task_id)] = time.time()
+
+
+def query(items, args):
+    """Filter items with the PyBossa API query arguments."""
+    filters = dict((k, v) for k, v in args.items() if k not in RESERVED)
+    found = [item for item in items
+             if all(str(item.get(k)) == v for k, v in filters.items())]
+    if args.get('fulltextsearch') and args.get('info'):
+        key, value = args['info'].split('::', 1)
+        words = value.lower().replace('&', ' ').split()
+        found = [item for item in found
+                 if all(w in str(item['info'].get(key, '')).lower()
+                        for w in words)]
+    if args.get('last_id'):
+        found = [item for item in found if item['id'] > int(args['last_id'])]
+    else:
+        found = found[int(args.get('offset', 0)):]
+    return found[:int(args.get('limit', 20))]
+
+
+def create_app(data, latency=0.0):
+    """Return the Flask app serving data."""
+    app = Flask(__name__)
+
+    @app.before_request
+    def delay():
+        if latency > 0:
+            time.sleep(latency)
+
+    @app.route('/api/project')
+    def projects():
+        return jsonify(query([data.project], request.args))
+
+    def listing(name, items):
+        app.add_url_rule('/api/' + name, name + '_list',
+                         lambda: jsonify(query(items, request.args)))
+
+    listing('task', data.tasks)
+    listing('taskrun', data.taskruns)
+    listing('result', data.results)
+    listing('helpingmaterial', data.helpingmaterial)
+
+    def update(items, id):
+        with data.lock:
+            for item in items:
+                if item['id'] == id:
+                    payload = json.loads(request.get_data() or '{}')
+                    item.update(dict((k, v) for k, v in payload.items()
+                                     if k != 'id'))
+                    return item
+        abort(404)
+
+    @app.route('/api/task/<int:id>', methods=['PUT'])
+    def task(id):
+        item = update(data.tasks, id)
+        data.complete(id)
+        return jsonify(item)
+
+    @app.route('/api/result/<int:id>', methods=['PUT'])
+    def result(id):
+        item = update(data.results, id)
+        data.complete(item['task_id'])
+        return jsonify(item)
+
+    @app.route('/api/user/<int:id>', methods=['GET', 'PUT'])
+    def user(id):
+        if id not in data.users:
+            abort(404)
+        if request.method == 'PUT':
+            return jsonify(update(data.users.values(), id))
+        return jsonify(data.users[id])
+
+    @app.route('/bench/completed')
+    def completed():
+        with data.lock:
+            return jsonify(dict((str(k), v)
+                                for k, v in data.completed.items()))
+
+    @app.route('/bench/reset', methods=['POST'])
+    def reset():
+        with data.lock:
+            data.completed.clear()
+        return 'OK'
+
+    return app
+
+
+def main():  # pragma: no cover
+    """Run the fake PyBossa server."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--tasks', type=int, default=100)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every API request')
+    parser.add_argument('--events', help='write the webhook events here')
+    args = parser.parse_args()
+    data = FakePyBossa(n_tasks=args.tasks, n_users=args.users, seed=args.seed)
+    if args.events:
+        with open(args.events, 'w') as f:
+            for event in data.events():
+                f.write(json.dumps(event) + '\n')
+    create_app(data, latency=args.latency).run(port=args.port, threaded=True)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
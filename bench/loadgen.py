@@ -0,0 +1,146 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Load generator replaying webhook events against the webhooks app.
+
+Events are read from a file with one JSON event per line, like the one
+written by bench.fake_pybossa, and posted to the app by a pool of threads.
+
+In sync mode (enable_background_jobs = False) the latency of an event is the
+duration of its POST. In rq mode the POST only enqueues a job, so the latency
+is measured until the fake PyBossa server records that the analysis of the
+task finished. Run it from the root of the project:
+
+    python -m bench.loadgen events.jsonl --mode rq --concurrency 8
+
+"""
+import argparse
+import json
+import math
+import threading
+import time
+import requests
+from Queue import Queue
+
+
+def percentile(values, p):
+    """Return the p percentile of values (nearest rank)."""
+    if len(values) == 0:
+        return float('nan')
+    values = sorted(values)
+    rank = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def read_events(path):
+    """Return the events of a file with one JSON event per line."""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def post_events(url, events, concurrency=4):
+    """POST events to url and return (sent, done, failed) per event."""
+    todo = Queue()
+    for i, event in enumerate(events):
+        todo.put((i, event))
+    sent = [None] * len(events)
+    done = [None] * len(events)
+    failed = [False] * len(events)
+    session = requests.Session()
+
+    def worker():
+        while True:
+            i, event = todo.get()
+            if event is None:
+                return
+            sent[i] = time.time()
+            try:
+                res = session.post(url, data=json.dumps(event),
+                                   headers={'content-type':
+                                            'application/json'})
+                failed[i] = res.status_code != 200
+            except requests.RequestException:
+                failed[i] = True
+            done[i] = time.time()
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for thread in threads:
+        todo.put((None, None))
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sent, done, failed
+
+
+def wait_completed(pybossa, task_ids, timeout=300, interval=0.5):
+    """Return the completion time of the tasks recorded by the fake server."""
+    deadline = time.time() + timeout
+    completed = {}
+    while time.time() < deadline:
+        completed = requests.get(pybossa + '/bench/completed').json()
+        if all(str(task_id) in completed for task_id in task_ids):
+            break
+        time.sleep(interval)
+    return [completed.get(str(task_id)) for task_id in task_ids]
+
+
+def report(mode, sent, done, failed):
+    """Return the throughput and latency percentiles of a run."""
+    latencies = [d - s for s, d, f in zip(sent, done, failed)
+                 if d is not None and not f]
+    finished = [d for d, f in zip(done, failed) if d is not None and not f]
+    elapsed = (max(finished) - min(sent)) if finished else float('nan')
+    return dict(mode=mode, events=len(sent), ok=len(latencies),
+                failed=len(sent) - len(latencies), seconds=elapsed,
+                throughput=len(latencies) / elapsed if finished else 0.0,
+                p50=percentile(latencies, 50), p95=percentile(latencies, 95),
+                p99=percentile(latencies, 99))
+
+
+def run(events, app, pybossa, mode='sync', concurrency=4, timeout=300):
+    """Replay events against app and return the report."""
+    if mode == 'rq':
+        requests.post(pybossa + '/bench/reset')
+    sent, done, failed = post_events(app, events, concurrency)
+    if mode == 'rq':
+        done = wait_completed(pybossa, [e['task_id'] for e in events],
+                              timeout=timeout)
+    return report(mode, sent, done, failed)
+
+
+def main():  # pragma: no cover
+    """Run the load generator."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('events', help='file with one JSON event per line')
+    parser.add_argument('--app', default='http://localhost:5000/')
+    parser.add_argument('--pybossa', default='http://localhost:5001')
+    parser.add_argument('--mode', choices=['sync', 'rq'], default='sync')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--timeout', type=float, default=300,
+                        help='seconds to wait for the rq jobs')
+    args = parser.parse_args()
+    res = run(read_events(args.events), args.app, args.pybossa,
+              mode=args.mode, concurrency=args.concurrency,
+              timeout=args.timeout)
+    print ('%(mode)s: %(ok)s/%(events)s events in %(seconds).2fs, '
+           '%(throughput).1f events/s, latency p50 %(p50).3fs '
+           'p95 %(p95).3fs p99 %(p99).3fs' % res)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
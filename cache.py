@@ -0,0 +1,134 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Read-through caches for the analysis workers.
+
+This exports:
+    - LRUCache: an in-process LRU cache with TTL, optionally backed by Redis
+    - normalize_name: normalizes a scientific name to be used as a key
+
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from redis.exceptions import RedisError
+
+_MISSING = object()
+
+
+def normalize_name(name):
+    """Return a normalized scientific name."""
+    if name is None:
+        return ''
+    return ' '.join(unicode(name).split()).lower()
+
+
+class LRUCache(object):
+
+    """In-process LRU cache with TTL and an optional Redis second level."""
+
+    def __init__(self, maxsize=1000, ttl=3600, redis=None, prefix='cache:'):
+        """Init method."""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.redis = redis
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self.redis_hits = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        """Return True if the cache stores anything at all."""
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, key, default=None):
+        """Return the cached value for key or default."""
+        if not self.enabled:
+            self.misses += 1
+            return default
+        now = time.time()
+        with self._lock:
+            item = self._data.pop(key, _MISSING)
+            if item is not _MISSING and item[0] > now:
+                self._data[key] = item
+                self.hits += 1
+                return item[1]
+        value = self._redis_get(key)
+        if value is not _MISSING:
+            self._store(key, value)
+            self.redis_hits += 1
+            self.hits += 1
+            return value
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        """Cache value under key."""
+        if not self.enabled:
+            return
+        self._store(key, value)
+        if self.redis is not None:
+            try:
+                self.redis.setex(self.prefix + key, self.ttl, json.dumps(value))
+            except RedisError:
+                pass
+
+    def invalidate(self, key):
+        """Remove key from the cache."""
+        with self._lock:
+            self._data.pop(key, None)
+        if self.redis is not None:
+            try:
+                self.redis.delete(self.prefix + key)
+            except RedisError:
+                pass
+
+    def clear(self):
+        """Empty the in-process cache and reset the counters."""
+        with self._lock:
+            self._data.clear()
+        self.hits = 0
+        self.misses = 0
+        self.redis_hits = 0
+
+    def stats(self):
+        """Return the cache counters."""
+        return dict(hits=self.hits, misses=self.misses,
+                    redis_hits=self.redis_hits, size=len(self._data))
+
+    def _store(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.ttl, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def _redis_get(self, key):
+        if self.redis is None:
+            return _MISSING
+        try:
+            value = self.redis.get(self.prefix + key)
+        except RedisError:
+            return _MISSING
+        if value is None:
+            return _MISSING
+        return json.loads(value)
@@ -0,0 +1,91 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Shared HTTP client for the PyBossa API.
+
+This exports:
+    - Session: a requests Session with connection pooling and timeouts
+    - session: the Session shared by the whole worker process
+
+"""
+import time
+import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import metrics
+try:  # pragma: no cover
+    import settings
+except ImportError:  # pragma: no cover
+    import settings_testing as settings
+
+# Names of the PyBossa API calls by method and domain object
+CALLS = {('GET', 'project'): 'find_project',
+         ('GET', 'task'): 'find_tasks',
+         ('PUT', 'task'): 'update_task',
+         ('GET', 'taskrun'): 'find_taskruns',
+         ('GET', 'result'): 'find_results',
+         ('PUT', 'result'): 'update_result',
+         ('GET', 'user'): 'get_user',
+         ('PUT', 'user'): 'update_user',
+         ('GET', 'helpingmaterial'): 'find_helpingmaterial'}
+
+
+def call_name(method, url):
+    """Return the name of the PyBossa API call of a request."""
+    parts = urlparse.urlparse(url).path.strip('/').split('/')
+    if 'api' not in parts or parts.index('api') == len(parts) - 1:
+        return 'other'
+    domain_object = parts[parts.index('api') + 1]
+    return CALLS.get((method.upper(), domain_object),
+                     '%s_%s' % (method.lower(), domain_object))
+
+
+class Session(requests.Session):
+
+    """requests Session with keep-alive pooling and a default timeout."""
+
+    def __init__(self, pool_size=10, timeout=30, gzip=True):
+        """Init method."""
+        super(Session, self).__init__()
+        self.timeout = timeout
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        if gzip:
+            self.headers['Accept-Encoding'] = 'gzip, deflate'
+        else:
+            self.headers['Accept-Encoding'] = 'identity'
+
+    def request(self, method, url, **kwargs):
+        """Send the request using the default timeout.
+
+        The duration of every request is recorded in the metrics.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.time()
+        try:
+            return super(Session, self).request(method, url, **kwargs)
+        finally:
+            metrics.observe('instantwild_pybossa_request_seconds',
+                            time.time() - start, call=call_name(method, url))
+
+
+session = Session(pool_size=settings.http_pool_size,
+                  timeout=settings.http_timeout,
+                  gzip=settings.http_gzip)
@@ -0,0 +1,59 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Redis connections shared by the web app and the workers.
+
+Every process keeps a pool of up to redis_pool_size connections to
+redis_url. When all of them are in use, callers wait up to redis_pool_timeout
+seconds for one to be released instead of opening new ones.
+
+This exports:
+    - pool: the connection pool of the process
+    - get_redis: returns a Redis client using the pool
+    - get_queue: returns the RQ queue of the webhooks
+
+"""
+from redis import Redis, BlockingConnectionPool
+from rq import Queue
+try:  # pragma: no cover
+    import settings
+except ImportError:  # pragma: no cover
+    import settings_testing as settings
+
+pool = BlockingConnectionPool.from_url(
+    settings.redis_url, max_connections=settings.redis_pool_size,
+    timeout=settings.redis_pool_timeout,
+    socket_timeout=settings.redis_socket_timeout,
+    socket_connect_timeout=settings.redis_connect_timeout)
+
+_redis = Redis(connection_pool=pool)
+
+_queues = {}
+
+
+def get_redis():
+    """Return a Redis client using the connection pool."""
+    return _redis
+
+
+def get_queue(name=None):
+    """Return the RQ queue called name (settings.queue_name by default)."""
+    name = name or settings.queue_name
+    if name not in _queues:
+        _queues[name] = Queue(name, connection=_redis)
+    return _queues[name]
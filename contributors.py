@@ -0,0 +1,91 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Pending badges and karma changes of the contributors.
+
+Every consensus appends the badge earned by each contributor (or None for a
+wrong answer) to a Redis list of the contributor. Flushing applies all of
+them to the contributor at once, and only removes the applied ones, so the
+changes pushed during a flush are kept for the next one.
+
+This exports:
+    - ContributorStore: keeps the pending changes of every contributor
+
+"""
+import json
+
+
+class ContributorStore(object):
+
+    """Keeps the pending badges of every contributor in Redis."""
+
+    def __init__(self, redis, prefix='instantwild:contributor:'):
+        """Init method."""
+        self.redis = redis
+        self.prefix = prefix
+        self.dirty_key = prefix + 'dirty'
+
+    def key(self, user_id):
+        """Return the Redis key of the pending badges of a contributor."""
+        return '%s%s' % (self.prefix, user_id)
+
+    def push(self, user_id, badge):
+        """Append a badge, and return the number of pending badges."""
+        n = self.redis.rpush(self.key(user_id), json.dumps(badge))
+        self.redis.sadd(self.dirty_key, user_id)
+        return n
+
+    def pending(self, user_id):
+        """Return the pending badges of a contributor."""
+        return [json.loads(badge)
+                for badge in self.redis.lrange(self.key(user_id), 0, -1)]
+
+    def discard(self, user_id, n):
+        """Forget the first n pending badges of a contributor."""
+        key = self.key(user_id)
+        self.redis.ltrim(key, n, -1)
+        self.redis.srem(self.dirty_key, user_id)
+        # Badges pushed meanwhile keep the contributor dirty
+        if self.redis.llen(key) > 0:
+            self.redis.sadd(self.dirty_key, user_id)
+
+    def dirty(self):
+        """Return the ids of the contributors with pending badges."""
+        return sorted(int(user_id)
+                      for user_id in self.redis.smembers(self.dirty_key))
+
+    def lock(self, user_id, ttl=60):
+        """Return True if the caller may flush the contributor."""
+        return bool(self.redis.set(self.key(user_id) + ':lock', 1, nx=True,
+                                   ex=ttl))
+
+    def unlock(self, user_id):
+        """Let others flush the contributor."""
+        self.redis.delete(self.key(user_id) + ':lock')
+
+    def schedule(self, ttl=600):
+        """Return True if no badge stage is pending, marking one as pending.
+
+        The mark expires after ttl seconds in case the stage is lost.
+        """
+        return bool(self.redis.set(self.prefix + 'scheduled', 1, nx=True,
+                                   ex=max(int(ttl), 1)))
+
+    def unschedule(self):
+        """Let the next badges schedule a new badge stage."""
+        self.redis.delete(self.prefix + 'scheduled')
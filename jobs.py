@@ -0,0 +1,206 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Background jobs for the webhooks.
+
+This exports:
+    - enqueue_analysis: enqueues the analysis of a webhook event
+    - enqueue_batch: enqueues the analysis of a batch of webhook events
+    - run_basic: the job that runs analysis.basic for a webhook event
+    - priority: returns the priority of the analysis of a webhook event
+    - get_priority_queue: returns the queue of the priority of an event
+    - Worker: an RQ worker recording the latency of every queue and warming
+      the projects of its jobs
+
+"""
+from collections import OrderedDict
+from datetime import timedelta
+from redis.exceptions import RedisError
+from rq import Worker as BaseWorker, get_current_job
+from rq.utils import utcnow
+from analysis import basic, basic_batch, check_event, tally_store
+from analysis import warm_project
+from connections import get_queue
+from log import get_logger
+from metrics import metrics
+try:  # pragma: no cover
+    import settings
+except ImportError:  # pragma: no cover
+    import settings_testing as settings
+
+PENDING = 'instantwild:pending:'
+RECEIVED = 'instantwild:webhooks:received'
+COALESCED = 'instantwild:webhooks:coalesced'
+
+PRIORITIES = ['high', 'default', 'low']
+
+logger = get_logger('jobs')
+
+
+def task_key(payload):
+    """Return the key of the pending analysis of the task of an event.
+
+    Jobs get ids of their own, as a task gets a new job once the previous
+    one starts.
+    """
+    return 'basic:%s:%s' % (payload.get('project_id'), payload.get('task_id'))
+
+
+def enqueue_analysis(queue, payload):
+    """Enqueue the analysis of a webhook event.
+
+    With coalesce_webhooks enabled, events for a task that already has a
+    pending job are merged into that job, which will analyze all the task
+    runs anyway. New jobs wait coalesce_window seconds before running so
+    close events are merged too. Returns the job, or None if merged.
+    """
+    if not settings.coalesce_webhooks:
+        return queue.enqueue(basic, **payload)
+    key = task_key(payload)
+    pipe = queue.connection.pipeline(transaction=False)
+    pipe.incr(RECEIVED)
+    # The pending flag is cleared when the job starts, so events arriving
+    # while it runs get a job of their own.
+    pipe.set(PENDING + key, 0, nx=True,
+             ex=settings.coalesce_window + settings.coalesce_ttl)
+    if not pipe.execute()[1]:
+        pipe.incr(PENDING + key)
+        pipe.incr(COALESCED)
+        pipe.execute()
+        return None
+    if settings.coalesce_window > 0:
+        return queue.enqueue_in(timedelta(seconds=settings.coalesce_window),
+                                run_basic, kwargs=payload)
+    return queue.enqueue_call(run_basic, kwargs=payload)
+
+
+def priority(payload):
+    """Return the priority of the analysis of a webhook event.
+
+    With priority_queues enabled, tasks whose tally has priority_task_runs
+    task runs or more can reach a final decision and are high priority,
+    while tasks reopened with fewer task runs are low priority. Tasks
+    without a tally have the default priority.
+    """
+    if not settings.priority_queues:
+        return 'default'
+    try:
+        count = tally_store.count(payload.get('project_id'),
+                                  payload.get('task_id'))
+    except RedisError:
+        return 'default'
+    if count is None:
+        return 'default'
+    if count >= settings.priority_task_runs:
+        return 'high'
+    return 'low'
+
+
+def queue_name(priority):
+    """Return the name of the queue of a priority."""
+    if priority == 'default':
+        return settings.queue_name
+    return '%s-%s' % (settings.queue_name, priority)
+
+
+def get_priority_queue(payload):
+    """Return the queue of the priority of a webhook event."""
+    return get_queue(queue_name(priority(payload)))
+
+
+def enqueue_batch(queue, events):
+    """Enqueue a basic_batch job per project and priority of the events.
+
+    Jobs with the default priority go to queue. All the jobs are sent to
+    Redis in a single pipeline. Returns a status per event, in the same
+    order.
+    """
+    statuses = []
+    groups = OrderedDict()
+    for event in events:
+        status = check_event(event)
+        if status is None:
+            status = dict(task_id=event['task_id'], status='queued')
+            key = (event['project_short_name'], priority(event))
+            groups.setdefault(key, []).append(event)
+        statuses.append(status)
+    pipe = queue.connection.pipeline()
+    for (_, level), group in groups.items():
+        target = queue if level == 'default' else get_queue(queue_name(level))
+        job = target.create_job(basic_batch, args=(group,))
+        target.enqueue_job(job, pipeline=pipe)
+    pipe.execute()
+    return statuses
+
+
+def run_basic(**payload):
+    """Run the analysis of a coalesced webhook event."""
+    job = get_current_job()
+    if job is not None:
+        key = PENDING + task_key(payload)
+        merged = int(job.connection.get(key) or 0)
+        job.connection.delete(key)
+        if merged > 0:
+            logger.info('Webhooks coalesced',
+                        extra=dict(data=dict(job_id=job.id, merged=merged)))
+    return basic(**payload)
+
+
+def job_projects(job):
+    """Return the (project_id, project_short_name) of the events of a job."""
+    events = job.args[0] if job.args else [job.kwargs]
+    projects = OrderedDict()
+    for event in events:
+        if isinstance(event, dict) and event.get('project_id') is not None:
+            projects[event['project_id']] = event.get('project_short_name')
+    return list(projects.items())
+
+
+class Worker(BaseWorker):
+
+    """RQ worker recording how long the jobs of every queue wait and run.
+
+    Before forking the work horse of a job, the worker warms the projects of
+    the job in its own process, so their species indexes survive the work
+    horses.
+
+    Run it with the queues in priority order:
+
+        rqworker -w jobs.Worker mywebhooks-high mywebhooks mywebhooks-low
+    """
+
+    def execute_job(self, job, queue):
+        """Warm the projects of a job, then run it in a work horse."""
+        for project_id, project_short_name in job_projects(job):
+            warm_project(project_id, project_short_name)
+        return BaseWorker.execute_job(self, job, queue)
+
+    def perform_job(self, job, queue, *args, **kwargs):
+        """Perform a job, observing its wait and run times."""
+        if job.enqueued_at is not None:
+            metrics.observe('instantwild_queue_wait_seconds',
+                            (utcnow() - job.enqueued_at).total_seconds(),
+                            queue=queue.name)
+        with metrics.timer('instantwild_job_seconds', queue=queue.name):
+            return BaseWorker.perform_job(self, job, queue, *args, **kwargs)
+
+
+def coalesce_stats(conn):
+    """Return the number of received and coalesced events."""
+    return dict(received=int(conn.get(RECEIVED) or 0),
+                coalesced=int(conn.get(COALESCED) or 0))
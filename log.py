@@ -0,0 +1,200 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Structured logging for the webhooks.
+
+Records are written as one JSON object per line by a background thread, so
+logging never blocks the analysis on stdout. Fields given as
+extra=dict(data={...}) are added to the JSON object.
+
+This exports:
+    - get_logger: returns the logger of a module
+    - configure: sets up the loggers of the webhooks
+    - flush_logs: waits until the records of the webhooks are written
+    - JSONFormatter: formats records as JSON
+    - SamplingFilter: keeps a sample of the records below WARNING
+    - QueueHandler: hands records to a background thread
+    - Stages: measures the duration of the stages of an analysis
+
+"""
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from Queue import Queue, Full
+try:  # pragma: no cover
+    import settings
+except ImportError:  # pragma: no cover
+    import settings_testing as settings
+
+ROOT = 'instantwild'
+
+_formatter = logging.Formatter()
+
+
+def get_logger(name):
+    """Return the logger of a module."""
+    return logging.getLogger('%s.%s' % (ROOT, name))
+
+
+class JSONFormatter(logging.Formatter):
+
+    """Formats records as JSON objects."""
+
+    def format(self, record):
+        """Return the record as a JSON object."""
+        data = dict(time=round(record.created, 3), level=record.levelname,
+                    logger=record.name, message=record.getMessage())
+        data.update(getattr(record, 'data', None) or {})
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, default=unicode)
+
+
+class SamplingFilter(logging.Filter):
+
+    """Keeps a rate of the records below WARNING, and all the others."""
+
+    def __init__(self, rate=1.0):
+        """Init method."""
+        logging.Filter.__init__(self)
+        self.rate = rate
+
+    def filter(self, record):
+        """Return True if the record is kept."""
+        return (record.levelno >= logging.WARNING or
+                self.rate >= 1 or random.random() < self.rate)
+
+
+class QueueHandler(logging.Handler):
+
+    """Hands records to a thread that sends them to the target handler.
+
+    Records are dropped when the queue is full. Processes forked after the
+    thread was started (like the RQ work horses) have no thread, so they
+    send the records to the target handler themselves.
+    """
+
+    def __init__(self, target, maxsize=10000):
+        """Init method."""
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue = Queue(maxsize)
+        self.dropped = 0
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        """Queue the record."""
+        if os.getpid() != self.pid:
+            self.target.handle(record)
+            return
+        # Formatted now, as the arguments may change before it is written
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _formatter.formatException(record.exc_info)
+        record.exc_info = None
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Wait until the queued records have been handled."""
+        if os.getpid() == self.pid:
+            self.queue.join()
+        self.target.flush()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            try:
+                self.target.handle(record)
+            except Exception:  # pragma: no cover
+                pass
+            finally:
+                self.queue.task_done()
+
+
+def configure(level='INFO', sample_rate=1.0, queue_size=10000,
+              stream=None):
+    """Set up the loggers of the webhooks and return their handler."""
+    target = logging.StreamHandler(stream or sys.stdout)
+    target.setFormatter(JSONFormatter())
+    if queue_size > 0:
+        handler = QueueHandler(target, queue_size)
+    else:
+        handler = target
+    handler.addFilter(SamplingFilter(sample_rate))
+    logger = logging.getLogger(ROOT)
+    for old in list(logger.handlers):
+        logger.removeHandler(old)
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+    return handler
+
+
+def flush_logs():
+    """Wait until the records of the webhooks have been written.
+
+    RQ work horses leave with os._exit, which drops the records still
+    queued for the thread of a QueueHandler, so jobs call this before they
+    end.
+    """
+    for handler in logging.getLogger(ROOT).handlers:
+        handler.flush()
+
+
+class Stages(object):
+
+    """Measures the duration of the stages of an analysis."""
+
+    def __init__(self):
+        """Init method."""
+        self.durations = {}
+        self.data = {}
+
+    @contextmanager
+    def __call__(self, name):
+        """Add the seconds spent in the with block to the stage."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.durations[name] = (self.durations.get(name, 0.0) +
+                                    time.time() - start)
+
+    def to_dict(self):
+        """Return the data and the durations in milliseconds."""
+        return dict(self.data, durations=dict(
+            (name, round(seconds * 1000, 3))
+            for name, seconds in self.durations.items()))
+
+
+handler = configure(settings.log_level, settings.log_sample_rate,
+                    settings.log_queue_size)
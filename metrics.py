@@ -0,0 +1,172 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Prometheus metrics shared by the web app and the workers.
+
+Counters and histograms are kept in a Redis hash, so the /metrics route of
+the app reports the totals of all the workers.
+
+This exports:
+    - Metrics: counters and histograms stored in Redis
+    - metrics: the Metrics of the webhooks
+
+"""
+import re
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from redis.exceptions import RedisError
+try:  # pragma: no cover
+    import settings
+except ImportError:  # pragma: no cover
+    import settings_testing as settings
+from connections import get_redis
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_LE = re.compile(r',?le="([^"]*)"')
+
+
+def _series(name, labels):
+    """Return the Prometheus series of a metric with labels."""
+    if not labels:
+        return name
+    return '%s{%s}' % (name, ','.join(
+        '%s="%s"' % (k, unicode(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in sorted(labels.items())))
+
+
+def _sort_key(series):
+    """Sort by labels, then buckets by upper bound, then sum and count."""
+    name, _, labels = series.partition('{')
+    le = _LE.search(labels)
+    if le is not None:
+        return (_LE.sub('', labels, count=1), 0, float(le.group(1)))
+    return (labels, 2 if name.endswith('_count') else 1, 0.0)
+
+
+class Metrics(object):
+
+    """Counters and histograms stored in a Redis hash."""
+
+    def __init__(self, redis=None, key='instantwild:metrics', buckets=BUCKETS):
+        """Init method."""
+        self.redis = redis
+        self.key = key
+        self.buckets = buckets
+        self.metrics = OrderedDict()
+        self.collectors = {}
+
+    @property
+    def enabled(self):
+        """Return True if the metrics are recorded."""
+        return self.redis is not None
+
+    def counter(self, name, help):
+        """Declare a counter."""
+        self.metrics[name] = ('counter', help)
+
+    def histogram(self, name, help):
+        """Declare a histogram."""
+        self.metrics[name] = ('histogram', help)
+
+    def gauge(self, name, help, collect):
+        """Declare a gauge of this process.
+
+        collect is called by render, and returns a list of (labels, value).
+        """
+        self.metrics[name] = ('gauge', help)
+        self.collectors[name] = collect
+
+    def inc(self, name, amount=1, **labels):
+        """Increment a counter."""
+        if not self.enabled:
+            return
+        try:
+            self.redis.hincrby(self.key, _series(name, labels), amount)
+        except RedisError:
+            pass
+
+    def observe(self, name, value, **labels):
+        """Add an observation to a histogram."""
+        if not self.enabled:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for le in self.buckets:
+            if value <= le:
+                pipe.hincrby(self.key, _series(name + '_bucket',
+                                               dict(labels, le=repr(le))), 1)
+        pipe.hincrby(self.key, _series(name + '_bucket',
+                                       dict(labels, le='+Inf')), 1)
+        pipe.hincrbyfloat(self.key, _series(name + '_sum', labels), value)
+        pipe.hincrby(self.key, _series(name + '_count', labels), 1)
+        try:
+            pipe.execute()
+        except RedisError:
+            pass
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the seconds spent in the with block."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def render(self):
+        """Return the metrics in the Prometheus text format."""
+        values = {}
+        if self.enabled:
+            try:
+                values = self.redis.hgetall(self.key)
+            except RedisError:
+                pass
+        series = {}
+        for field, value in values.items():
+            name = field.split('{')[0]
+            if name not in self.metrics:
+                name = name.rsplit('_', 1)[0]
+            series.setdefault(name, []).append((field, value))
+        for name, collect in self.collectors.items():
+            series[name] = [(_series(name, labels), value)
+                            for labels, value in collect()]
+        lines = []
+        for name, (kind, help) in self.metrics.items():
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for field, value in sorted(series.get(name, []),
+                                       key=lambda item: _sort_key(item[0])):
+                lines.append('%s %s' % (field, value))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        """Forget all the recorded values."""
+        if self.enabled:
+            self.redis.delete(self.key)
+
+
+metrics = Metrics(get_redis() if settings.metrics else None)
+metrics.counter('instantwild_analysis_total',
+                'Analyzed tasks by the decision taken.')
+metrics.histogram('instantwild_pybossa_request_seconds',
+                  'Duration of the requests to the PyBossa API by call.')
+metrics.histogram('instantwild_queue_wait_seconds',
+                  'Time the background jobs waited in their queue.')
+metrics.histogram('instantwild_job_seconds',
+                  'Duration of the background jobs by queue.')
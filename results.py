@@ -0,0 +1,134 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Buffered writes of the results of the analysis.
+
+Results are kept in memory and stored in PyBossa size at a time, and at
+least every interval seconds, using up to pool_size concurrent requests. A
+result updated again before it is stored is only written once. Failed writes
+are retried up to retries times, waiting a bit longer every time.
+
+This exports:
+    - ResultWriter: buffers the updates of the results
+
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from log import get_logger
+
+logger = get_logger('results')
+
+
+class ResultWriter(object):
+
+    """Buffers the updates of the results and writes them in batches."""
+
+    def __init__(self, write, size=100, interval=5, retries=3, pool_size=4,
+                 retry_delay=1):
+        """Init method.
+
+        write stores a result, returning a dict with the error on failure.
+        """
+        self.write = write
+        self.size = size
+        self.interval = interval
+        self.retries = retries
+        self.pool_size = pool_size
+        self.retry_delay = retry_delay
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+        self.written = 0
+        self.failed = 0
+        self.pid = None
+
+    def add(self, result):
+        """Queue the update of a result, flushing if the buffer is full."""
+        with self.lock:
+            self.pending.pop(result.id, None)
+            self.pending[result.id] = result
+            full = len(self.pending) >= self.size
+        self._start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Store the queued results, and return the number stored."""
+        with self.lock:
+            results = self.pending.values()
+            self.pending = OrderedDict()
+        if len(results) == 0:
+            return 0
+        if self.pool_size <= 1 or len(results) == 1:
+            stored = map(self._store, results)
+        else:
+            pool = ThreadPool(min(self.pool_size, len(results)))
+            try:
+                stored = pool.map(self._store, results)
+            finally:
+                pool.close()
+        n = sum(stored)
+        with self.lock:
+            self.written += n
+            self.failed += len(results) - n
+        return n
+
+    def stats(self):
+        """Return the number of queued, written and failed results."""
+        with self.lock:
+            return dict(queued=len(self.pending), written=self.written,
+                        failed=self.failed)
+
+    def _store(self, result):
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                res = self.write(result)
+                if not isinstance(res, dict):
+                    return True
+                error = res
+            except Exception as ex:
+                error = ex
+        logger.warning('Result not stored',
+                       extra=dict(data=dict(result_id=result.id,
+                                            error=unicode(error))))
+        return False
+
+    def _start(self):
+        # Forked processes (like the RQ work horses) need a thread of their own
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:  # pragma: no cover
+                logger.exception('Results not flushed')
@@ -6,7 +6,107 @@ endpoint = 'http://localhost:5001'
 enable_background_jobs = True
 # Queue name: use your own name in case you're using also python-rq
 queue_name = 'mywebhooks'
+# Redis server of the background jobs, tallies, caches and metrics. Every
+# process keeps up to redis_pool_size connections, and waits up to
+# redis_pool_timeout seconds for a free one. Timeouts are in seconds.
+redis_url = 'redis://localhost:6379/0'
+redis_pool_size = 50
+redis_pool_timeout = 5
+redis_socket_timeout = 5
+redis_connect_timeout = 2
+# Without background jobs, acknowledge the webhooks right away and analyze
+# them in a pool of worker_pool_size threads of the web app. Up to
+# worker_pool_queue_size events wait for a thread, and they are given
+# worker_pool_drain_timeout seconds to finish when the app stops.
+enable_worker_pool = False
+worker_pool_size = 4
+worker_pool_queue_size = 1000
+worker_pool_drain_timeout = 30
 # String for no animal
 no_animal = 'no animal'
 # String for no consensus
 no_consensus = 'no consensus'
+# Red list lookups cache: species kept in memory and seconds to live
+red_list_cache_size = 1000
+red_list_cache_ttl = 3600
+# Share the red list cache between workers using the local Redis server
+# (always done with enable_background_jobs)
+red_list_cache_redis = False
+# Species index: load all the helping material of a project once and look up
+# species by name instead of running a full text search for every consensus
+species_index = False
+species_index_page_size = 100
+# Minimum seconds between refreshes of the index when a species is not found
+species_index_refresh_interval = 60
+# Concurrent red list lookups of a consensus, and seconds to wait for all of
+# them before failing the job (keep it above http_timeout)
+red_list_pool_size = 1
+red_list_timeout = 40
+# Concurrent requests used to fetch and update the contributors of a task
+badges_pool_size = 1
+# Tasks of a batch analyzed at the same time by a worker
+analysis_pool_size = 1
+# Keep the badges in Redis and update the contributors in PyBossa every
+# contributor_flush_size badges, or contributor_flush_interval seconds later
+# in a badge stage job (needs rqworker --with-scheduler)
+contributor_write_behind = False
+contributor_flush_size = 10
+contributor_flush_interval = 60
+# Store the result first and award the badges in a later stage, a job that
+# waits badge_delay seconds (needs rqworker --with-scheduler) and updates
+# every contributor once for all the results stored meanwhile
+defer_badges = False
+badge_delay = 0
+# Store per status badge counters instead of a badge per result, and the
+# ids of the last badge_results_size awarded results to skip duplicates
+compact_badges = False
+badge_results_size = 1000
+# Keep the results in memory and store them result_buffer_size at a time (and
+# at least every result_buffer_interval seconds) with up to
+# result_write_pool_size concurrent requests, retrying failed writes
+# result_write_retries times. Batches and jobs store their results when done.
+result_buffer = False
+result_buffer_size = 100
+result_buffer_interval = 5
+result_write_pool_size = 1
+result_write_retries = 3
+# Record Prometheus metrics in Redis, reported by the /metrics route
+metrics = False
+# Level of the JSON logs, rate of the records below WARNING that are kept,
+# and records waiting to be written by the logging thread (0 writes them
+# right away)
+log_level = 'WARNING'
+log_sample_rate = 1.0
+log_queue_size = 0
+# HTTP connections kept alive to the PyBossa server, seconds before a request
+# times out and whether responses are gzipped
+http_pool_size = 10
+http_timeout = 30
+http_gzip = True
+# Use the same pooled connections for the enki/pbclient requests
+http_share_with_pbclient = True
+# Decide with plain counters instead of pandas DataFrames
+fast_analysis = False
+# Keep a running tally of every task in Redis so each webhook only fetches
+# the new task runs. Tallies expire after tally_ttl seconds.
+incremental_tally = False
+# Fetch the task runs of a task page by page, counting them as they arrive
+# instead of loading all of them (and their DataFrames) in memory
+stream_task_runs = False
+tally_ttl = 604800
+# Merge the webhooks of a task that already has a pending background job.
+# New jobs wait coalesce_window seconds (needs rqworker --with-scheduler) and
+# the pending mark expires coalesce_ttl seconds later in case a job is lost.
+coalesce_webhooks = False
+coalesce_window = 0
+coalesce_ttl = 600
+# Send the background jobs of tasks that can reach a final decision (their
+# tally has priority_task_runs task runs or more) to the queue_name-high
+# queue, and those of tasks reopened with fewer task runs to queue_name-low.
+# Needs incremental_tally.
+priority_queues = False
+priority_task_runs = 9
+# Projects looked up by every worker process are kept for project_cache_ttl
+# seconds (0 disables the cache)
+project_cache_size = 100
+project_cache_ttl = 0
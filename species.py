@@ -0,0 +1,95 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Species index built from the project helping material.
+
+This exports:
+    - SpeciesIndex: in-memory index of scientific names to red list status
+
+"""
+import time
+from cache import normalize_name
+from client import session
+
+
+class SpeciesIndex(object):
+
+    """In-memory index of the helping material of a project."""
+
+    def __init__(self, project_id, endpoint, page_size=100,
+                 refresh_interval=60):
+        """Init method."""
+        self.project_id = project_id
+        self.endpoint = endpoint
+        self.page_size = page_size
+        self.refresh_interval = refresh_interval
+        self.watermark = 0
+        self.refreshed_at = 0
+        self.species = {}
+
+    def __len__(self):
+        """Return the number of indexed species."""
+        return len(self.species)
+
+    def load(self):
+        """Load all the helping material of the project from scratch."""
+        self.watermark = 0
+        self.species = {}
+        return self.refresh(force=True)
+
+    def refresh(self, force=False):
+        """Fetch the helping material created after the watermark.
+
+        Returns the number of fetched items. Unless forced, the server is
+        asked at most once every refresh_interval seconds.
+        """
+        now = time.time()
+        if not force and now - self.refreshed_at < self.refresh_interval:
+            return 0
+        self.refreshed_at = now
+        fetched = 0
+        while True:
+            page = self._get_page(self.watermark)
+            for hp in page:
+                self.add(hp)
+            fetched += len(page)
+            if len(page) < self.page_size:
+                return fetched
+
+    def add(self, hp):
+        """Index a helping material item."""
+        info = hp.get('info') or {}
+        name = info.get('scientific_name')
+        if name and 'iucn_red_list_status' in info:
+            self.species[normalize_name(name)] = (info['iucn_red_list_status'],
+                                                  info.get('species'))
+        self.watermark = max(self.watermark, hp['id'])
+
+    def lookup(self, scientific_name):
+        """Return (iucn_red_list_status, species) or None."""
+        return self.species.get(normalize_name(scientific_name))
+
+    def _get_page(self, last_id):
+        params = dict(project_id=self.project_id, limit=self.page_size)
+        if last_id:
+            params['last_id'] = last_id
+        res = session.get(self.endpoint + '/api/helpingmaterial',
+                          params=params)
+        if res.status_code != 200:
+            return []
+        return res.json()
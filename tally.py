@@ -0,0 +1,170 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Running tally of the answers of a task.
+
+The tally keeps plain counters instead of a pandas DataFrame, and takes the
+same decisions as analysis.get_count_nan and analysis.get_consensus.
+
+This exports:
+    - Tally: counters of the answers given to a task
+    - TallyStore: keeps the tally of every task in Redis
+
+"""
+import json
+import math
+
+NAN = float('nan')
+
+
+def _missing(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+class Tally(object):
+
+    """Counters of the answers given to a task."""
+
+    def __init__(self):
+        """Init method."""
+        self.task_runs = 0
+        self.last_task_run_id = 0
+        self.no_animal = 0
+        # speciesScientificName: [answers, counted, sum, sum of squares,
+        #                         min, max] of the animalCount
+        self.species = {}
+        # [user_id, answer] of the task runs of registered users
+        self.contributions = []
+
+    def add_task_run(self, tr):
+        """Count the answers of a task run."""
+        self.task_runs += 1
+        self.last_task_run_id = max(self.last_task_run_id, tr.id)
+        for datum in tr.info['answer']:
+            self.add_answer(datum)
+        if tr.user_id:
+            answer = [dict(speciesScientificName=datum.get('speciesScientificName'),
+                           animalCount=datum.get('animalCount'))
+                      for datum in tr.info['answer']]
+            self.contributions.append([tr.user_id, answer])
+
+    def add_answer(self, datum):
+        """Count an answer."""
+        name = datum.get('speciesScientificName')
+        if _missing(name):
+            self.no_animal += 1
+            return
+        stats = self.species.get(name)
+        if stats is None:
+            stats = self.species[name] = [0, 0, 0.0, 0.0, None, None]
+        stats[0] += 1
+        count = datum.get('animalCount')
+        if not _missing(count):
+            count = float(count)
+            stats[1] += 1
+            stats[2] += count
+            stats[3] += count * count
+            stats[4] = count if stats[4] is None else min(stats[4], count)
+            stats[5] = count if stats[5] is None else max(stats[5], count)
+
+    def top(self):
+        """Return (no_animal, count) for the most common answer.
+
+        no_animal is True when the most common answer is that there is no
+        animal in the picture. On a tie with a species the species wins, like
+        in analysis.get_no_animal.
+        """
+        species = max([stats[0] for stats in self.species.values()] + [0])
+        return self.no_animal > species, max(species, self.no_animal)
+
+    def consensus(self, th=10):
+        """Return the species chosen by at least th answers."""
+        answer = []
+        for sp in sorted(self.species):
+            size, n, total, squares, low, high = self.species[sp]
+            if size < th:
+                continue
+            mean = total / n if n else NAN
+            if n > 1:
+                std = math.sqrt(max(squares - total * mean, 0.0) / (n - 1))
+            else:
+                std = NAN
+            answer.append(dict(speciesScientificName=sp,
+                               animalCount=mean,
+                               animalCountStd=std,
+                               animalCountMin=NAN if low is None else low,
+                               animalCountMax=NAN if high is None else high))
+        return answer
+
+    def to_dict(self):
+        """Return the tally as a dict."""
+        return dict(task_runs=self.task_runs,
+                    last_task_run_id=self.last_task_run_id,
+                    no_animal=self.no_animal, species=self.species,
+                    contributions=self.contributions)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Return the tally stored in data."""
+        tally = cls()
+        tally.task_runs = data['task_runs']
+        tally.last_task_run_id = data['last_task_run_id']
+        tally.no_animal = data['no_animal']
+        tally.species = data['species']
+        tally.contributions = data['contributions']
+        return tally
+
+
+class TallyStore(object):
+
+    """Keeps the tally of every task in Redis."""
+
+    def __init__(self, redis, ttl=7 * 24 * 3600, prefix='instantwild:tally:'):
+        """Init method."""
+        self.redis = redis
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def key(self, project_id, task_id):
+        """Return the Redis key of the tally of a task."""
+        return '%s%s:%s' % (self.prefix, project_id, task_id)
+
+    def load(self, project_id, task_id):
+        """Return the stored tally of a task or an empty one."""
+        data = self.redis.get(self.key(project_id, task_id))
+        if data is None:
+            return Tally()
+        return Tally.from_dict(json.loads(data))
+
+    def save(self, project_id, task_id, tally):
+        """Store the tally of a task."""
+        key = self.key(project_id, task_id)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.setex(key, self.ttl, json.dumps(tally.to_dict()))
+        pipe.setex(key + ':count', self.ttl, tally.task_runs)
+        pipe.execute()
+
+    def count(self, project_id, task_id):
+        """Return the number of task runs in the tally of a task, or None."""
+        count = self.redis.get(self.key(project_id, task_id) + ':count')
+        return None if count is None else int(count)
+
+    def delete(self, project_id, task_id):
+        """Forget the tally of a task."""
+        key = self.key(project_id, task_id)
+        self.redis.delete(key, key + ':count')
@@ -20,6 +20,8 @@ Base package for testing PyBossa application.
 
 This exports:
     - Test a generic class for setting up database and fixtures
+    - FakeRedis a minimal in-memory stand-in for a Redis connection
+    - FakePipeline a stand-in for the pipelines of FakeRedis
 
 """
 from app import app
@@ -47,3 +49,122 @@ class Test(object):
         self.app = app
         self.app.config['TESTING'] = True
         self.tc = self.app.test_client()
+
+
+class FakeRedis(object):
+
+    """Minimal in-memory stand-in for a Redis connection."""
+
+    def __init__(self):
+        """Init method."""
+        self.data = {}
+
+    def get(self, key):
+        """Return the value of key."""
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        """Set the value of key, ignoring the expiration."""
+        if nx and key in self.data:
+            return None
+        self.data[key] = str(value)
+        return True
+
+    def incr(self, key, amount=1):
+        """Increment the value of key."""
+        value = int(self.data.get(key, 0)) + amount
+        self.data[key] = str(value)
+        return value
+
+    def setex(self, key, time, value):
+        """Set the value of key, ignoring the expiration."""
+        return self.set(key, value)
+
+    def delete(self, *keys):
+        """Delete keys."""
+        return len([self.data.pop(key) for key in keys if key in self.data])
+
+    def rpush(self, key, *values):
+        """Append values to the list at key."""
+        items = self.data.setdefault(key, [])
+        items.extend(str(value) for value in values)
+        return len(items)
+
+    def lrange(self, key, start, end):
+        """Return the items of the list at key from start to end."""
+        items = self.data.get(key, [])
+        return items[start:None if end == -1 else end + 1]
+
+    def ltrim(self, key, start, end):
+        """Keep the items of the list at key from start to end."""
+        items = self.lrange(key, start, end)
+        if items:
+            self.data[key] = items
+        else:
+            self.data.pop(key, None)
+        return True
+
+    def llen(self, key):
+        """Return the length of the list at key."""
+        return len(self.data.get(key, []))
+
+    def sadd(self, key, *values):
+        """Add values to the set at key."""
+        items = self.data.setdefault(key, set())
+        added = set(str(value) for value in values) - items
+        items.update(added)
+        return len(added)
+
+    def srem(self, key, *values):
+        """Remove values from the set at key."""
+        items = self.data.get(key, set())
+        removed = set(str(value) for value in values) & items
+        items.difference_update(removed)
+        return len(removed)
+
+    def smembers(self, key):
+        """Return the members of the set at key."""
+        return set(self.data.get(key, set()))
+
+    def hincrby(self, key, field, amount=1):
+        """Increment the value of a field of the hash at key."""
+        items = self.data.setdefault(key, {})
+        items[field] = str(int(items.get(field, 0)) + amount)
+        return int(items[field])
+
+    def hincrbyfloat(self, key, field, amount=1.0):
+        """Increment the float value of a field of the hash at key."""
+        items = self.data.setdefault(key, {})
+        items[field] = repr(float(items.get(field, 0)) + amount)
+        return float(items[field])
+
+    def hgetall(self, key):
+        """Return the fields of the hash at key."""
+        return dict(self.data.get(key, {}))
+
+    def pipeline(self, transaction=True):
+        """Return a pipeline."""
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+
+    """Queues the commands of a FakeRedis until executed."""
+
+    def __init__(self, redis):
+        """Init method."""
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        """Run the queued commands."""
+        commands, self.commands = self.commands, []
+        return [method(*args, **kwargs) for method, args, kwargs in commands]
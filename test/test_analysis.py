@@ -27,9 +27,20 @@ try:
 except ImportError:  # pragma: no cover
     import settings_testing as settings
 import json
+import multiprocessing
+import random
+import threading
+import time
+from datetime import timedelta
 import enki
-from base import Test
-from analysis import basic, get_task
+import numpy as np
+import pandas as pd
+from base import Test, FakeRedis
+from metrics import Metrics
+from tally import Tally, TallyStore
+import analysis
+from analysis import basic, get_task, get_red_list_status, give_badges
+from analysis import get_consensus
 from mock import patch, Mock, MagicMock, call
 import mock
 
@@ -38,6 +49,14 @@ class TestApp(Test):
 
     """Class for Testing the PyBossa application."""
 
+    def setUp(self):
+        """Setup method for configuring the tests."""
+        super(TestApp, self).setUp()
+        # Background jobs keep the red list cache in Redis
+        analysis.red_list_cache.redis = FakeRedis()
+        analysis.red_list_cache.clear()
+        analysis.species_indexes.clear()
+
     def _mock_response(
                 self,
                 status=200,
@@ -124,7 +143,8 @@ class TestApp(Test):
             enki_mock.tasks = []
             res = basic(**self.payload)
             assert enki_mock.get_tasks.called
-            assert enki_mock.get_task_runs.called
+            # There are no task runs to fetch for a missing task
+            assert not enki_mock.get_task_runs.called
             assert res == 'OK', res
 
     @patch('enki.pbclient', autospec=True)
@@ -362,7 +382,7 @@ class TestApp(Test):
         #assert res == "No consensus. Asking for one more answer.", res
         assert res.n_answers == 13
 
-    @patch('analysis.requests', autospec=True)
+    @patch('analysis.session', autospec=True)
     @patch('enki.pbclient', autospec=True)
     @patch('enki.Enki', autospec=True)
     def test_basic_10_animal(self, enki_mock, pbclient, requests_mock):
@@ -479,7 +499,7 @@ class TestApp(Test):
         assert task.n_answers == 25, task.n_answers
         assert task.state == 'completed', task.state
 
-    @patch('analysis.requests', autospec=True)
+    @patch('analysis.session', autospec=True)
     @patch('enki.pbclient', autospec=True)
     @patch('enki.Enki', autospec=True)
     def test_basic_10_animal_consensus(self, enki_mock, pbclient,
@@ -574,7 +594,7 @@ class TestApp(Test):
 
         requests_mock.put.assert_has_calls(calls)
 
-    @patch('analysis.requests', autospec=True)
+    @patch('analysis.session', autospec=True)
     @patch('enki.pbclient', autospec=True)
     @patch('enki.Enki', autospec=True)
     def test_basic_10_animal_consensus_karma(self, enki_mock, pbclient,
@@ -663,7 +683,7 @@ class TestApp(Test):
 
         requests_mock.put.assert_has_calls(calls)
 
-    @patch('analysis.requests', autospec=True)
+    @patch('analysis.session', autospec=True)
     @patch('enki.pbclient', autospec=True)
     @patch('enki.Enki', autospec=True)
     def test_basic_10_animal_consensus_karma_min(self, enki_mock, pbclient,
@@ -750,7 +770,7 @@ class TestApp(Test):
 
         requests_mock.put.assert_has_calls(calls)
 
-    @patch('analysis.requests', autospec=True)
+    @patch('analysis.session', autospec=True)
     @patch('enki.pbclient', autospec=True)
     @patch('enki.Enki', autospec=True)
     def test_basic_10_animal_consensus_two_badges_work(self, enki_mock, pbclient,
@@ -856,7 +876,7 @@ class TestApp(Test):
         requests_mock.put.assert_has_calls(calls)
 
 
-    @patch('analysis.requests', autospec=True)
+    @patch('analysis.session', autospec=True)
     @patch('enki.pbclient', autospec=True)
     @patch('enki.Enki', autospec=True)
     def test_basic_10_animal_consensus_badges_work(self, enki_mock, pbclient,
@@ -943,7 +963,7 @@ class TestApp(Test):
 
         requests_mock.put.assert_has_calls(calls)
 
-    @patch('analysis.requests', autospec=True)
+    @patch('analysis.session', autospec=True)
     @patch('enki.pbclient', autospec=True)
     @patch('enki.Enki', autospec=True)
     def test_basic_10_animal_consensus_badges_duplicates(self, enki_mock, pbclient,
@@ -1033,7 +1053,7 @@ class TestApp(Test):
 
         requests_mock.put.assert_has_calls(calls)
 
-    @patch('analysis.requests', autospec=True)
+    @patch('analysis.session', autospec=True)
     @patch('enki.pbclient', autospec=True)
     @patch('enki.Enki', autospec=True)
     def test_basic_10_animal_consensus_badges_two_badges(self, enki_mock, pbclient,
@@ -1127,7 +1147,7 @@ class TestApp(Test):
 
         requests_mock.put.assert_has_calls(calls)
 
-    @patch('analysis.requests', autospec=True)
+    @patch('analysis.session', autospec=True)
     @patch('enki.pbclient', autospec=True)
     @patch('enki.Enki', autospec=True)
     def test_basic_10_animal_consensus_badges_two_badges_user_no_info(self, enki_mock, pbclient,
@@ -1229,3 +1249,1068 @@ class TestApp(Test):
         pbclient.find_tasks.return_value = []
         res = get_task(1, 1)
         assert len(res) == 0
+
+    @patch('analysis.session', autospec=True)
+    def test_get_red_list_status_cached(self, requests_mock):
+        """Test get_red_list_status only asks PyBossa once per species."""
+        info = [dict(info=dict(iucn_red_list_status='Endangered',
+                               species='common'))]
+        requests_mock.get.return_value = self._mock_response(json_data=info,
+                                                             status=200)
+        res = get_red_list_status('Loxodonta africana', 1)
+        assert res == ('Endangered', 'common'), res
+        res = get_red_list_status(' loxodonta  Africana', 1)
+        assert res == ('Endangered', 'common'), res
+        assert requests_mock.get.call_count == 1, requests_mock.get.mock_calls
+        assert analysis.red_list_cache.hits == 1
+        assert analysis.red_list_cache.misses == 1
+        # Work horses find the lookups of previous jobs in Redis
+        analysis.red_list_cache.clear()
+        res = get_red_list_status('Loxodonta africana', 1)
+        assert res == ('Endangered', 'common'), res
+        assert analysis.red_list_cache.redis_hits == 1
+        assert requests_mock.get.call_count == 1, requests_mock.get.mock_calls
+        # Other projects have their own helping material
+        get_red_list_status('Loxodonta africana', 2)
+        assert requests_mock.get.call_count == 2, requests_mock.get.mock_calls
+
+    @patch('analysis.session', autospec=True)
+    def test_get_red_list_status_not_found(self, requests_mock):
+        """Test get_red_list_status does not cache unknown species."""
+        mock_response = self._mock_response(status=200)
+        mock_response.json.return_value = []
+        requests_mock.get.return_value = mock_response
+        res = get_red_list_status('unknown', 1)
+        assert res == (None, None), res
+        get_red_list_status('unknown', 1)
+        assert requests_mock.get.call_count == 2, requests_mock.get.mock_calls
+
+    @patch('settings.species_index', True)
+    @patch('species.session', autospec=True)
+    @patch('analysis.session', autospec=True)
+    def test_get_red_list_status_species_index(self, requests_mock,
+                                               species_requests_mock):
+        """Test get_red_list_status uses the species index."""
+        hp = [dict(id=1, info=dict(scientific_name='Lore',
+                                   iucn_red_list_status='Endangered',
+                                   species='common'))]
+        species_requests_mock.get.return_value = self._mock_response(
+            json_data=hp, status=200)
+        res = get_red_list_status('lore', 1)
+        assert res == ('Endangered', 'common'), res
+        analysis.red_list_cache.clear()
+        res = get_red_list_status('lore', 1)
+        assert res == ('Endangered', 'common'), res
+        assert species_requests_mock.get.call_count == 1
+        assert not requests_mock.get.called
+
+    @patch('settings.species_index', True)
+    @patch('species.session', autospec=True)
+    @patch('analysis.session', autospec=True)
+    def test_get_red_list_status_species_index_miss(self, requests_mock,
+                                                    species_requests_mock):
+        """Test get_red_list_status falls back to the full text search."""
+        mock_response = self._mock_response(status=200)
+        mock_response.json.return_value = []
+        species_requests_mock.get.return_value = mock_response
+        info = [dict(info=dict(iucn_red_list_status='Endangered',
+                               species='common'))]
+        requests_mock.get.return_value = self._mock_response(json_data=info,
+                                                             status=200)
+        res = get_red_list_status('lore', 1)
+        assert res == ('Endangered', 'common'), res
+        assert requests_mock.get.call_count == 1
+
+    @patch('settings.species_index_refresh_interval', 0)
+    @patch('settings.species_index', True)
+    @patch('species.session', autospec=True)
+    def test_warm_project(self, requests_mock):
+        """Test warm_project loads and then refreshes the species index."""
+        hp = [dict(id=1, info=dict(scientific_name='Lore',
+                                   iucn_red_list_status='Endangered',
+                                   species='common'))]
+        requests_mock.get.return_value = self._mock_response(json_data=hp,
+                                                             status=200)
+        analysis.warm_project(1, 'project')
+        index = analysis.species_indexes[1]
+        assert index.lookup('lore') == ('Endangered', 'common')
+        analysis.warm_project(1, 'project')
+        assert analysis.species_indexes[1] is index
+        assert requests_mock.get.call_count == 2
+        params = requests_mock.get.call_args[1]['params']
+        assert params['last_id'] == 1, params
+        requests_mock.get.side_effect = IOError('down')
+        with patch('analysis.logger', new_callable=Mock) as logger:
+            analysis.warm_project(1, 'project')
+        assert logger.exception.called
+
+    @patch('analysis.session', autospec=True)
+    @patch('pbclient.find_project')
+    def test_warm_project_enki(self, find_project, session):
+        """Test warm_project caches the project of the jobs."""
+        project = MagicMock()
+        project.id = 1
+        find_project.return_value = [project]
+        cache = analysis.LRUCache(10, 60)
+        with patch('analysis.enki_cache', cache):
+            analysis.warm_project(1, 'project')
+            analysis.warm_project(1, 'project')
+            assert find_project.call_count == 1
+            e = analysis.get_enki('project')
+            assert find_project.call_count == 1
+            assert e.project is project
+        assert session.close.call_count == 2
+
+    @patch('settings.badges_pool_size', 4)
+    @patch('analysis.session', autospec=True)
+    def test_give_badges_concurrent(self, requests_mock):
+        """Test give_badges fetches and updates each contributor once."""
+        users = {1: dict(info=dict(karma=2)), 2: dict(info=dict(karma=2)),
+                 3: dict(info=dict())}
+
+        def get(url):
+            user_id = int(url.split('/api/user/')[1].split('?')[0])
+            return self._mock_response(json_data=users[user_id], status=200)
+
+        requests_mock.get.side_effect = get
+        e = MagicMock()
+        t = MagicMock()
+        t.id = 1
+        e.task_runs = {1: [self.create_task_runs_animal(user_id=1),
+                           self.create_task_runs_animal(user_id=None),
+                           self.create_task_runs_animal_wrong(),
+                           self.create_task_runs_no_animal(),
+                           self.create_task_runs_animal(user_id=3)]}
+        result = MagicMock()
+        result.id = 1
+        answers = [dict(speciesScientificName='lore',
+                        iucn_red_list_status='Endangered')]
+        give_badges(e, t, answers, result)
+
+        assert requests_mock.get.call_count == 3, requests_mock.get.mock_calls
+        assert requests_mock.put.call_count == 3, requests_mock.put.mock_calls
+        puts = dict((c[1][0], json.loads(c[2]['data']))
+                    for c in requests_mock.put.mock_calls)
+        user_url = settings.endpoint + '/api/user/%s?api_key=%s'
+        badge = dict(iucn_red_list_status='Endangered', result_id=1, number=1)
+        assert puts[user_url % (1, settings.api_key)]['info'] == dict(
+            karma=3, iucn_number=1, species_number=1, badges=[badge])
+        assert puts[user_url % (2, settings.api_key)]['info'] == dict(
+            karma=1, iucn_number=0, species_number=0, badges=[])
+        # User 3 answered wrong first and right afterwards
+        assert puts[user_url % (3, settings.api_key)]['info'] == dict(
+            karma=1, iucn_number=1, species_number=1, badges=[badge])
+
+    def test_get_consensus(self):
+        """Test get_consensus matches the describe() of every species."""
+        rnd = random.Random(1)
+        data = []
+        for i in range(500):
+            if rnd.random() < 0.2:
+                data.append(dict(animalCount=-1))
+            else:
+                sp = 'species %s' % rnd.randint(0, 40)
+                data.append(dict(speciesScientificName=sp,
+                                 animalCount=float(rnd.randint(1, 9)),
+                                 speciesID=sp))
+        data.append(dict(speciesScientificName='single', animalCount=1.0))
+        df = pd.DataFrame(data)
+        for th in [1, 10, 20]:
+            answers = get_consensus(df, th=th)
+            sizes = df['speciesScientificName'].value_counts()
+            expected = sorted(sizes[sizes >= th].index)
+            assert [a['speciesScientificName'] for a in answers] == expected
+            for a in answers:
+                describe = df.loc[df['speciesScientificName'] ==
+                                  a['speciesScientificName'],
+                                  'animalCount'].describe()
+                assert np.allclose([a['animalCount'], a['animalCountStd'],
+                                    a['animalCountMin'], a['animalCountMax']],
+                                   [describe['mean'], describe['std'],
+                                    describe['min'], describe['max']],
+                                   equal_nan=True), (a, describe)
+
+    def test_get_consensus_integers(self):
+        """Test get_consensus stores integer counts like describe()."""
+        data = [dict(speciesScientificName='lore', animalCount=i % 3 + 1)
+                for i in range(10)]
+        data.append(dict(speciesScientificName='ipsum', animalCount=2))
+        df = pd.DataFrame(data)
+        assert df['animalCount'].dtype == np.int64
+        answers = get_consensus(df, th=1)
+        for a in answers:
+            describe = df.loc[df['speciesScientificName'] ==
+                              a['speciesScientificName'],
+                              'animalCount'].describe()
+            expected = dict(speciesScientificName=a['speciesScientificName'],
+                            animalCount=describe['mean'],
+                            animalCountStd=describe['std'],
+                            animalCountMin=describe['min'],
+                            animalCountMax=describe['max'])
+            assert (json.dumps(a, sort_keys=True) ==
+                    json.dumps(expected, sort_keys=True)), (a, expected)
+
+
+    @patch('settings.incremental_tally', True)
+    @patch('enki.pbclient', autospec=True)
+    @patch('enki.Enki', autospec=True)
+    def test_basic_incremental_tally(self, enki_mock, pbclient):
+        """Test basic only fetches the new task runs of the task."""
+        enki_mock = enki.Enki(endpoint='server',
+                              api_key='api',
+                              project_short_name='project')
+        task = MagicMock()
+        task.id = 1
+        task.project_id = 1
+        task.n_answers = 5
+        task.state = 'completed'
+        pbclient.find_tasks.return_value = [task]
+        pbclient.update_task.side_effect = lambda t: t
+        enki_mock.pbclient = pbclient
+        enki_mock.tasks = [task]
+        task_runs = []
+        for i in range(4):
+            task_runs.append(self.create_task_runs_no_animal())
+        task_runs.append(self.create_task_runs_animal())
+        task_runs.append(self.create_task_runs_animal())
+        for i, tr in enumerate(task_runs):
+            tr.id = i + 1
+
+        with patch('analysis.tally_store', TallyStore(FakeRedis())):
+            pbclient.find_taskruns.side_effect = [task_runs[:5], []]
+            res = basic(**self.payload)
+            assert res.n_answers == 6, res.n_answers
+            calls = [call(1, task_id=1, limit=100, offset=0, all=1),
+                     call(1, task_id=1, last_id=5, limit=100, all=1)]
+            assert pbclient.find_taskruns.mock_calls == calls, pbclient.find_taskruns.mock_calls
+            assert not enki_mock.get_task_runs.called
+
+            pbclient.find_taskruns.reset_mock()
+            pbclient.find_taskruns.side_effect = [task_runs[5:], []]
+            res = basic(**self.payload)
+            assert res.n_answers == 7, res.n_answers
+            calls = [call(1, task_id=1, last_id=5, limit=100, all=1),
+                     call(1, task_id=1, last_id=6, limit=100, all=1)]
+            assert pbclient.find_taskruns.mock_calls == calls, pbclient.find_taskruns.mock_calls
+            assert analysis.tally_store.load(1, 1).task_runs == 6
+
+    @patch('settings.incremental_tally', True)
+    @patch('analysis.session', autospec=True)
+    @patch('enki.pbclient', autospec=True)
+    @patch('enki.Enki', autospec=True)
+    def test_basic_incremental_tally_badges(self, enki_mock, pbclient,
+                                            requests_mock):
+        """Test badges are given to the contributors kept in the tally."""
+        info = [dict(info=dict(iucn_red_list_status='Endangered',
+                               species='common'))]
+        mock_response = self._mock_response(json_data=info, status=200)
+        mock_response_2 = self._mock_response(json_data=dict(info=dict()),
+                                              status=200)
+        mock_response_3 = self._mock_response(json_data=dict(info=dict()),
+                                              status=200)
+        requests_mock.get.side_effect = [mock_response, mock_response_2,
+                                         mock_response_3]
+        enki_mock = enki.Enki(endpoint='server',
+                              api_key='api',
+                              project_short_name='project')
+        enki_mock.pbclient = pbclient
+        result = MagicMock()
+        result.id = 1
+        result.info = dict()
+        pbclient.find_results.return_value = [result]
+        task = MagicMock()
+        task.id = 1
+        task.project_id = 1
+        task.n_answers = 11
+        task.info = dict()
+        enki_mock.tasks = [task]
+        task_runs = []
+        for i in range(10):
+            task_runs.append(self.create_task_runs_animal(user_id=(1 if i == 1
+                                                                   else None)))
+        task_runs.append(self.create_task_runs_animal_wrong())
+        for i, tr in enumerate(task_runs):
+            tr.id = i + 1
+        store = TallyStore(FakeRedis())
+        tally = Tally()
+        for tr in task_runs[:10]:
+            tally.add_task_run(tr)
+        store.save(1, 1, tally)
+
+        with patch('analysis.tally_store', store):
+            pbclient.find_taskruns.side_effect = [task_runs[10:], []]
+            res = basic(**self.payload)
+        assert res == 'OK', res
+        assert result.info['animalCount'] == 1.0, result.info
+        user_url = settings.endpoint + '/api/user/%s?api_key=%s'
+        badge = dict(iucn_red_list_status='Endangered', result_id=1, number=1)
+        calls = [call(user_url % (1, settings.api_key),
+                      data=json.dumps(dict(info=dict(species_number=1,
+                                                     iucn_number=1, karma=1,
+                                                     badges=[badge]))),
+                      headers={'content-type': 'application/json'}),
+                 call(user_url % (2, settings.api_key),
+                      data=json.dumps(dict(info=dict(species_number=0,
+                                                     iucn_number=0, karma=0,
+                                                     badges=[]))),
+                      headers={'content-type': 'application/json'})]
+        requests_mock.put.assert_has_calls(calls)
+
+
+    @patch('analysis.analyze_task')
+    @patch('enki.pbclient', autospec=True)
+    @patch('enki.Enki', autospec=True)
+    def test_basic_batch(self, enki_mock, pbclient, analyze_task):
+        """Test basic_batch groups the events by project."""
+        tasks = {}
+        for i in [1, 2, 3]:
+            tasks[i] = MagicMock()
+            tasks[i].id = i
+        pbclient.find_tasks.side_effect = lambda **kw: ([tasks[kw['id']]]
+                                                        if kw['id'] in tasks
+                                                        else [])
+        analyze_task.side_effect = [None, 'OK', Exception('boom')]
+        e = enki_mock.return_value
+        e.project = MagicMock()
+        e.project.id = 1
+        events = [self.payload, dict(self.payload, task_id=2),
+                  dict(self.payload, project_short_name='other', task_id=3),
+                  dict(self.payload, task_id=4),
+                  dict(self.payload)]
+        statuses = analysis.basic_batch(events)
+        assert statuses == [dict(task_id=1, status='ok'),
+                            dict(task_id=2, status='ok'),
+                            dict(task_id=3, status='failed', error='boom'),
+                            dict(task_id=4, status='skipped'),
+                            dict(task_id=1, status='skipped')], statuses
+        assert enki_mock.call_count == 2, enki_mock.mock_calls
+        assert e.get_task_runs.call_count == 2
+        assert pbclient.find_tasks.call_count == 4
+        pbclient.find_tasks.assert_any_call(project_id=1, id=1, limit=1,
+                                            offset=0, all=1)
+        assert analyze_task.call_count == 3
+
+    @patch('enki.Enki', autospec=True)
+    def test_basic_batch_project_not_found(self, enki_mock):
+        """Test basic_batch reports the events of unknown projects."""
+        enki_mock.side_effect = Exception('not found')
+        statuses = analysis.basic_batch([self.payload])
+        assert statuses == [dict(task_id=1, status='failed',
+                                 error='not found')], statuses
+
+    @patch('analysis.analyze_task')
+    @patch('enki.pbclient', autospec=True)
+    @patch('enki.Enki', autospec=True)
+    def test_basic_batch_task_error(self, enki_mock, pbclient, analyze_task):
+        """Test basic_batch fails the project of a task that errored."""
+        task = MagicMock()
+        task.id = 1
+        error = dict(status='failed', status_code=500)
+        pbclient.find_tasks.side_effect = lambda **kw: ([task]
+                                                        if kw['id'] == 1
+                                                        else error)
+        e = enki_mock.return_value
+        e.project = MagicMock()
+        e.project.id = 1
+        events = [self.payload, dict(self.payload, task_id=2),
+                  dict(self.payload, project_short_name='other', task_id=1)]
+        with patch('settings.incremental_tally', True):
+            statuses = analysis.basic_batch(events)
+        assert statuses[2] == dict(task_id=1, status='ok'), statuses
+        for status in statuses[:2]:
+            assert status['status'] == 'failed', statuses
+            assert 'status_code' in status['error'], statuses
+        assert analyze_task.call_count == 1
+
+
+    @patch('pbclient.find_project')
+    def test_get_enki_cached(self, find_project):
+        """Test get_enki only looks up the project once."""
+        project = MagicMock()
+        project.id = 1
+        find_project.return_value = [project]
+        cache = analysis.LRUCache(10, 60)
+        with patch('analysis.enki_cache', cache):
+            e = analysis.get_enki('project')
+            e2 = analysis.get_enki('project')
+            assert find_project.call_count == 1
+            assert e is not e2
+            assert e.project is e2.project is project
+            e.tasks = [1]
+            assert not hasattr(e2, 'tasks')
+            analysis.get_enki('other')
+            assert find_project.call_count == 2
+            analysis.invalidate_project('project')
+            analysis.get_enki('project')
+            assert find_project.call_count == 3
+            analysis.invalidate_project()
+            analysis.get_enki('other')
+            assert find_project.call_count == 4
+
+
+    @patch('settings.analysis_pool_size', 4)
+    @patch('analysis.analyze_task')
+    @patch('enki.pbclient', autospec=True)
+    @patch('enki.Enki', autospec=True)
+    def test_basic_batch_concurrent(self, enki_mock, pbclient, analyze_task):
+        """Test basic_batch analyzes the tasks of a batch concurrently."""
+        tasks = {}
+        for i in range(1, 9):
+            tasks[i] = MagicMock()
+            tasks[i].id = i
+        pbclient.find_tasks.side_effect = lambda **kw: [tasks[kw['id']]]
+        lock = threading.Lock()
+        in_flight = [0, 0]
+        analyzed = []
+
+        def analyze(e, t, **kwargs):
+            with lock:
+                analyzed.append(t.id)
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            time.sleep(0.05)
+            with lock:
+                in_flight[0] -= 1
+            if t.id == 5:
+                raise Exception('boom')
+
+        analyze_task.side_effect = analyze
+        e = enki_mock.return_value
+        e.project = MagicMock()
+        e.project.id = 1
+        events = [dict(self.payload, task_id=i) for i in range(1, 9)]
+        statuses = analysis.basic_batch(events)
+        expected = [dict(task_id=i, status='ok') for i in range(1, 9)]
+        expected[4] = dict(task_id=5, status='failed', error='boom')
+        assert statuses == expected, statuses
+        # The mock does not count the calls of several threads reliably
+        assert sorted(analyzed) == range(1, 9), analyzed
+        assert 1 < in_flight[1] <= 4, in_flight
+
+
+    @patch('settings.red_list_pool_size', 4)
+    @patch('settings.red_list_timeout', 0.5)
+    @patch('analysis.get_red_list_status')
+    def test_get_red_list_statuses(self, get_red_list_status):
+        """Test get_red_list_statuses looks up each species once."""
+        def lookup(name, project_id):
+            if name == 'slow':
+                time.sleep(2)
+            return (name.upper(), project_id)
+
+        get_red_list_status.side_effect = lookup
+        res = analysis.get_red_list_statuses(['a', 'b', 'a'], 1)
+        assert res == dict(a=('A', 1), b=('B', 1)), res
+        assert get_red_list_status.call_count == 2
+        with patch('settings.red_list_pool_size', 1):
+            res = analysis.get_red_list_statuses(['a', 'b', 'a'], 2)
+        assert res == dict(a=('A', 2), b=('B', 2)), res
+        assert get_red_list_status.call_count == 4
+        # Lookups that time out fail the job, with one or more species
+        for names in [['a', 'slow', 'b'], ['slow']]:
+            start = time.time()
+            try:
+                analysis.get_red_list_statuses(names, 1)
+                raise AssertionError('The lookup must time out')
+            except multiprocessing.TimeoutError:
+                pass
+            assert time.time() - start < 1.5
+
+
+    @patch('enki.pbclient', autospec=True)
+    @patch('enki.Enki', autospec=True)
+    def test_basic_api_calls(self, enki_mock, pbclient):
+        """Test every branch of basic fetches the task and result once."""
+        enki_mock = enki.Enki(endpoint='server',
+                              api_key='api',
+                              project_short_name='project')
+        enki_mock.pbclient = pbclient
+        scenarios = [
+            # Five no animal answers store the result
+            ([self.create_task_runs_no_animal() for i in range(5)],
+             'update_result'),
+            # Four no animal answers and an animal re-open the task
+            ([self.create_task_runs_no_animal() for i in range(4)] +
+             [self.create_task_runs_animal()], 'update_task'),
+            # No consensus after 25 answers stores the result
+            ([self.create_task_runs_animal_wrong() for i in range(9)] +
+             [self.create_task_runs_animal() for i in range(9)] +
+             [self.create_task_runs_no_animal() for i in range(7)],
+             'update_result')]
+        for task_runs, update in scenarios:
+            pbclient.reset_mock()
+            enki_mock.reset_mock()
+            task = MagicMock()
+            task.id = 1
+            task.project_id = 1
+            task.n_answers = len(task_runs)
+            result = MagicMock()
+            result.id = 1
+            pbclient.find_results.return_value = [result]
+            enki_mock.tasks = [task]
+            enki_mock.task_runs = {1: task_runs}
+            basic(**self.payload)
+            assert enki_mock.get_tasks.call_count == 1
+            assert enki_mock.get_task_runs.call_count == 1
+            assert not pbclient.find_tasks.called
+            pbclient.find_results.assert_called_once_with(project_id=1, id=1,
+                                                          all=1)
+            names = [c[0] for c in pbclient.method_calls]
+            assert sorted(names) == ['find_results', update], names
+            if update == 'update_task':
+                pbclient.update_task.assert_called_once_with(task)
+                assert task.state == 'ongoing'
+            else:
+                pbclient.update_result.assert_called_once_with(result)
+
+    def test_load_task_context(self):
+        """Test load_task_context loads the task runs and the result."""
+        e = MagicMock()
+        e.task_runs = {1: ['tr']}
+        t = MagicMock()
+        t.id = 1
+        fetch = MagicMock()
+        with patch('enki.pbclient') as pbclient:
+            pbclient.find_results.return_value = []
+            ctx = analysis.load_task_context(e, t, self.payload, fetch)
+        assert fetch.call_count == 1
+        assert ctx == analysis.TaskContext(t, ['tr'], None, None), ctx
+        try:
+            ctx.result = 1
+            raise AssertionError('The context can be changed')
+        except AttributeError:
+            pass
+
+
+    @patch('settings.contributor_write_behind', True)
+    @patch('settings.contributor_flush_size', 3)
+    @patch('settings.contributor_flush_interval', 60)
+    @patch('settings.enable_background_jobs', True)
+    @patch('analysis.get_queue')
+    @patch('analysis.session', autospec=True)
+    def test_give_badges_write_behind(self, requests_mock, get_queue):
+        """Test give_badges keeps the badges in Redis until a flush."""
+        users = {1: dict(info=dict(karma=2)), 2: dict(info=dict(karma=1))}
+
+        def get(url):
+            user_id = int(url.split('/api/user/')[1].split('?')[0])
+            return self._mock_response(json_data=users[user_id], status=200)
+
+        def put(url, headers, data):
+            user_id = int(url.split('/api/user/')[1].split('?')[0])
+            users[user_id] = json.loads(data)
+            return self._mock_response(status=200)
+
+        requests_mock.get.side_effect = get
+        requests_mock.put.side_effect = put
+        store = analysis.ContributorStore(FakeRedis())
+        t = MagicMock()
+        answers = [dict(speciesScientificName='lore',
+                        iucn_red_list_status='Endangered')]
+        contributions = [(1, self.create_task_runs_animal().info['answer']),
+                         (2, self.create_task_runs_animal_wrong().info['answer'])]
+        with patch('analysis.contributor_store', store):
+            for result_id in [1, 2]:
+                result = MagicMock()
+                result.id = result_id
+                give_badges(None, t, answers, result, contributions)
+            assert not requests_mock.get.called
+            assert not requests_mock.put.called
+            assert store.dirty() == [1, 2]
+            # The rest are flushed by a single badge stage
+            get_queue.return_value.enqueue_in.assert_called_once_with(
+                timedelta(seconds=60), analysis.run_badge_stage)
+            # The third badge of a contributor flushes it
+            result.id = 3
+            give_badges(None, t, answers, result, contributions)
+            assert requests_mock.get.call_count == 2
+            assert requests_mock.put.call_count == 2
+            assert store.dirty() == []
+        badges = [dict(iucn_red_list_status='Endangered', result_id=i,
+                       number=1) for i in [1, 2, 3]]
+        assert users[1]['info'] == dict(karma=5, iucn_number=3,
+                                        species_number=3, badges=badges)
+        assert users[2]['info'] == dict(karma=0, iucn_number=0,
+                                        species_number=0, badges=[])
+
+    @patch('analysis.session', autospec=True)
+    def test_flush_contributor_keeps_new_badges(self, requests_mock):
+        """Test flush_contributor only forgets the applied badges."""
+        store = analysis.ContributorStore(FakeRedis())
+        badge = dict(iucn_red_list_status='Vulnerable', result_id=1, number=1)
+
+        def get(url):
+            # A badge arrives while the contributor is flushed
+            store.push(1, None)
+            return self._mock_response(json_data=dict(info=dict(karma=1)),
+                                       status=200)
+
+        requests_mock.get.side_effect = get
+        requests_mock.put.return_value = self._mock_response(status=200)
+        with patch('analysis.contributor_store', store):
+            store.push(1, badge)
+            assert analysis.flush_contributor(1) == 1
+            assert store.pending(1) == [None]
+            assert store.dirty() == [1]
+            data = json.loads(requests_mock.put.call_args[1]['data'])
+            assert data['info'] == dict(karma=2, iucn_number=0,
+                                        species_number=1, badges=[badge])
+            # Failed updates are retried on the next flush
+            requests_mock.get.side_effect = None
+            requests_mock.get.return_value = self._mock_response(
+                json_data=dict(info=dict(karma=2)), status=200)
+            requests_mock.put.return_value = self._mock_response(status=500)
+            assert analysis.flush_contributors() == 0
+            assert store.pending(1) == [None]
+            requests_mock.put.return_value = self._mock_response(status=200)
+            assert analysis.flush_contributors() == 1
+            assert store.dirty() == []
+
+
+    @patch('settings.badge_results_size', 3)
+    def test_compact_badges(self):
+        """Test compact_badges migrates the badges list."""
+        badges = [dict(iucn_red_list_status='Endangered', result_id=1,
+                       number=1),
+                  dict(iucn_red_list_status='Vulnerable', result_id=2,
+                       number=1),
+                  dict(iucn_red_list_status='Endangered', result_id=2,
+                       number=1),
+                  dict(iucn_red_list_status=None, result_id=3, number=1),
+                  dict(iucn_red_list_status='Endangered', result_id=4,
+                       number=1)]
+        info = analysis.compact_badges(dict(karma=3, badges=badges))
+        assert info == dict(karma=3, badge_results=[2, 3, 4],
+                            badge_counts={'Endangered': 2, 'Vulnerable': 1,
+                                          'Unknown': 1}), info
+        assert analysis.compact_badges(dict(info)) == info
+        assert analysis.compact_badges(dict()) == dict(badge_counts={},
+                                                       badge_results=[])
+
+    def test_apply_compact_badge(self):
+        """Test compact badges count like the badges list."""
+        rnd = random.Random(1)
+        statuses = analysis.RARE_FINDS + analysis.REST + [None]
+        badges = []
+        for i in range(300):
+            if rnd.random() < 0.3:
+                badges.append(None)
+            else:
+                badges.append(dict(iucn_red_list_status=rnd.choice(statuses),
+                                   result_id=rnd.randint(1, 100), number=1))
+        contributor = dict(info=dict())
+        compact = dict(info=dict())
+        for i, badge in enumerate(badges):
+            analysis.apply_badge(contributor, badge)
+            with patch('settings.compact_badges', True):
+                analysis.apply_badge(compact, badge)
+            # The list keeps a single badge per result
+            n = len(set(b['result_id']
+                        for b in contributor['info']['badges']))
+            assert len(compact['info']['badge_results']) == n
+            for key in ['karma', 'iucn_number', 'species_number']:
+                assert compact['info'][key] == contributor['info'][key], i
+        assert 'badges' not in compact['info']
+        assert sum(compact['info']['badge_counts'].values()) == n
+
+
+    @patch('enki.pbclient', autospec=True)
+    def test_iter_task_runs(self, pbclient):
+        """Test iter_task_runs fetches a page when the last one is used."""
+        task_runs = [self.create_task_runs_no_animal() for i in range(5)]
+        for i, tr in enumerate(task_runs):
+            tr.id = i + 1
+        pbclient.find_taskruns.side_effect = [task_runs[:2], task_runs[2:4],
+                                              task_runs[4:], []]
+        gen = analysis.iter_task_runs(1, 1, limit=2)
+        assert not pbclient.find_taskruns.called
+        assert next(gen) is task_runs[0]
+        assert next(gen) is task_runs[1]
+        assert pbclient.find_taskruns.call_count == 1
+        assert next(gen) is task_runs[2]
+        assert pbclient.find_taskruns.call_count == 2
+        assert list(gen) == task_runs[3:]
+        calls = [call(1, task_id=1, limit=2, offset=0, all=1),
+                 call(1, task_id=1, last_id=2, limit=2, all=1),
+                 call(1, task_id=1, last_id=4, limit=2, all=1),
+                 call(1, task_id=1, last_id=5, limit=2, all=1)]
+        assert pbclient.find_taskruns.mock_calls == calls
+
+    @patch('enki.pbclient', autospec=True)
+    def test_iter_task_runs_error(self, pbclient):
+        """Test iter_task_runs raises when a page is a PyBossa error."""
+        task_runs = [self.create_task_runs_no_animal() for i in range(2)]
+        for i, tr in enumerate(task_runs):
+            tr.id = i + 1
+        error = dict(status='failed', status_code=500)
+        pbclient.find_taskruns.side_effect = [task_runs, error]
+        gen = analysis.iter_task_runs(1, 1, limit=2)
+        assert next(gen) is task_runs[0]
+        assert next(gen) is task_runs[1]
+        try:
+            next(gen)
+            raise AssertionError('An error page must not end the task runs')
+        except ValueError as ex:
+            assert 'failed' in str(ex), ex
+
+    @patch('settings.stream_task_runs', True)
+    @patch('enki.pbclient', autospec=True)
+    @patch('enki.Enki', autospec=True)
+    def test_basic_stream_task_runs(self, enki_mock, pbclient):
+        """Test basic counts the task runs without loading them."""
+        enki_mock = enki.Enki(endpoint='server',
+                              api_key='api',
+                              project_short_name='project')
+        task = MagicMock()
+        task.id = 1
+        task.project_id = 1
+        task.n_answers = 5
+        result = MagicMock()
+        result.id = 1
+        pbclient.find_results.return_value = [result]
+        pbclient.update_result.side_effect = lambda r: r
+        enki_mock.pbclient = pbclient
+        enki_mock.tasks = [task]
+        task_runs = [self.create_task_runs_no_animal() for i in range(5)]
+        for i, tr in enumerate(task_runs):
+            tr.id = i + 1
+        pbclient.find_taskruns.side_effect = [task_runs[:3], task_runs[3:],
+                                              []]
+        res = basic(**self.payload)
+        assert res.info['iucn_red_list_status'] == settings.no_animal
+        assert not enki_mock.get_task_runs.called
+        assert pbclient.find_taskruns.call_count == 3
+
+    @patch('enki.pbclient', autospec=True)
+    @patch('enki.Enki', autospec=True)
+    def test_basic_task_runs_error(self, enki_mock, pbclient):
+        """Test basic decides nothing when a task run page fails."""
+        enki_mock = enki.Enki(endpoint='server',
+                              api_key='api',
+                              project_short_name='project')
+        task = MagicMock()
+        task.id = 1
+        task.project_id = 1
+        task.n_answers = 5
+        result = MagicMock()
+        result.id = 1
+        pbclient.find_results.return_value = [result]
+        enki_mock.pbclient = pbclient
+        enki_mock.tasks = [task]
+        task_runs = [self.create_task_runs_no_animal() for i in range(5)]
+        for i, tr in enumerate(task_runs):
+            tr.id = i + 1
+        error = dict(status='failed', status_code=500)
+        store = TallyStore(FakeRedis())
+        for mode in ['stream_task_runs', 'incremental_tally']:
+            pbclient.find_taskruns.side_effect = [task_runs[:3], error]
+            with patch('settings.%s' % mode, True), \
+                    patch('analysis.tally_store', store):
+                try:
+                    basic(**self.payload)
+                    raise AssertionError('A failed page must fail the job')
+                except ValueError as ex:
+                    assert 'failed' in str(ex), (mode, ex)
+            assert not pbclient.update_task.called, mode
+            assert not pbclient.update_result.called, mode
+            assert store.load(1, 1).task_runs == 0, mode
+            assert store.count(1, 1) is None, mode
+
+
+    @patch('enki.pbclient', autospec=True)
+    @patch('enki.Enki', autospec=True)
+    def test_basic_metrics(self, enki_mock, pbclient):
+        """Test basic counts the decision taken for every task."""
+        enki_mock = enki.Enki(endpoint='server',
+                              api_key='api',
+                              project_short_name='project')
+        enki_mock.pbclient = pbclient
+        task = MagicMock()
+        task.id = 1
+        task.project_id = 1
+        task.n_answers = 5
+        enki_mock.tasks = [task]
+        metrics = Metrics(FakeRedis())
+        metrics.counter('instantwild_analysis_total', 'Analyzed tasks.')
+        with patch('analysis.metrics', metrics):
+            enki_mock.task_runs = {1: [self.create_task_runs_no_animal()
+                                       for i in range(5)]}
+            basic(**self.payload)
+            enki_mock.task_runs = {1: [self.create_task_runs_no_animal()
+                                       for i in range(4)] +
+                                   [self.create_task_runs_animal()]}
+            basic(**self.payload)
+            basic(**self.payload)
+        lines = metrics.render().splitlines()
+        assert lines[2:] == [
+            'instantwild_analysis_total{outcome="no_animal_5"} 1',
+            'instantwild_analysis_total{outcome="reopen_5"} 2'], lines
+
+
+    @patch('analysis.logger', new_callable=Mock)
+    @patch('enki.pbclient', autospec=True)
+    @patch('enki.Enki', autospec=True)
+    def test_basic_logs_stages(self, enki_mock, pbclient, logger):
+        """Test basic logs the duration of every stage."""
+        enki_mock = enki.Enki(endpoint='server',
+                              api_key='api',
+                              project_short_name='project')
+        enki_mock.pbclient = pbclient
+        task = MagicMock()
+        task.id = 1
+        task.project_id = 1
+        task.n_answers = 5
+        enki_mock.tasks = [task]
+        enki_mock.task_runs = {1: [self.create_task_runs_no_animal()
+                                   for i in range(4)] +
+                               [self.create_task_runs_animal()]}
+        basic(**self.payload)
+        logger.info.assert_called_once_with('Task analyzed', extra=mock.ANY)
+        data = logger.info.call_args[1]['extra']['data']
+        assert data['outcome'] == 'reopen_5', data
+        assert data['task_id'] == 1
+        assert data['task_runs'] == 5
+        assert sorted(data['durations']) == ['decide', 'fetch', 'write'], data
+
+
+
+    @patch('settings.badge_delay', 0)
+    @patch('settings.enable_background_jobs', True)
+    @patch('settings.defer_badges', True)
+    @patch('analysis.get_queue')
+    @patch('analysis.session', autospec=True)
+    def test_defer_badges(self, requests_mock, get_queue):
+        """Test the badge stage updates every contributor once."""
+        users = {1: dict(info=dict(karma=2)), 2: dict(info=dict(karma=1))}
+
+        def get(url):
+            user_id = int(url.split('/api/user/')[1].split('?')[0])
+            return self._mock_response(json_data=users[user_id], status=200)
+
+        def put(url, headers, data):
+            user_id = int(url.split('/api/user/')[1].split('?')[0])
+            users[user_id] = json.loads(data)
+            return self._mock_response(status=200)
+
+        requests_mock.get.side_effect = get
+        requests_mock.put.side_effect = put
+        store = analysis.ContributorStore(FakeRedis())
+        t = MagicMock()
+        answers = [dict(speciesScientificName='lore',
+                        iucn_red_list_status='Endangered')]
+        contributions = [(1, self.create_task_runs_animal().info['answer']),
+                         (2, self.create_task_runs_animal_wrong().info['answer'])]
+        with patch('analysis.contributor_store', store):
+            for result_id in [1, 2]:
+                result = MagicMock()
+                result.id = result_id
+                give_badges(None, t, answers, result, contributions)
+            assert not requests_mock.get.called
+            assert not requests_mock.put.called
+            # A single stage is pending for both results
+            get_queue.return_value.enqueue.assert_called_once_with(
+                analysis.run_badge_stage)
+            assert analysis.run_badge_stage() == 4
+            assert requests_mock.get.call_count == 2
+            assert requests_mock.put.call_count == 2
+            assert store.dirty() == []
+            assert store.schedule()
+        badges = [dict(iucn_red_list_status='Endangered', result_id=i,
+                       number=1) for i in [1, 2]]
+        assert users[1]['info'] == dict(karma=4, iucn_number=2,
+                                        species_number=2, badges=badges)
+        assert users[2]['info'] == dict(karma=0, iucn_number=0,
+                                        species_number=0, badges=[])
+
+    @patch('settings.enable_background_jobs', False)
+    @patch('analysis.threading.Timer')
+    def test_schedule_badge_stage_timer(self, timer):
+        """Test the app runs delayed badge stages itself."""
+        store = analysis.ContributorStore(FakeRedis())
+        with patch('analysis.contributor_store', store):
+            analysis.schedule_badge_stage(60)
+            analysis.schedule_badge_stage(60)
+        timer.assert_called_once_with(60, analysis.run_badge_stage)
+        assert timer.return_value.daemon
+        timer.return_value.start.assert_called_once_with()
+
+    @patch('settings.enable_worker_pool', True)
+    @patch('settings.enable_background_jobs', False)
+    @patch('analysis.get_worker_pool')
+    def test_schedule_badge_stage_worker_pool(self, get_worker_pool):
+        """Test the badge stage runs in the worker pool when it has room."""
+        store = analysis.ContributorStore(FakeRedis())
+        pool = get_worker_pool.return_value
+        pool.submit.return_value = False
+        with patch('analysis.contributor_store', store):
+            analysis.schedule_badge_stage()
+            pool.submit.assert_called_with(analysis.run_badge_stage)
+            # A refused stage is scheduled again by the next badges
+            pool.submit.return_value = True
+            analysis.schedule_badge_stage()
+            analysis.schedule_badge_stage()
+        assert pool.submit.call_count == 2
+
+    @patch('settings.defer_badges', True)
+    @patch('analysis.get_red_list_statuses')
+    @patch('analysis.give_badges')
+    @patch('enki.pbclient.update_result')
+    def test_defer_badges_stores_result_first(self, update_result,
+                                              give_badges, statuses):
+        """Test the result is stored before the badges are given."""
+        calls = []
+        update_result.side_effect = lambda result: calls.append('result')
+        give_badges.side_effect = lambda *args: calls.append('badges')
+        statuses.return_value = {'lore': ('Endangered', 'common')}
+        tally = Tally()
+        for i in range(10):
+            tally.add_task_run(self.create_task_runs_animal(user_id=i + 1))
+        ctx = analysis.TaskContext(task=MagicMock(), task_runs=None,
+                                   tally=tally, result=MagicMock())
+        assert analysis.analyze_context(ctx) == 'OK'
+        assert calls == ['result', 'badges'], calls
+        with patch('settings.result_buffer', True), \
+                patch('analysis.result_writer') as writer:
+            del calls[:]
+            analysis.analyze_context(ctx)
+            assert calls == ['result', 'badges'], calls
+            assert not writer.add.called
+        with patch('settings.defer_badges', False):
+            del calls[:]
+            analysis.analyze_context(ctx)
+            assert calls == ['badges', 'result'], calls
+
+    @patch('settings.defer_badges', True)
+    @patch('analysis.get_red_list_statuses')
+    @patch('analysis.give_badges')
+    @patch('enki.pbclient.update_result')
+    def test_defer_badges_failed_write(self, update_result, give_badges,
+                                       statuses):
+        """Test no badges are given for a result that was not stored."""
+        update_result.return_value = dict(status='failed', status_code=500)
+        statuses.return_value = {'lore': ('Endangered', 'common')}
+        tally = Tally()
+        for i in range(10):
+            tally.add_task_run(self.create_task_runs_animal(user_id=i + 1))
+        ctx = analysis.TaskContext(task=MagicMock(), task_runs=None,
+                                   tally=tally, result=MagicMock())
+        try:
+            analysis.analyze_context(ctx)
+            raise AssertionError('A failed write must fail the job')
+        except ValueError as ex:
+            assert 'not stored' in str(ex), ex
+        assert update_result.called
+        assert not give_badges.called
+
+    @patch('settings.result_buffer', True)
+    @patch('settings.incremental_tally', True)
+    @patch('analysis.analyze_task')
+    @patch('analysis.enki.pbclient')
+    @patch('analysis.enki.Enki')
+    def test_basic_batch_result_buffer(self, enki_mock, pbclient,
+                                       analyze_task):
+        """Test the results of a batch are stored together at its end."""
+        tasks = {}
+        for i in range(1, 4):
+            tasks[i] = MagicMock()
+            tasks[i].id = i
+        pbclient.find_tasks.side_effect = lambda **kw: [tasks[kw['id']]]
+        writer = analysis.ResultWriter(pbclient.update_result, interval=60)
+
+        def analyze(e, t, **kwargs):
+            result = MagicMock()
+            result.id = t.id
+            assert analysis.store_result(result) == result
+            assert not pbclient.update_result.called
+
+        analyze_task.side_effect = analyze
+        e = enki_mock.return_value
+        e.project = MagicMock()
+        e.project.id = 1
+        events = [dict(self.payload, task_id=i) for i in range(1, 4)]
+        with patch('analysis.result_writer', writer):
+            statuses = analysis.basic_batch(events)
+        assert [s['status'] for s in statuses] == ['ok'] * 3, statuses
+        assert pbclient.update_result.call_count == 3
+        assert writer.stats() == dict(queued=0, written=3, failed=0)
+
+
+
+    @patch('settings.result_buffer', True)
+    @patch('analysis.result_writer')
+    @patch('analysis.run_analysis')
+    @patch('analysis.get_enki')
+    def test_basic_result_buffer(self, get_enki, run_analysis, writer):
+        """Test basic stores the buffered results unless in the pool."""
+        get_enki.return_value.tasks = [MagicMock()]
+        with patch('settings.enable_background_jobs', True):
+            basic(**self.payload)
+        assert writer.flush.call_count == 1
+        with patch('settings.enable_background_jobs', False):
+            with patch('settings.enable_worker_pool', True):
+                basic(**self.payload)
+            assert writer.flush.call_count == 1
+            basic(**self.payload)
+        assert writer.flush.call_count == 2
+
+    @patch('analysis.flush_logs')
+    @patch('analysis.run_analysis')
+    @patch('analysis.get_enki')
+    def test_basic_flush_logs(self, get_enki, run_analysis, flush_logs):
+        """Test background jobs write their records before they end."""
+        get_enki.return_value.tasks = [MagicMock()]
+        run_analysis.side_effect = ValueError('boom')
+        with patch('settings.enable_background_jobs', True):
+            try:
+                basic(**self.payload)
+            except ValueError:
+                pass
+        assert flush_logs.call_count == 1
+        with patch('settings.enable_background_jobs', False):
+            try:
+                basic(**self.payload)
+            except ValueError:
+                pass
+        assert flush_logs.call_count == 1
+
+
+
+    @patch('settings.incremental_tally', True)
+    @patch('analysis.analyze_task')
+    @patch('analysis.enki.pbclient')
+    @patch('analysis.enki.Enki')
+    def test_basic_batch_only_completed(self, enki_mock, pbclient,
+                                        analyze_task):
+        """Test basic_batch can skip the tasks that are not completed."""
+        tasks = {}
+        for i, state in [(1, 'completed'), (2, 'ongoing')]:
+            tasks[i] = MagicMock()
+            tasks[i].id = i
+            tasks[i].state = state
+        pbclient.find_tasks.side_effect = lambda **kw: [tasks[kw['id']]]
+        e = enki_mock.return_value
+        e.project = MagicMock()
+        e.project.id = 1
+        events = [dict(self.payload, task_id=i) for i in [1, 2]]
+        statuses = analysis.basic_batch(events, only_completed=True)
+        assert statuses == [dict(task_id=1, status='ok'),
+                            dict(task_id=2, status='skipped')], statuses
+        assert analyze_task.call_count == 1
+        statuses = analysis.basic_batch(events)
+        assert statuses == [dict(task_id=1, status='ok'),
+                            dict(task_id=2, status='ok')], statuses
+
+
+class TestAppFastAnalysis(TestApp):
+
+    """Run the analysis tests using the pandas-free decisions."""
+
+    def setUp(self):
+        """Setup method for configuring the tests."""
+        super(TestAppFastAnalysis, self).setUp()
+        self.fast_analysis = patch('settings.fast_analysis', True)
+        self.fast_analysis.start()
+
+    def tearDown(self):
+        """Stop patching the settings."""
+        self.fast_analysis.stop()
@@ -23,8 +23,11 @@ This exports:
 
 """
 import json
-from base import Test
-from app import app
+from base import Test, FakeRedis
+from metrics import Metrics
+from redis.exceptions import ConnectionError
+from app import app, queue_stats
+from analysis import basic, basic_batch
 from mock import patch
 try:
     import settings
@@ -59,7 +62,7 @@ class TestApp(Test):
         assert "OK" in res.data, res.data
 
     @patch('settings.enable_background_jobs', True)
-    @patch('app.Queue')
+    @patch('app.get_priority_queue')
     def test_post_works_with_queues(self, mock):
         """Test POST method works with queues."""
         res = self.tc.post('/', headers={'Content-type': 'application/json'},
@@ -67,3 +70,144 @@ class TestApp(Test):
         assert mock.called
         assert res.status_code == 200, self.ERR_MSG_200_STATUS_CODE
         assert "OK" in res.data, res.data
+
+    @patch('settings.enable_background_jobs', False)
+    @patch('app.basic_batch')
+    def test_batch_json(self, mock):
+        """Test batch accepts a JSON array of events."""
+        mock.return_value = [dict(task_id=1, status='ok'),
+                             dict(task_id=2, status='ok')]
+        events = [self.payload, dict(self.payload, task_id=2)]
+        res = self.tc.post('/batch', headers={'Content-type': 'application/json'},
+                           data=json.dumps(events))
+        assert res.status_code == 200, self.ERR_MSG_200_STATUS_CODE
+        mock.assert_called_with(events)
+        assert json.loads(res.data) == mock.return_value, res.data
+
+    @patch('settings.enable_background_jobs', False)
+    @patch('app.basic_batch')
+    def test_batch_ndjson(self, mock):
+        """Test batch accepts NDJSON events."""
+        mock.return_value = []
+        events = [self.payload, dict(self.payload, task_id=2)]
+        data = '\n'.join(json.dumps(event) for event in events) + '\n'
+        res = self.tc.post('/batch',
+                           headers={'Content-type': 'application/x-ndjson'},
+                           data=data)
+        assert res.status_code == 200, self.ERR_MSG_200_STATUS_CODE
+        mock.assert_called_with(events)
+        res = self.tc.post('/batch',
+                           headers={'Content-type': 'application/x-ndjson'},
+                           data=json.dumps(self.payload))
+        mock.assert_called_with([self.payload])
+
+    @patch('settings.enable_background_jobs', False)
+    @patch('app.basic_batch')
+    def test_batch_invalid(self, mock):
+        """Test batch rejects invalid events."""
+        for data in ['{"task_id": 1', '[1, 2]', '"event"']:
+            res = self.tc.post('/batch', data=data)
+            assert res.status_code == 400, res.status_code
+        assert not mock.called
+
+    @patch('settings.enable_background_jobs', False)
+    @patch('analysis.get_enki')
+    def test_batch_missing_keys(self, get_enki):
+        """Test batch reports the events missing required keys."""
+        events = [dict(task_id=1), dict(project_short_name='project')]
+        res = self.tc.post('/batch', headers={'Content-type': 'application/json'},
+                           data=json.dumps(events))
+        assert res.status_code == 200, res.status_code
+        assert json.loads(res.data) == [
+            dict(task_id=1, status='failed',
+                 error='Missing project_short_name'),
+            dict(task_id=None, status='failed', error='Missing task_id')]
+        assert not get_enki.called
+        with patch('settings.enable_background_jobs', True):
+            with patch('app.get_queue') as get_queue:
+                res = self.tc.post('/batch', data=json.dumps(
+                    [dict(task_id=1), self.payload]))
+        assert res.status_code == 200, res.status_code
+        statuses = json.loads(res.data)
+        assert [s['status'] for s in statuses] == ['failed', 'queued']
+        queue = get_queue.return_value
+        queue.create_job.assert_called_once_with(basic_batch,
+                                                 args=([self.payload],))
+
+    @patch('settings.enable_background_jobs', True)
+    @patch('app.get_queue')
+    def test_batch_with_queues(self, mock):
+        """Test batch enqueues a job per project."""
+        events = [self.payload, dict(self.payload, task_id=2),
+                  dict(self.payload, project_short_name='other', task_id=3)]
+        res = self.tc.post('/batch', headers={'Content-type': 'application/json'},
+                           data=json.dumps(events))
+        assert res.status_code == 200, self.ERR_MSG_200_STATUS_CODE
+        queue = mock.return_value
+        assert queue.enqueue_job.call_count == 2
+        assert queue.connection.pipeline.return_value.execute.call_count == 1
+        statuses = json.loads(res.data)
+        assert statuses == [dict(task_id=i, status='queued')
+                            for i in [1, 2, 3]], statuses
+
+    def test_metrics(self):
+        """Test metrics are reported in the Prometheus format."""
+        metrics = Metrics(FakeRedis())
+        metrics.counter('events_total', 'Events.')
+        metrics.inc('events_total', outcome='consensus')
+        with patch('app.metrics', metrics):
+            res = self.tc.get('/metrics')
+        assert res.status_code == 200, self.ERR_MSG_200_STATUS_CODE
+        assert res.mimetype == 'text/plain'
+        assert res.data == ('# HELP events_total Events.\n'
+                            '# TYPE events_total counter\n'
+                            'events_total{outcome="consensus"} 1\n'), res.data
+
+    @patch('settings.priority_queues', True)
+    @patch('settings.enable_background_jobs', True)
+    @patch('app.get_queue')
+    def test_queue_stats(self, get_queue):
+        """Test the jobs waiting in every queue are reported."""
+        get_queue.return_value.__len__.return_value = 3
+        stats = queue_stats()
+        assert stats == [(dict(queue='mywebhooks-high'), 3),
+                         (dict(queue='mywebhooks'), 3),
+                         (dict(queue='mywebhooks-low'), 3)], stats
+        get_queue.side_effect = ConnectionError
+        assert queue_stats() == []
+
+    @patch('settings.enable_worker_pool', True)
+    @patch('settings.enable_background_jobs', False)
+    @patch('app.get_worker_pool')
+    def test_worker_pool(self, get_worker_pool):
+        """Test webhooks are analyzed in the worker pool."""
+        pool = get_worker_pool.return_value
+        pool.submit.return_value = True
+        res = self.tc.post('/', headers={'Content-type': 'application/json'},
+                           data=json.dumps(self.payload))
+        assert res.status_code == 200, self.ERR_MSG_200_STATUS_CODE
+        pool.submit.assert_called_with(basic, **self.payload)
+        pool.submit.return_value = False
+        res = self.tc.post('/', headers={'Content-type': 'application/json'},
+                           data=json.dumps(self.payload))
+        assert res.status_code == 503, res.status_code
+
+    @patch('settings.enable_worker_pool', True)
+    @patch('settings.enable_background_jobs', False)
+    @patch('app.get_worker_pool')
+    def test_batch_worker_pool(self, get_worker_pool):
+        """Test batches are analyzed in the worker pool."""
+        pool = get_worker_pool.return_value
+        pool.submit.return_value = True
+        pool.stats.return_value = dict(queued=3, running=1)
+        events = [self.payload, dict(self.payload, task_id=2), dict(task_id=3)]
+        res = self.tc.post('/batch', data=json.dumps(events))
+        assert res.status_code == 200, self.ERR_MSG_200_STATUS_CODE
+        assert json.loads(res.data) == [
+            dict(task_id=1, status='queued'), dict(task_id=2, status='queued'),
+            dict(task_id=3, status='failed',
+                 error='Missing project_short_name')]
+        pool.submit.assert_called_with(basic_batch, events[:2])
+        res = self.tc.get('/metrics')
+        assert 'instantwild_worker_pool_jobs{state="queued"} 3' in res.data
+        assert 'instantwild_worker_pool_jobs{state="running"} 1' in res.data
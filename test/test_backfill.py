@@ -0,0 +1,182 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Backfill package for testing PyBossa application.
+
+This exports:
+    - Test the re-analysis of all the tasks of a project
+
+"""
+import json
+import os
+import shutil
+import tempfile
+import enki
+import analysis
+import backfill
+import settings
+from base import FakeRedis
+from tally import Tally, TallyStore
+from mock import patch, MagicMock
+
+
+def result(id):
+    r = MagicMock()
+    r.id = id
+    r.task_id = id * 10
+    return r
+
+
+class TestBackfill(object):
+
+    """Class for Testing the backfill."""
+
+    def setUp(self):
+        """SetUp method."""
+        self.tmp = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.tmp, 'backfill.json')
+        self.project = MagicMock()
+        self.project.id = 1
+        self.project.short_name = 'project'
+        self.results = [result(i) for i in range(1, 8)]
+
+    def tearDown(self):
+        """TearDown method."""
+        shutil.rmtree(self.tmp)
+
+    def find_results(self, project_id, limit, all, last_id=0, offset=0):
+        return [r for r in self.results if r.id > last_id][offset:limit]
+
+    @patch('enki.pbclient')
+    def test_get_events(self, pbclient):
+        """Test get_events pages through the results."""
+        pbclient.find_results.side_effect = self.find_results
+        events = backfill.get_events(self.project, limit=3)
+        assert [e['result_id'] for e in events] == [1, 2, 3]
+        assert events[0] == dict(project_short_name='project', project_id=1,
+                                 task_id=10, result_id=1,
+                                 event='task_completed'), events[0]
+        events = backfill.get_events(self.project, last_id=6, limit=3)
+        assert [e['result_id'] for e in events] == [7]
+        pbclient.find_results.assert_called_with(1, last_id=6, limit=3, all=1)
+
+    @patch('analysis.basic_batch')
+    @patch('analysis.get_enki')
+    @patch('enki.pbclient')
+    def test_backfill(self, pbclient, get_enki, basic_batch):
+        """Test backfill analyzes every result and resumes."""
+        pbclient.find_results.side_effect = self.find_results
+        get_enki.return_value.project = self.project
+        basic_batch.side_effect = lambda events, **kwargs: [
+            dict(status='ok') for e in events]
+        counts = backfill.backfill('project', processes=1, page_size=2,
+                                   checkpoint=self.checkpoint)
+        assert counts == dict(ok=7), counts
+        pages = [[e['result_id'] for e in c[0][0]]
+                 for c in basic_batch.call_args_list]
+        assert pages == [[1, 2], [3, 4], [5, 6], [7]], pages
+        with open(self.checkpoint) as f:
+            assert json.load(f) == dict(project_id=1, last_id=7,
+                                        counts=dict(ok=7))
+        # New results are analyzed from the checkpoint
+        self.results.append(result(8))
+        basic_batch.reset_mock()
+        counts = backfill.backfill('project', processes=1, page_size=2,
+                                   checkpoint=self.checkpoint)
+        assert counts == dict(ok=8), counts
+        pages = [[e['result_id'] for e in c[0][0]]
+                 for c in basic_batch.call_args_list]
+        assert pages == [[8]], pages
+        counts = backfill.backfill('project', processes=1, page_size=10,
+                                   checkpoint=self.checkpoint, restart=True)
+        assert counts == dict(ok=8), counts
+
+    @patch('analysis.update_contributor')
+    @patch('analysis.basic_batch')
+    @patch('analysis.get_enki')
+    @patch('enki.pbclient')
+    def test_backfill_dry_run(self, pbclient, get_enki, basic_batch,
+                              update_contributor):
+        """Test a dry run counts the writes without sending them."""
+        pbclient.find_results.side_effect = self.find_results
+        get_enki.return_value.project = self.project
+
+        def analyze(events, **kwargs):
+            for event in events:
+                enki.pbclient.update_result(event)
+                analysis.update_contributor(1, {})
+                analysis.tally_store.save(1, event['task_id'], Tally())
+            return [dict(status='ok') for e in events]
+
+        basic_batch.side_effect = analyze
+        store = TallyStore(FakeRedis())
+        with patch('analysis.tally_store', store):
+            counts = backfill.backfill('project', processes=1, page_size=5,
+                                       is_dry_run=True)
+            assert analysis.tally_store is store
+        assert counts == dict(ok=7, results=7, contributors=7,
+                              tallies=7), counts
+        assert not pbclient.update_result.called
+        assert not update_contributor.called
+        assert analysis.update_contributor is update_contributor
+        assert store.redis.data == {}, store.redis.data
+        assert not os.path.exists(self.checkpoint)
+
+    @patch('settings.result_buffer', False)
+    @patch('analysis.basic_batch')
+    @patch('analysis.get_enki')
+    @patch('enki.pbclient')
+    def test_backfill_badges(self, pbclient, get_enki, basic_batch):
+        """Test backfill buffers the results and skips the badges."""
+        pbclient.find_results.side_effect = self.find_results
+        get_enki.return_value.project = self.project
+        give_badges = analysis.give_badges
+        seen = []
+
+        def analyze(events, only_completed=False):
+            assert only_completed
+            seen.append((analysis.give_badges, settings.result_buffer))
+            return [dict(status='ok') for e in events]
+
+        basic_batch.side_effect = analyze
+        backfill.backfill('project', processes=1, page_size=10)
+        assert seen == [(backfill.skip_badges, True)], seen
+        assert analysis.give_badges is give_badges
+        assert not settings.result_buffer
+        del seen[:]
+        backfill.backfill('project', processes=1, page_size=10,
+                          with_badges=True)
+        assert seen == [(give_badges, True)], seen
+
+    @patch('analysis.basic_batch')
+    def test_analyze_page_unstored(self, basic_batch):
+        """Test results that could not be stored are counted."""
+        writer = analysis.ResultWriter(lambda r: dict(status='failed'),
+                                       retries=0)
+
+        def analyze(events, only_completed=False):
+            for event in events:
+                writer.add(result(event['result_id']))
+            writer.flush()
+            return [dict(status='ok') for e in events]
+
+        basic_batch.side_effect = analyze
+        with patch('analysis.result_writer', writer):
+            counts = backfill.analyze_page([dict(result_id=1),
+                                            dict(result_id=2)])
+        assert counts == dict(ok=2, unstored=2), counts
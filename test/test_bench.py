@@ -0,0 +1,97 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmark package for testing PyBossa application.
+
+This exports:
+    - Test the fake PyBossa server and the load generator
+
+"""
+import json
+from bench.fake_pybossa import FakePyBossa, create_app, query
+from bench.loadgen import percentile, report
+
+
+class TestBench(object):
+
+    """Class for Testing the benchmark harness."""
+
+    def setUp(self):
+        """SetUp method."""
+        self.data = FakePyBossa(n_tasks=10, n_users=30, seed=1)
+        self.client = create_app(self.data).test_client()
+
+    def test_query(self):
+        """Test query filters and paginates like the PyBossa API."""
+        items = [dict(id=i, task_id=i % 2, info=dict(name='Panthera leo'))
+                 for i in range(1, 11)]
+        found = query(items, dict(task_id='1', limit='2'))
+        assert [item['id'] for item in found] == [1, 3], found
+        found = query(items, dict(task_id='1', limit='2', offset='2'))
+        assert [item['id'] for item in found] == [5, 7], found
+        found = query(items, dict(task_id='1', last_id='7'))
+        assert [item['id'] for item in found] == [9], found
+        found = query(items, dict(fulltextsearch='1', info='name::leo'))
+        assert len(found) == 10, found
+
+    def test_events(self):
+        """Test there is a webhook event per task."""
+        events = self.data.events()
+        assert len(events) == 10
+        assert events[0]['project_short_name'] == 'instantwild'
+        assert events[0]['event'] == 'task_completed'
+
+    def test_api(self):
+        """Test the fake API serves the data."""
+        res = self.client.get('/api/project?short_name=instantwild')
+        assert json.loads(res.data)[0]['id'] == 1
+        res = self.client.get('/api/taskrun?task_id=1&limit=100')
+        taskruns = json.loads(res.data)
+        assert len(taskruns) == self.data.tasks[0]['n_answers']
+        assert all(tr['task_id'] == 1 for tr in taskruns)
+        res = self.client.get('/api/user/1')
+        assert json.loads(res.data)['name'] == 'user1'
+        res = self.client.get('/api/user/1000')
+        assert res.status_code == 404
+
+    def test_completed(self):
+        """Test updating a result records the task as completed."""
+        res = self.client.put('/api/result/3',
+                              data=json.dumps(dict(id=3, info=dict(a=1))))
+        assert json.loads(res.data)['info'] == dict(a=1)
+        completed = json.loads(self.client.get('/bench/completed').data)
+        assert completed.keys() == ['3'], completed
+        self.client.post('/bench/reset')
+        assert json.loads(self.client.get('/bench/completed').data) == {}
+
+    def test_percentile(self):
+        """Test percentile uses the nearest rank."""
+        values = range(1, 101)
+        assert percentile(values, 50) == 50
+        assert percentile(values, 95) == 95
+        assert percentile(values, 99) == 99
+        assert percentile([3.0], 99) == 3.0
+
+    def test_report(self):
+        """Test report skips failed events."""
+        res = report('sync', [0.0, 0.0, 1.0], [1.0, 2.0, 3.0],
+                     [False, True, False])
+        assert res['ok'] == 2
+        assert res['failed'] == 1
+        assert res['seconds'] == 3.0
+        assert res['p99'] == 2.0
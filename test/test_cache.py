@@ -0,0 +1,101 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Cache package for testing PyBossa application.
+
+This exports:
+    - Test the read-through caches
+
+"""
+import json
+from cache import LRUCache, normalize_name
+from mock import patch, MagicMock
+from redis.exceptions import ConnectionError
+
+
+class TestCache(object):
+
+    """Class for Testing the caches."""
+
+    def test_normalize_name(self):
+        """Test normalize_name works."""
+        assert normalize_name(u' Panthera   Leo ') == u'panthera leo'
+        assert normalize_name(None) == u''
+
+    def test_get_set(self):
+        """Test get and set work."""
+        cache = LRUCache(maxsize=10, ttl=60)
+        assert cache.get('a') is None
+        cache.set('a', 1)
+        assert cache.get('a') == 1
+        assert cache.stats() == dict(hits=1, misses=1, redis_hits=0, size=1)
+
+    def test_lru_eviction(self):
+        """Test least recently used keys are evicted first."""
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+
+    @patch('cache.time')
+    def test_ttl(self, time_mock):
+        """Test expired keys are not returned."""
+        time_mock.time.return_value = 100
+        cache = LRUCache(maxsize=10, ttl=60)
+        cache.set('a', 1)
+        time_mock.time.return_value = 159
+        assert cache.get('a') == 1
+        time_mock.time.return_value = 161
+        assert cache.get('a') is None
+
+    def test_disabled(self):
+        """Test a cache without size or ttl never stores anything."""
+        cache = LRUCache(maxsize=0, ttl=60)
+        cache.set('a', 1)
+        assert cache.get('a') is None
+        assert cache.misses == 1
+
+    def test_redis_backend(self):
+        """Test Redis is used as a second level."""
+        redis = MagicMock()
+        redis.get.return_value = json.dumps(['Endangered', 'common'])
+        cache = LRUCache(maxsize=10, ttl=60, redis=redis, prefix='p:')
+        assert cache.get('a') == ['Endangered', 'common']
+        redis.get.assert_called_with('p:a')
+        assert cache.get('a') == ['Endangered', 'common']
+        assert redis.get.call_count == 1
+        assert cache.redis_hits == 1
+        assert cache.hits == 2
+        cache.set('b', 2)
+        redis.setex.assert_called_with('p:b', 60, '2')
+        cache.invalidate('b')
+        redis.delete.assert_called_with('p:b')
+
+    def test_redis_errors(self):
+        """Test Redis errors are treated as misses."""
+        redis = MagicMock()
+        redis.get.side_effect = ConnectionError
+        redis.setex.side_effect = ConnectionError
+        cache = LRUCache(maxsize=10, ttl=60, redis=redis)
+        cache.set('a', 1)
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
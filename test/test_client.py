@@ -0,0 +1,60 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Client package for testing PyBossa application.
+
+This exports:
+    - Test the shared HTTP client
+
+"""
+import requests
+import client
+import analysis
+from client import Session
+from mock import patch
+
+
+class TestClient(object):
+
+    """Class for Testing the shared HTTP client."""
+
+    def test_pool(self):
+        """Test the session keeps a pool of connections per host."""
+        s = Session(pool_size=5, timeout=3)
+        adapter = s.get_adapter('https://server')
+        assert adapter._pool_connections == 5
+        assert adapter._pool_maxsize == 5
+        assert s.headers['Accept-Encoding'] == 'gzip, deflate'
+        s = Session(gzip=False)
+        assert s.headers['Accept-Encoding'] == 'identity'
+
+    @patch('requests.Session.request')
+    def test_default_timeout(self, request):
+        """Test requests use the default timeout unless given."""
+        s = Session(timeout=3)
+        s.get('http://server/api/user/1')
+        request.assert_called_with('GET', 'http://server/api/user/1',
+                                   allow_redirects=True, timeout=3)
+        s.put('http://server/api/user/1', data='{}', timeout=10)
+        request.assert_called_with('PUT', 'http://server/api/user/1',
+                                   data='{}', timeout=10)
+
+    def test_shared_with_pbclient(self):
+        """Test enki uses the same pooled session."""
+        assert analysis.enki.pbclient.requests is client.session
+        assert isinstance(client.session, requests.Session)
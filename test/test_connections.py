@@ -0,0 +1,50 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Connections package for testing PyBossa application.
+
+This exports:
+    - Test the shared Redis connections
+
+"""
+import settings
+from connections import pool, get_redis, get_queue
+
+
+class TestConnections(object):
+
+    """Class for Testing the shared Redis connections."""
+
+    def test_pool(self):
+        """Test the pool is configured from the settings."""
+        assert pool.max_connections == settings.redis_pool_size
+        assert pool.timeout == settings.redis_pool_timeout
+        kwargs = pool.connection_kwargs
+        assert kwargs['socket_timeout'] == settings.redis_socket_timeout
+        assert (kwargs['socket_connect_timeout'] ==
+                settings.redis_connect_timeout)
+        assert get_redis().connection_pool is pool
+
+    def test_get_queue(self):
+        """Test queues are created once and share the pool."""
+        queue = get_queue()
+        assert queue.name == settings.queue_name
+        assert queue.connection is get_redis()
+        assert get_queue() is queue
+        assert get_queue('other') is not queue
+        assert get_queue('other') is get_queue('other')
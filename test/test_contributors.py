@@ -0,0 +1,72 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Contributors package for testing PyBossa application.
+
+This exports:
+    - Test the pending badges of the contributors
+
+"""
+from base import FakeRedis
+from contributors import ContributorStore
+
+
+class TestContributorStore(object):
+
+    """Class for Testing the ContributorStore."""
+
+    def setUp(self):
+        """SetUp method."""
+        self.store = ContributorStore(FakeRedis())
+
+    def test_push(self):
+        """Test badges are kept in order per contributor."""
+        badge = dict(iucn_red_list_status='Endangered', result_id=1, number=1)
+        assert self.store.push(1, badge) == 1
+        assert self.store.push(1, None) == 2
+        assert self.store.push(2, None) == 1
+        assert self.store.pending(1) == [badge, None]
+        assert self.store.pending(3) == []
+        assert self.store.dirty() == [1, 2]
+
+    def test_discard(self):
+        """Test discard forgets the flushed badges only."""
+        for i in range(3):
+            self.store.push(1, None)
+        self.store.push(2, None)
+        self.store.discard(1, 2)
+        assert self.store.pending(1) == [None]
+        assert self.store.dirty() == [1, 2]
+        self.store.discard(1, 1)
+        assert self.store.pending(1) == []
+        assert self.store.dirty() == [2]
+
+    def test_lock(self):
+        """Test a contributor is flushed by one worker at a time."""
+        assert self.store.lock(1)
+        assert not self.store.lock(1)
+        assert self.store.lock(2)
+        self.store.unlock(1)
+        assert self.store.lock(1)
+
+    def test_schedule(self):
+        """Test a single badge stage is pending at a time."""
+        assert self.store.schedule()
+        assert not self.store.schedule()
+        self.store.unschedule()
+        assert self.store.schedule()
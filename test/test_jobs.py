@@ -0,0 +1,191 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Jobs package for testing PyBossa application.
+
+This exports:
+    - Test the background jobs
+
+"""
+from datetime import datetime, timedelta
+from base import Test, FakeRedis
+from analysis import basic, basic_batch
+from jobs import enqueue_analysis, enqueue_batch, run_basic, coalesce_stats
+from jobs import task_key, priority, queue_name, Worker
+from metrics import Metrics
+from tally import Tally, TallyStore
+from mock import patch, MagicMock, call
+
+
+class TestJobs(Test):
+
+    """Class for Testing the background jobs."""
+
+    def queue(self):
+        queue = MagicMock()
+        queue.connection = FakeRedis()
+        return queue
+
+    @patch('settings.coalesce_webhooks', False)
+    def test_enqueue_analysis(self):
+        """Test every event is enqueued without coalescing."""
+        queue = self.queue()
+        enqueue_analysis(queue, self.payload)
+        enqueue_analysis(queue, self.payload)
+        assert queue.enqueue.call_count == 2
+        queue.enqueue.assert_called_with(basic, **self.payload)
+
+    @patch('settings.coalesce_window', 0)
+    @patch('settings.coalesce_webhooks', True)
+    def test_enqueue_analysis_coalesce(self):
+        """Test events of a task with a pending job are merged."""
+        queue = self.queue()
+        job = enqueue_analysis(queue, self.payload)
+        assert job == queue.enqueue_call.return_value
+        queue.enqueue_call.assert_called_with(run_basic, kwargs=self.payload)
+        assert enqueue_analysis(queue, self.payload) is None
+        assert enqueue_analysis(queue, self.payload) is None
+        assert task_key(self.payload) == 'basic:1:1'
+        assert int(queue.connection.get('instantwild:pending:basic:1:1')) == 2
+        other = dict(self.payload, task_id=2)
+        assert enqueue_analysis(queue, other) is not None
+        assert queue.enqueue_call.call_count == 2
+        stats = coalesce_stats(queue.connection)
+        assert stats == dict(received=4, coalesced=2), stats
+
+    @patch('settings.coalesce_window', 5)
+    @patch('settings.coalesce_webhooks', True)
+    def test_enqueue_analysis_debounce(self):
+        """Test new jobs wait for the coalesce window."""
+        queue = self.queue()
+        enqueue_analysis(queue, self.payload)
+        queue.enqueue_in.assert_called_with(timedelta(seconds=5), run_basic,
+                                            kwargs=self.payload)
+
+    def test_enqueue_batch(self):
+        """Test batch jobs are enqueued in a single pipeline."""
+        queue = self.queue()
+        pipelines = []
+        queue.connection.pipeline = lambda transaction=True: (
+            pipelines.append(MagicMock()) or pipelines[-1])
+        other = dict(self.payload, project_short_name='other', task_id=2)
+        statuses = enqueue_batch(queue, [self.payload, other])
+        assert statuses == [dict(task_id=1, status='queued'),
+                            dict(task_id=2, status='queued')], statuses
+        assert len(pipelines) == 1
+        pipelines[0].execute.assert_called_once_with()
+        queue.create_job.assert_any_call(basic_batch, args=([self.payload],))
+        queue.create_job.assert_any_call(basic_batch, args=([other],))
+        for call in queue.enqueue_job.call_args_list:
+            assert call[1]['pipeline'] == pipelines[0], call
+
+    @patch('settings.priority_task_runs', 9)
+    @patch('settings.priority_queues', True)
+    def test_priority(self):
+        """Test events are classified by the task runs of their tally."""
+        store = TallyStore(FakeRedis())
+        with patch('jobs.tally_store', store):
+            assert priority(self.payload) == 'default'
+            for task_runs, expected in [(5, 'low'), (8, 'low'), (9, 'high'),
+                                        (24, 'high')]:
+                tally = Tally()
+                tally.task_runs = task_runs
+                store.save(1, 1, tally)
+                assert priority(self.payload) == expected, task_runs
+            with patch('settings.priority_queues', False):
+                assert priority(self.payload) == 'default'
+        assert queue_name('default') == 'mywebhooks'
+        assert queue_name('high') == 'mywebhooks-high'
+
+    @patch('settings.priority_queues', True)
+    @patch('jobs.get_queue')
+    @patch('jobs.priority')
+    def test_enqueue_batch_priority(self, priority, get_queue):
+        """Test batch jobs are enqueued in the queue of their priority."""
+        queue = self.queue()
+        events = [self.payload, dict(self.payload, task_id=2),
+                  dict(self.payload, task_id=3)]
+        priority.side_effect = ['high', 'default', 'high']
+        enqueue_batch(queue, events)
+        get_queue.assert_called_with('mywebhooks-high')
+        high = get_queue.return_value
+        high.create_job.assert_called_once_with(
+            basic_batch, args=([events[0], events[2]],))
+        queue.create_job.assert_called_once_with(basic_batch,
+                                                 args=([events[1]],))
+
+    @patch('jobs.BaseWorker.perform_job')
+    def test_worker(self, perform_job):
+        """Test the worker observes the latency of every queue."""
+        metrics = Metrics(FakeRedis())
+        job = MagicMock()
+        job.enqueued_at = datetime.utcnow() - timedelta(seconds=2)
+        queue = MagicMock()
+        queue.name = 'mywebhooks-high'
+        worker = Worker.__new__(Worker)
+        with patch('jobs.metrics', metrics):
+            assert worker.perform_job(job, queue) == perform_job.return_value
+        perform_job.assert_called_with(worker, job, queue)
+        values = metrics.redis.hgetall(metrics.key)
+        wait = 'instantwild_queue_wait_seconds_sum{queue="mywebhooks-high"}'
+        assert float(values[wait]) >= 2, values
+        run = 'instantwild_job_seconds_count{queue="mywebhooks-high"}'
+        assert values[run] == '1', values
+
+    @patch('jobs.warm_project')
+    @patch('jobs.BaseWorker.execute_job')
+    def test_worker_warm(self, execute_job, warm_project):
+        """Test the worker warms the projects of a job before forking."""
+        worker = Worker.__new__(Worker)
+        queue = MagicMock()
+        job = MagicMock(args=(), kwargs=self.payload)
+        assert worker.execute_job(job, queue) == execute_job.return_value
+        warm_project.assert_called_once_with(1, 'project')
+        execute_job.assert_called_with(worker, job, queue)
+        warm_project.reset_mock()
+        events = [dict(self.payload, task_id=i) for i in range(3)]
+        events.append(dict(self.payload, project_id=2,
+                           project_short_name='other'))
+        job = MagicMock(args=(events,), kwargs={})
+        worker.execute_job(job, queue)
+        assert warm_project.mock_calls == [call(1, 'project'),
+                                           call(2, 'other')]
+        warm_project.reset_mock()
+        worker.execute_job(MagicMock(args=(), kwargs={}), queue)
+        assert not warm_project.called
+
+    @patch('settings.coalesce_window', 0)
+    @patch('settings.coalesce_webhooks', True)
+    @patch('jobs.basic')
+    @patch('jobs.get_current_job')
+    def test_run_basic(self, get_current_job, basic):
+        """Test a running job lets new events enqueue a new job."""
+        queue = self.queue()
+        enqueue_analysis(queue, self.payload)
+        enqueue_analysis(queue, self.payload)
+        job = MagicMock()
+        job.id = 'f1c3b0a2'
+        job.connection = queue.connection
+        get_current_job.return_value = job
+        res = run_basic(**self.payload)
+        assert res == basic.return_value
+        basic.assert_called_with(**self.payload)
+        assert enqueue_analysis(queue, self.payload) is not None
+        get_current_job.return_value = None
+        run_basic(**self.payload)
+        assert basic.call_count == 2
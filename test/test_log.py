@@ -0,0 +1,135 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Log package for testing PyBossa application.
+
+This exports:
+    - Test the structured logging
+
+"""
+import json
+import logging
+import os
+import time
+from StringIO import StringIO
+import log
+from log import configure, flush_logs, get_logger, Stages, SamplingFilter
+from mock import patch, MagicMock
+
+
+class TestLog(object):
+
+    """Class for Testing the structured logging."""
+
+    def tearDown(self):
+        """TearDown method."""
+        configure('WARNING', queue_size=0)
+
+    def test_json(self):
+        """Test records are written as JSON objects."""
+        stream = StringIO()
+        handler = configure('INFO', stream=stream)
+        logger = get_logger('test')
+        logger.debug('Hidden')
+        logger.info('Task %s analyzed', 1, extra=dict(data=dict(task_id=1)))
+        handler.flush()
+        lines = stream.getvalue().splitlines()
+        assert len(lines) == 1, lines
+        record = json.loads(lines[0])
+        assert record['message'] == 'Task 1 analyzed'
+        assert record['level'] == 'INFO'
+        assert record['logger'] == 'instantwild.test'
+        assert record['task_id'] == 1
+
+    def test_queued_exception(self):
+        """Test queued records keep the traceback of exceptions."""
+        stream = StringIO()
+        handler = configure('INFO', queue_size=10, stream=stream)
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            get_logger('test').exception('Job failed')
+        handler.flush()
+        record = json.loads(stream.getvalue())
+        assert record['message'] == 'Job failed'
+        assert 'Traceback' in record['exception'], record
+        assert "ValueError: boom" in record['exception'], record
+
+    def test_work_horse_exit(self):
+        """Test records logged by a work horse are written before _exit."""
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            try:
+                os.close(read)
+                # The handler is created in the work horse, as when RQ
+                # imports the job there
+                configure('INFO', queue_size=10,
+                          stream=os.fdopen(write, 'w'))
+                get_logger('test').info('Job done')
+                flush_logs()
+            finally:
+                os._exit(0)
+        os.close(write)
+        os.waitpid(pid, 0)
+        lines = os.fdopen(read).read().splitlines()
+        assert len(lines) == 1, lines
+        assert json.loads(lines[0])['message'] == 'Job done'
+
+    def test_queue_full(self):
+        """Test records are dropped when the queue is full."""
+        stream = StringIO()
+        handler = configure('INFO', queue_size=1, stream=stream)
+        target = handler.target
+        handler.target = MagicMock()
+        handler.target.handle.side_effect = lambda r: time.sleep(0.2)
+        logger = get_logger('test')
+        for i in range(5):
+            logger.info('Record %s', i)
+        assert handler.dropped >= 3, handler.dropped
+        handler.flush()
+
+    def test_sampling(self):
+        """Test only a sample of the records below WARNING is kept."""
+        sampling = SamplingFilter(0.5)
+        record = logging.LogRecord('test', logging.INFO, '', 0, '', (), None)
+        with patch('random.random', return_value=0.7):
+            assert not sampling.filter(record)
+            record.levelno = logging.WARNING
+            assert sampling.filter(record)
+        record.levelno = logging.INFO
+        with patch('random.random', return_value=0.3):
+            assert sampling.filter(record)
+        assert SamplingFilter(1.0).filter(record)
+
+    def test_stages(self):
+        """Test Stages adds the time spent in every stage."""
+        stages = Stages()
+        stages.data['task_id'] = 1
+        with patch('time.time', side_effect=[0, 0.5, 1, 1.25, 2, 3]):
+            with stages('fetch'):
+                pass
+            with stages('write'):
+                pass
+            try:
+                with stages('write'):
+                    raise ValueError()
+            except ValueError:
+                pass
+        assert stages.to_dict() == dict(task_id=1, durations=dict(
+            fetch=500.0, write=1250.0)), stages.to_dict()
@@ -0,0 +1,103 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Metrics package for testing PyBossa application.
+
+This exports:
+    - Test the Prometheus metrics
+
+"""
+from base import FakeRedis
+from client import call_name
+from metrics import Metrics
+from mock import MagicMock
+from redis.exceptions import ConnectionError
+
+
+class TestMetrics(object):
+
+    """Class for Testing the metrics."""
+
+    def setUp(self):
+        """SetUp method."""
+        self.metrics = Metrics(FakeRedis(), buckets=(0.1, 1.0))
+        self.metrics.counter('events_total', 'Events.')
+        self.metrics.histogram('request_seconds', 'Requests.')
+
+    def test_counter(self):
+        """Test counters are rendered per label."""
+        self.metrics.inc('events_total', outcome='consensus')
+        self.metrics.inc('events_total', 2, outcome='consensus')
+        self.metrics.inc('events_total', outcome='no_animal_5')
+        lines = self.metrics.render().splitlines()
+        assert lines[:4] == ['# HELP events_total Events.',
+                             '# TYPE events_total counter',
+                             'events_total{outcome="consensus"} 3',
+                             'events_total{outcome="no_animal_5"} 1'], lines
+
+    def test_histogram(self):
+        """Test histograms have cumulative buckets."""
+        self.metrics.observe('request_seconds', 0.05, call='find_tasks')
+        self.metrics.observe('request_seconds', 0.5, call='find_tasks')
+        self.metrics.observe('request_seconds', 5, call='find_tasks')
+        with self.metrics.timer('request_seconds', call='get_user'):
+            pass
+        lines = self.metrics.render().splitlines()
+        assert lines[-12:] == [
+            '# HELP request_seconds Requests.',
+            '# TYPE request_seconds histogram',
+            'request_seconds_bucket{call="find_tasks",le="0.1"} 1',
+            'request_seconds_bucket{call="find_tasks",le="1.0"} 2',
+            'request_seconds_bucket{call="find_tasks",le="+Inf"} 3',
+            'request_seconds_sum{call="find_tasks"} 5.55',
+            'request_seconds_count{call="find_tasks"} 3',
+            'request_seconds_bucket{call="get_user",le="0.1"} 1',
+            'request_seconds_bucket{call="get_user",le="1.0"} 1',
+            'request_seconds_bucket{call="get_user",le="+Inf"} 1',
+            lines[-2],
+            'request_seconds_count{call="get_user"} 1'], lines
+        assert lines[-2].startswith('request_seconds_sum{call="get_user"} ')
+
+    def test_disabled(self):
+        """Test metrics without Redis are not recorded."""
+        metrics = Metrics()
+        metrics.counter('events_total', 'Events.')
+        metrics.inc('events_total')
+        metrics.observe('events_total', 1)
+        assert metrics.render() == ('# HELP events_total Events.\n'
+                                    '# TYPE events_total counter\n')
+
+    def test_redis_down(self):
+        """Test metrics ignore Redis errors."""
+        redis = MagicMock()
+        redis.hincrby.side_effect = ConnectionError()
+        redis.pipeline.return_value.execute.side_effect = ConnectionError()
+        redis.hgetall.side_effect = ConnectionError()
+        metrics = Metrics(redis)
+        metrics.counter('events_total', 'Events.')
+        metrics.inc('events_total')
+        metrics.observe('events_total', 1)
+        assert metrics.render().count('\n') == 2
+
+    def test_call_name(self):
+        """Test requests are named after the PyBossa API calls."""
+        assert call_name('get', 'http://s/api/task?id=1') == 'find_tasks'
+        assert call_name('PUT', 'http://s/api/result/1') == 'update_result'
+        assert call_name('GET', 'http://s/api/user/1?api_key=k') == 'get_user'
+        assert call_name('DELETE', 'http://s/api/task/1') == 'delete_task'
+        assert call_name('GET', 'http://s/') == 'other'
@@ -0,0 +1,102 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Results package for testing PyBossa application.
+
+This exports:
+    - Test the buffered writes of the results
+
+"""
+import threading
+import time
+from mock import MagicMock
+from results import ResultWriter
+
+
+def result(id, info=None):
+    r = MagicMock()
+    r.id = id
+    r.info = info
+    return r
+
+
+class TestResultWriter(object):
+
+    """Class for Testing the ResultWriter."""
+
+    def setUp(self):
+        """SetUp method."""
+        self.stored = []
+        self.lock = threading.Lock()
+        self.failures = {}
+
+    def write(self, r):
+        with self.lock:
+            if self.failures.get(r.id, 0) > 0:
+                self.failures[r.id] -= 1
+                return dict(status='failed', status_code=500)
+            self.stored.append((r.id, r.info))
+            return r
+
+    def test_flush_by_size(self):
+        """Test results are stored once size of them are queued."""
+        writer = ResultWriter(self.write, size=3, interval=60)
+        writer.add(result(1))
+        writer.add(result(2, 'old'))
+        writer.add(result(2, 'new'))
+        assert self.stored == []
+        assert writer.stats()['queued'] == 2
+        writer.add(result(3))
+        assert self.stored == [(1, None), (2, 'new'), (3, None)], self.stored
+        assert writer.stats() == dict(queued=0, written=3, failed=0)
+        assert writer.flush() == 0
+
+    def test_flush_by_time(self):
+        """Test queued results are stored every interval seconds."""
+        writer = ResultWriter(self.write, size=100, interval=0.05)
+        writer.add(result(1))
+        deadline = time.time() + 5
+        while len(self.stored) == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        assert self.stored == [(1, None)], self.stored
+
+    def test_retries(self):
+        """Test failed writes are retried."""
+        writer = ResultWriter(self.write, size=100, interval=60, retries=2,
+                              pool_size=2, retry_delay=0)
+        self.failures = {1: 2, 2: 3}
+        writer.add(result(1))
+        writer.add(result(2))
+        assert writer.flush() == 1
+        assert self.stored == [(1, None)], self.stored
+        assert writer.stats() == dict(queued=0, written=1, failed=1)
+
+    def test_exceptions(self):
+        """Test writes raising exceptions are retried."""
+        calls = []
+
+        def write(r):
+            calls.append(r.id)
+            if len(calls) == 1:
+                raise IOError('Connection reset')
+            return r
+
+        writer = ResultWriter(write, interval=60, retry_delay=0)
+        writer.add(result(1))
+        assert writer.flush() == 1
+        assert calls == [1, 1]
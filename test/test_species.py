@@ -0,0 +1,100 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Species package for testing PyBossa application.
+
+This exports:
+    - Test the species index
+
+"""
+from species import SpeciesIndex
+from mock import patch, Mock, call
+
+
+def helping_material(id, name, status='Endangered', species='common'):
+    return dict(id=id, info=dict(scientific_name=name,
+                                 iucn_red_list_status=status,
+                                 species=species))
+
+
+def response(data, status=200):
+    res = Mock()
+    res.status_code = status
+    res.json.return_value = data
+    return res
+
+
+class TestSpeciesIndex(object):
+
+    """Class for Testing the species index."""
+
+    @patch('species.session')
+    def test_load_pages(self, requests_mock):
+        """Test load fetches all the pages using keyset pagination."""
+        requests_mock.get.side_effect = [
+            response([helping_material(1, 'Panthera leo'),
+                      helping_material(2, 'Loxodonta  Africana',
+                                       status='Vulnerable',
+                                       species='elephant')]),
+            response([helping_material(5, 'Lore')])]
+        index = SpeciesIndex(1, 'http://server', page_size=2)
+        assert index.load() == 3
+        assert len(index) == 3
+        assert index.watermark == 5
+        assert index.lookup('loxodonta africana') == ('Vulnerable',
+                                                      'elephant')
+        assert index.lookup('Unknown') is None
+        url = 'http://server/api/helpingmaterial'
+        calls = [call(url, params=dict(project_id=1, limit=2)),
+                 call(url, params=dict(project_id=1, limit=2, last_id=2))]
+        assert requests_mock.get.mock_calls == calls, requests_mock.get.mock_calls
+
+    @patch('species.session')
+    def test_refresh_incremental(self, requests_mock):
+        """Test refresh only asks for items after the watermark."""
+        requests_mock.get.side_effect = [
+            response([helping_material(3, 'Panthera leo')]),
+            response([helping_material(7, 'Lore')])]
+        index = SpeciesIndex(1, 'http://server', refresh_interval=0)
+        index.load()
+        assert index.refresh() == 1
+        requests_mock.get.assert_called_with(
+            'http://server/api/helpingmaterial',
+            params=dict(project_id=1, limit=100, last_id=3))
+        assert index.lookup('lore') == ('Endangered', 'common')
+
+    @patch('species.session')
+    def test_refresh_interval(self, requests_mock):
+        """Test refresh does not hammer the server."""
+        requests_mock.get.return_value = response([])
+        index = SpeciesIndex(1, 'http://server', refresh_interval=60)
+        index.load()
+        assert index.refresh() == 0
+        assert requests_mock.get.call_count == 1
+
+    @patch('species.session')
+    def test_errors(self, requests_mock):
+        """Test server errors and incomplete items are ignored."""
+        requests_mock.get.side_effect = [
+            response([dict(id=1, info=dict(scientific_name='Lore')),
+                      dict(id=2, info=None)]),
+            response(dict(status='failed'), status=500)]
+        index = SpeciesIndex(1, 'http://server', page_size=2)
+        assert index.load() == 2
+        assert len(index) == 0
+        assert index.watermark == 2
@@ -0,0 +1,173 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tally package for testing PyBossa application.
+
+This exports:
+    - Test the pandas-free tally of answers
+
+"""
+import math
+import random
+import numpy as np
+import pandas as pd
+from analysis import get_count_nan, get_consensus, get_no_animal
+from base import FakeRedis
+from tally import Tally, TallyStore
+from mock import MagicMock
+
+
+def task_run(answer, id=1, user_id=None):
+    tr = MagicMock()
+    tr.id = id
+    tr.user_id = user_id
+    tr.info = dict(answer=answer)
+    return tr
+
+
+def no_animal():
+    return [{'animalCount': -1}]
+
+
+def animal(name='lore', count=1.0):
+    return [{'animalCount': count, 'speciesScientificName': name,
+             'speciesCommonName': 'common', 'speciesID': name}]
+
+
+def random_task_runs(rnd, n):
+    task_runs = []
+    for i in range(n):
+        if rnd.random() < 0.4:
+            task_runs.append(task_run(no_animal()))
+        elif rnd.random() < 0.2:
+            task_runs.append(task_run(animal('ipsum', rnd.randint(1, 5)) +
+                                      animal('lore', rnd.randint(1, 5))))
+        else:
+            task_runs.append(task_run(animal(rnd.choice(['lore', 'ipsum',
+                                                         'dolor']),
+                                             rnd.randint(1, 5))))
+    return task_runs
+
+
+class TestTally(object):
+
+    """Class for Testing the tally."""
+
+    def tally(self, task_runs):
+        tally = Tally()
+        for tr in task_runs:
+            tally.add_task_run(tr)
+        return tally
+
+    def test_no_animal(self):
+        """Test the no animal answers are counted."""
+        tally = self.tally([task_run(no_animal()) for i in range(5)])
+        assert tally.task_runs == 5
+        assert tally.top() == (True, 5)
+        assert tally.consensus(th=1) == []
+
+    def test_top(self):
+        """Test top returns the most common answer."""
+        task_runs = [task_run(no_animal()) for i in range(4)]
+        task_runs += [task_run(animal()) for i in range(6)]
+        tally = self.tally(task_runs)
+        assert tally.top() == (False, 6)
+
+    def test_tie(self):
+        """Test a species tied with no animal is the most common answer."""
+        task_runs = [task_run(no_animal()) for i in range(10)]
+        task_runs += [task_run(animal()) for i in range(10)]
+        for order in [task_runs, task_runs[::-1]]:
+            tally = self.tally(order)
+            assert tally.top() == (False, 10)
+            df = pd.DataFrame([datum for tr in order
+                               for datum in tr.info['answer']])
+            assert not get_no_animal(get_count_nan(df))
+
+    def test_consensus(self):
+        """Test consensus returns the statistics of the animalCount."""
+        task_runs = [task_run(animal(count=c)) for c in [1, 2, 3]]
+        task_runs.append(task_run(animal(name='ipsum', count=float('nan'))))
+        answers = self.tally(task_runs).consensus(th=1)
+        assert len(answers) == 2
+        assert answers[0]['speciesScientificName'] == 'ipsum'
+        assert math.isnan(answers[0]['animalCount'])
+        assert math.isnan(answers[0]['animalCountStd'])
+        assert math.isnan(answers[0]['animalCountMin'])
+        assert answers[1] == dict(speciesScientificName='lore',
+                                  animalCount=2.0, animalCountStd=1.0,
+                                  animalCountMin=1.0, animalCountMax=3.0)
+        assert self.tally(task_runs).consensus(th=4) == []
+
+    def test_same_decisions_as_pandas(self):
+        """Test the tally decides like get_count_nan and get_consensus."""
+        rnd = random.Random(7)
+        for i in range(200):
+            task_runs = random_task_runs(rnd, rnd.choice([5, 10, 12, 20, 25]))
+            data = [datum for tr in task_runs for datum in tr.info['answer']]
+            df = pd.DataFrame(data)
+            vc = get_count_nan(df)
+            tally = self.tally(task_runs)
+            no_animal, top = tally.top()
+            assert top == vc.values[0], (top, vc)
+            assert no_animal == get_no_animal(vc), (no_animal, vc)
+            if 'speciesScientificName' not in df.columns:
+                continue
+            expected = get_consensus(df, th=5)
+            answers = tally.consensus(th=5)
+            assert ([a['speciesScientificName'] for a in answers] ==
+                    [a['speciesScientificName'] for a in expected])
+            keys = ['animalCount', 'animalCountStd', 'animalCountMin',
+                    'animalCountMax']
+            for a, b in zip(answers, expected):
+                assert np.allclose([a[k] for k in keys], [b[k] for k in keys],
+                                   equal_nan=True), (a, b)
+
+    def test_contributions(self):
+        """Test the answers of registered users are kept."""
+        tally = self.tally([task_run(animal(), id=3, user_id=1),
+                            task_run(no_animal(), id=7, user_id=None),
+                            task_run(no_animal(), id=5, user_id=2)])
+        assert tally.last_task_run_id == 7
+        assert tally.contributions == [
+            [1, [dict(speciesScientificName='lore', animalCount=1.0)]],
+            [2, [dict(speciesScientificName=None, animalCount=-1)]]]
+
+
+class TestTallyStore(object):
+
+    """Class for Testing the tally store."""
+
+    def test_load_save(self):
+        """Test tallies are stored per task."""
+        store = TallyStore(FakeRedis())
+        tally = store.load(1, 2)
+        assert tally.task_runs == 0
+        tally.add_task_run(task_run(animal(count=2), id=4, user_id=1))
+        tally.add_task_run(task_run(no_animal(), id=5))
+        store.save(1, 2, tally)
+        assert store.load(1, 3).task_runs == 0
+        assert store.count(1, 3) is None
+        assert store.count(1, 2) == 2
+        stored = store.load(1, 2)
+        assert stored.to_dict() == tally.to_dict()
+        assert stored.top() == tally.top()
+        assert stored.consensus(th=1) == tally.consensus(th=1)
+        store.delete(1, 2)
+        assert store.load(1, 2).task_runs == 0
+        assert store.count(1, 2) is None
@@ -0,0 +1,73 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+Workers package for testing PyBossa application.
+
+This exports:
+    - Test the in-process worker pool
+
+"""
+import threading
+from workers import WorkerPool
+
+
+class TestWorkerPool(object):
+
+    """Class for Testing the WorkerPool."""
+
+    def test_submit(self):
+        """Test jobs run in the pool and failures are counted."""
+        pool = WorkerPool(size=2, maxsize=10)
+        done = []
+
+        def job(i, fail=False):
+            if fail:
+                raise ValueError(i)
+            done.append(i)
+
+        for i in range(5):
+            assert pool.submit(job, i)
+        assert pool.submit(job, 5, fail=True)
+        assert pool.drain(timeout=5)
+        assert sorted(done) == range(5), done
+        assert pool.stats() == dict(queued=0, running=0, processed=6,
+                                    failed=1, rejected=0), pool.stats()
+        # Closed pools do not take jobs
+        assert not pool.submit(job, 6)
+        assert pool.stats()['rejected'] == 1
+
+    def test_bounded(self):
+        """Test jobs are rejected when the queue is full."""
+        pool = WorkerPool(size=1, maxsize=2)
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+
+        assert pool.submit(block)
+        assert started.wait(5)
+        assert pool.submit(block)
+        assert pool.submit(block)
+        assert not pool.submit(block)
+        stats = pool.stats()
+        assert stats['queued'] == 2 and stats['running'] == 1, stats
+        assert stats['rejected'] == 1
+        assert not pool.drain(timeout=0.1)
+        release.set()
@@ -0,0 +1,141 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2017 Scifabric LTD.
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa. If not, see <http://www.gnu.org/licenses/>.
+"""
+In-process background jobs for deployments without Redis.
+
+This exports:
+    - WorkerPool: a bounded queue of jobs run by a pool of threads
+    - get_worker_pool: returns the WorkerPool of the web app
+
+"""
+import atexit
+import threading
+import time
+from Queue import Queue, Full
+from log import get_logger
+try:  # pragma: no cover
+    import settings
+except ImportError:  # pragma: no cover
+    import settings_testing as settings
+
+logger = get_logger('workers')
+
+_STOP = object()
+
+
+class WorkerPool(object):
+
+    """A bounded queue of jobs run by a pool of threads."""
+
+    def __init__(self, size=4, maxsize=1000):
+        """Init method."""
+        self.queue = Queue(maxsize)
+        self.lock = threading.Lock()
+        self.accepting = True
+        self.running = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.threads = [threading.Thread(target=self._run)
+                        for i in range(size)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue a job, and return False if the queue is full or closed."""
+        if self.accepting:
+            try:
+                self.queue.put_nowait((func, args, kwargs))
+                return True
+            except Full:
+                pass
+        with self.lock:
+            self.rejected += 1
+        return False
+
+    def drain(self, timeout=30):
+        """Stop accepting jobs and wait for the queued ones to finish.
+
+        Returns True if all of them finished within timeout seconds.
+        """
+        self.accepting = False
+        deadline = time.time() + timeout
+        drained = self.queue.unfinished_tasks == 0
+        while not drained and time.time() < deadline:
+            time.sleep(0.05)
+            drained = self.queue.unfinished_tasks == 0
+        for thread in self.threads:
+            try:
+                self.queue.put_nowait((_STOP, None, None))
+            except Full:
+                break
+        if drained:
+            for thread in self.threads:
+                thread.join(max(deadline - time.time(), 0.1))
+        else:
+            logger.warning('Jobs left in the queue',
+                           extra=dict(data=dict(queued=self.queue.qsize())))
+        return drained
+
+    def stats(self):
+        """Return the number of queued, running and finished jobs."""
+        with self.lock:
+            return dict(queued=self.queue.qsize(), running=self.running,
+                        processed=self.processed, failed=self.failed,
+                        rejected=self.rejected)
+
+    def _run(self):
+        while True:
+            func, args, kwargs = self.queue.get()
+            if func is _STOP:
+                self.queue.task_done()
+                return
+            with self.lock:
+                self.running += 1
+            failed = 1
+            try:
+                func(*args, **kwargs)
+                failed = 0
+            except Exception:
+                logger.exception('Job failed')
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    self.processed += 1
+                    self.failed += failed
+                self.queue.task_done()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_worker_pool():
+    """Return the WorkerPool of the process, starting it if needed.
+
+    Queued jobs are given settings.worker_pool_drain_timeout seconds to
+    finish when the process exits.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool(settings.worker_pool_size,
+                               settings.worker_pool_queue_size)
+            atexit.register(_pool.drain, settings.worker_pool_drain_timeout)
+        return _pool